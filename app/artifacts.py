@@ -0,0 +1,289 @@
+"""
+Locate the artifacts published by the data pipeline and keep copies of them on local disk.
+
+By default artifacts are read from `gs://{BUCKET_NAME}/...`. Setting `DATA_ROOT` to a local directory
+with the same layout as the bucket reads them from there instead, which is useful for working offline.
+
+Setting `DISK_CACHE_DIR` keeps a copy of every artifact the app reads in that directory, so that
+restarted or scaled-out instances with a mounted volume start from local disk instead of downloading
+everything again. The cache is limited to `DISK_CACHE_BYTES` bytes and drops the least recently used
+artifacts first, but never the artifacts that any process sharing the cache is using, which hold a
+shared lock on them until they exit. Cache entries are keyed by the release date and the version of the object
+(the generation or etag on GCS, the modification time and size on other filesystems), so a new
+release or a re-published object is downloaded again, while unchanged objects are reused.
+
+    from artifacts import cached_path
+
+    # a local path to a copy of the Zarr store if the cache is turned on, otherwise its URL
+    path = cached_path('zarr/analysis/wb-f3-2026-07-01.zarr', release='2026-07-01')
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import fsspec
+
+BUCKET = os.getenv('BUCKET_NAME')
+
+# a local directory with the same layout as the bucket, which is read instead of the bucket when it is set
+DATA_ROOT = os.getenv('DATA_ROOT')
+
+# the directory that copies of the artifacts are kept in (the cache is turned off when this is not set)
+DISK_CACHE_DIR = os.getenv('DISK_CACHE_DIR')
+
+# the number of bytes that the cache can use on disk before the least recently used artifacts are dropped
+DISK_CACHE_BYTES = int(os.getenv('DISK_CACHE_BYTES', str(50 * 1024**3)))
+
+# the objects whose version stands in for the version of a whole Zarr store (consolidated metadata)
+METADATA_FILES = ['.zmetadata', 'zarr.json']
+
+MANIFEST = 'cache.json'
+
+# the file in every cache entry that processes using the entry hold a shared lock on
+LOCK = '.lock'
+
+_lock = threading.Lock()
+
+# the cache entries that this process has read from, which may still be open (like lazily opened stores),
+# and the open lock files that keep other processes from evicting them
+_in_use = {}
+
+
+def data_url(path: str) -> str:
+    """
+    Return the URL of an artifact, given its path relative to the root of the bucket.
+    """
+    if DATA_ROOT:
+        return os.path.join(DATA_ROOT, path)
+
+    return f'gs://{BUCKET}/{path}'
+
+
+def exists(path: str) -> bool:
+    """
+    Check whether an artifact has been published, given its path relative to the root of the bucket.
+    """
+    fs, url = fsspec.core.url_to_fs(data_url(path))
+    return fs.exists(url)
+
+
+def object_version(info: dict) -> str:
+    """
+    Return a string that changes whenever an object is re-written, from the output of `fs.info`.
+    """
+    for key in ['generation', 'etag', 'md5Hash']:
+        if info.get(key):
+            return str(info[key])
+
+    return f"{info.get('mtime', info.get('updated'))}-{info.get('size')}"
+
+
+def artifact_version(fs: fsspec.AbstractFileSystem, url: str) -> str:
+    """
+    Return the version of a single object, or of a directory such as a Zarr store.
+
+    The version of a consolidated Zarr store is the version of its metadata, which is re-written
+    whenever the store is. Other directories are versioned by the listing of all of their objects.
+    """
+    info = fs.info(url)
+    if info['type'] != 'directory':
+        return object_version(info)
+
+    for name in METADATA_FILES:
+        if fs.exists(f'{url}/{name}'):
+            return object_version(fs.info(f'{url}/{name}'))
+
+    listing = sorted(
+        (name, object_version(details)) for name, details in fs.find(url, detail=True).items()
+    )
+    return hashlib.sha256(json.dumps(listing).encode()).hexdigest()
+
+
+def directory_size(path: str) -> int:
+    """
+    Return the number of bytes used by the files in a directory.
+    """
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def cache_entries() -> list[dict]:
+    """
+    List the artifacts in the cache, from the least to the most recently used.
+    """
+    entries = []
+    for release in os.listdir(DISK_CACHE_DIR):
+        release_dir = os.path.join(DISK_CACHE_DIR, release)
+        if release.startswith('.') or not os.path.isdir(release_dir):
+            continue
+
+        for key in os.listdir(release_dir):
+            manifest = os.path.join(release_dir, key, MANIFEST)
+            try:
+                with open(manifest) as f:
+                    entry = json.load(f)
+                entry['path'] = os.path.join(release_dir, key)
+                entry['used'] = os.path.getmtime(manifest)
+            except (FileNotFoundError, json.JSONDecodeError):
+                # entries that are still being written by another process have no manifest yet
+                continue
+            entries.append(entry)
+
+    return sorted(entries, key=lambda entry: entry['used'])
+
+
+def use(entry: str) -> bool:
+    """
+    Take a shared lock on a cache entry for the rest of the process, so that no process evicts it.
+    Returns False if the entry was evicted before the lock was taken.
+    """
+    if entry in _in_use:
+        return True
+
+    # the lock file is created for entries that were cached before entries had one
+    try:
+        lock = open(os.path.join(entry, LOCK), 'a')
+    except FileNotFoundError:
+        return False
+
+    fcntl.flock(lock, fcntl.LOCK_SH)
+    # the entry could have been removed while this process waited for the lock
+    if not os.path.exists(os.path.join(entry, MANIFEST)):
+        lock.close()
+        return False
+
+    _in_use[entry] = lock
+    return True
+
+
+def remove_unused(path: str) -> bool:
+    """
+    Remove a cache entry unless a process holds a lock on it. Returns whether it was removed.
+    """
+    try:
+        lock = open(os.path.join(path, LOCK), 'a')
+    except FileNotFoundError:
+        # another process has already removed it
+        return True
+
+    with lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+
+        shutil.rmtree(path, ignore_errors=True)
+
+    return True
+
+
+def evict() -> None:
+    """
+    Drop the least recently used artifacts until the cache fits in its byte budget,
+    except for the artifacts that this process or any other process sharing the cache is using.
+    """
+    with _lock:
+        entries = cache_entries()
+        total = sum(entry['nbytes'] for entry in entries)
+
+        for entry in entries:
+            if total <= DISK_CACHE_BYTES:
+                break
+            if entry['path'] in _in_use or not remove_unused(entry['path']):
+                continue
+
+            total -= entry['nbytes']
+
+        # remove release directories that no longer have any artifacts in them
+        for release in os.listdir(DISK_CACHE_DIR):
+            release_dir = os.path.join(DISK_CACHE_DIR, release)
+            if not release.startswith('.') and os.path.isdir(release_dir):
+                try:
+                    os.rmdir(release_dir)
+                except OSError:
+                    pass
+
+
+def cached_path(path: str, release: str = 'static') -> str:
+    """
+    Return where an artifact can be read from, given its path relative to the root of the bucket.
+
+    If the disk cache is turned off, this is the URL of the artifact. Otherwise, the artifact is
+    downloaded into the cache if there is no copy of its current version yet, and the path to the
+    local copy is returned. Artifacts that are published for every release, like the water balance
+    data, should pass the release date, while artifacts that are shared by releases keep the default.
+    """
+    url = data_url(path)
+    if not DISK_CACHE_DIR:
+        return url
+
+    fs, remote = fsspec.core.url_to_fs(url)
+    version = artifact_version(fs, remote)
+    key = hashlib.sha256(f'{url}@{version}'.encode()).hexdigest()[:32]
+
+    entry = os.path.join(DISK_CACHE_DIR, release, key)
+    local = os.path.join(entry, os.path.basename(path.rstrip('/')))
+    manifest = os.path.join(entry, MANIFEST)
+
+    if os.path.exists(manifest) and use(entry):
+        # the modification time of the manifest is when the artifact was last used
+        os.utime(manifest)
+        return local
+
+    # download into a temporary directory first, so that other threads and processes
+    # sharing the cache never see a partially written artifact
+    staging_dir = os.path.join(DISK_CACHE_DIR, '.staging')
+    os.makedirs(staging_dir, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=staging_dir)
+
+    try:
+        target = os.path.join(staging, os.path.basename(local))
+        if fs.isdir(remote):
+            fs.get(remote.rstrip('/') + '/', target, recursive=True)
+        else:
+            fs.get(remote, target)
+
+        if not os.path.exists(target):
+            raise FileNotFoundError(f'Could not download {url} to the disk cache.')
+
+        with open(os.path.join(staging, MANIFEST), 'w') as f:
+            json.dump(
+                {
+                    'url': url,
+                    'version': version,
+                    'nbytes': directory_size(staging),
+                    'created': time.time(),
+                },
+                f,
+            )
+
+        # the lock is taken before the entry appears, so it can't be evicted before this process uses it
+        lock = open(os.path.join(staging, LOCK), 'w')
+        fcntl.flock(lock, fcntl.LOCK_SH)
+
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        try:
+            os.rename(staging, entry)
+            _in_use[entry] = lock
+        except OSError:
+            # another thread or process has already cached the same version of the artifact
+            lock.close()
+            shutil.rmtree(staging, ignore_errors=True)
+            if not use(entry):
+                raise
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    evict()
+
+    return local
@@ -0,0 +1,49 @@
+"""
+Static files that the app serves from installed packages, with long-lived cache headers.
+
+Their URLs include the version of their package, so browsers keep them until the package is upgraded,
+and the app page only downloads plotly.js once instead of with every forecast map:
+
+    ui.tags.script(src=assets.plotly_js_url)
+
+    app = assets.with_cache_control(
+        App(app_ui, server, static_assets={'/': static_dir, **assets.static_assets})
+    )
+"""
+
+from pathlib import Path
+
+import plotly
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# plotly.js of the installed plotly package, which draws the forecast map and the timeseries chart
+plotly_js_url = f'plotly-{plotly.__version__}.min.js'
+plotly_js_path = Path(plotly.__file__).parent / 'package_data' / 'plotly.min.js'
+
+# the static files, keyed by their path in the app
+static_assets = {f'/{plotly_js_url}': plotly_js_path}
+
+# the files never change at their URL, so browsers do not need to check them again
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def with_cache_control(app: ASGIApp) -> ASGIApp:
+    """
+    Add the `Cache-Control` header of the static files to their responses from an ASGI app,
+    like the Shiny app, and pass every other request on unchanged.
+    """
+
+    async def cache_control_app(scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or scope['path'] not in static_assets:
+            await app(scope, receive, send)
+            return
+
+        async def send_with_cache_control(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                MutableHeaders(scope=message)['Cache-Control'] = CACHE_CONTROL
+            await send(message)
+
+        await app(scope, receive, send_with_cache_control)
+
+    return cache_control_app
@@ -1,4 +1,4 @@
-import io
+import base64
 import json
 from datetime import datetime
 from pathlib import Path
@@ -6,31 +6,39 @@ from pathlib import Path
 import gcsfs
 import geopandas as gpd
 import matplotlib
-import matplotlib.dates as mdates
-import matplotlib.font_manager as font_manager
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import plotly.express as px
 import plotly.graph_objects as go
 import rioxarray
 import shapely
 import xarray as xr
-from matplotlib.lines import Line2D
 from shiny import App, Inputs, Outputs, Session, reactive, render, ui
 from shinywidgets import output_widget, render_plotly, render_widget
 
+import assets
+import frames
+import metrics
+import prefetch
 from utils import (
     create_bbox_from_coords,
     forecast_dates,
     historical_dates,
     load_countries,
-    load_crop_extent_vector,
-    load_crop_production_raster,
-    load_forecast_wb,
-    load_historical_wb,
     load_states,
 )
+from views import (
+    DOWNLOAD_SIZE,
+    FORECAST_MAP_CONFIG,
+    TIMESERIES_MODE,
+    forecast_map_payload,
+    render_async,
+    render_timeseries,
+    select_region,
+    series_table,
+    table_chunks,
+    table_csv,
+    timeseries_chart,
+)
 
 # shiny run --reload drought.py
 
@@ -52,9 +60,6 @@ max_index = len(slider_dates) - 1
 
 # point the app to the static files directory
 static_dir = Path(__file__).parent / 'www'
-# get the font based on the path
-ginto = font_manager.FontProperties(fname='./www/GintoNormal-Regular.ttf')
-ginto_medium = font_manager.FontProperties(fname='./www/GintoNormal-Medium.ttf')
 
 app_ui = ui.page_fluid(
     # css
@@ -63,6 +68,14 @@ app_ui = ui.page_fluid(
         ui.include_js('./scripts/reset-sidebar-visibility.js', method='inline'),
         ui.include_js('./scripts/sidebar-visibility.js', method='inline'),
         ui.include_js('./scripts/navbar-width.js', method='inline'),
+        # plotly.js draws the forecast map and the interactive timeseries chart
+        ui.tags.script(src=assets.plotly_js_url),
+        ui.include_js('./scripts/forecast-map.js', method='inline'),
+        (
+            ui.include_js('./scripts/timeseries-chart.js', method='inline')
+            if TIMESERIES_MODE == 'interactive'
+            else None
+        ),
     ),
     ui.div(
         {'id': 'layout'},
@@ -161,13 +174,29 @@ app_ui = ui.page_fluid(
 )
 
 
+class render_png(render.image):
+    """
+    Render an image from PNG bytes in its `src`, instead of from a file like `render.image`.
+    """
+
+    async def transform(self, value):
+        src = base64.b64encode(value['src']).decode('utf-8')
+        return {**value, 'src': f'data:image/png;base64,{src}'}
+
+
 def server(input: Inputs, output: Outputs, session: Session):
 
-    countries = load_countries()
-    states = load_states()
+    metrics.sessions.inc()
+    metrics.active_sessions.inc()
+    session.on_ended(metrics.active_sessions.dec)
 
-    countries_list = sorted(countries.name.values)
-    country_options = reactive.value(countries_list)
+    # these are loaded in the background when the app starts, and are set once they are ready,
+    # since waiting for them here would block every session of the app process
+    countries = reactive.value(None)
+    states = reactive.value(None)
+
+    countries_list = reactive.value([])
+    country_options = reactive.value([])
 
     # states_dict = states.groupby('country')['name'].apply(list).to_dict()
     # states_list keeps track of all states within a given country so that
@@ -197,8 +226,6 @@ def server(input: Inputs, output: Outputs, session: Session):
         'Wheat',
     ]
     crop_options = reactive.value(crop_list)
-    crop_layer = reactive.value(None)
-    crop_production = reactive.value(None)
 
     country_name = reactive.value('')
     state_name = reactive.value('')
@@ -213,21 +240,21 @@ def server(input: Inputs, output: Outputs, session: Session):
     # these values change the data between the 3-month and 12-month integration windows
     integration_window = reactive.value(None)
 
-    # these values represent the data clipped to a specific area, used for the timeseries figures
-    historical_wb = reactive.value(None)
-    forecast_wb = reactive.value(None)
+    # the historical and forecast timeseries for a specific area, used for the timeseries figures and tables
+    regional_series = reactive.value(None)
 
-    # these values represent the data clipped to a specific area for the unweighted forecast map
-    unweighted_historical_wb = reactive.value(None)
+    # this value represents the forecast data clipped to a specific area for the unweighted forecast map
     unweighted_forecast_wb = reactive.value(None)
 
+    # the (country, state, crop, window) of the regional series
+    selection = reactive.value(None)
+
     # values for quickly storing and downloading figures and tables
     timeseries_to_save = reactive.value(None)
     table_to_save = reactive.value(None)
     add_download_links = reactive.value(True)
 
     display_bounds_error = reactive.value(False)
-    data_has_loaded = reactive.value(False)
 
     @render.ui
     def main_content():
@@ -263,13 +290,19 @@ def server(input: Inputs, output: Outputs, session: Session):
                     ),
                     ui.card(
                         {'id': 'timeseries-inner-container'},
-                        ui.output_plot('timeseries', width='100%', height='100%'),
+                        (
+                            ui.div({'id': 'timeseries_chart'})
+                            if TIMESERIES_MODE == 'interactive'
+                            else ui.output_plot('timeseries', width='100%', height='100%')
+                        ),
                     ),
                 ),
                 ui.output_ui('show_time_slider'),
                 ui.div(
                     {'id': 'download-csv-container', 'class': 'download-container'},
                     ui.download_link('download_csv_link', 'Download CSV'),
+                    ui.download_link('download_parquet_link', 'Parquet'),
+                    ui.download_link('download_arrow_link', 'Arrow'),
                 ),
                 ui.div(
                     {'id': 'timeseries-table-container'},
@@ -282,25 +315,69 @@ def server(input: Inputs, output: Outputs, session: Session):
                 f"input.tab_menu == '{forecast_tab_name}'",
                 ui.div(
                     {'id': 'forecast-map-container'},
-                    ui.output_ui('forecast_map'),
+                    # the map is drawn in the browser, which keeps it between selections
+                    ui.div({'id': 'forecast_map'}),
                 ),
             ),
         )
 
+    # a user who reloads the page while the datasets that are needed first have failed loads them again
+    prefetch.retry(*prefetch.REQUIRED_DATASETS)
+
+    # changed when datasets are loaded again, which checks on them again
+    status_checks = reactive.value(0)
+
+    @reactive.calc
+    def data_status():
+        status_checks()
+        status = prefetch.status()
+
+        # keep checking on the datasets while any of them is loading. datasets that failed are
+        # loaded again when a user asks for them, so they are not checked on until then
+        if any(value == 'loading' for value in status.values()):
+            reactive.invalidate_later(1)
+
+        return status
+
+    # whether the datasets that are needed first have loaded, which only changes once,
+    # so that the sidebar is not rendered again every time the status of the other datasets is checked
+    required_data_ready = reactive.value(False)
+
+    @reactive.effect
+    def update_required_data_ready():
+        status = data_status()
+        required_data_ready.set(
+            all(status.get(name, 'ready') == 'ready' for name in prefetch.REQUIRED_DATASETS)
+        )
+
     @reactive.effect
-    @reactive.event(input.load_data_button)
-    def load_data():
-        load_historical_wb('12')
-        load_forecast_wb('12')
+    @metrics.handler
+    def update_boundaries():
+        if not required_data_ready() or countries() is not None:
+            return
 
-        load_historical_wb('3')
-        load_forecast_wb('3')
+        # the datasets have finished loading, so this does not wait
+        new_countries = prefetch.get('countries', load_countries)
+        countries.set(new_countries)
+        states.set(prefetch.get('states', load_states))
+        names = sorted(new_countries.name.values)
+        countries_list.set(names)
+        country_options.set(names)
 
-        data_has_loaded.set(True)
+    @render.ui
+    def data_status_list():
+        status = data_status()
+        return ui.tags.ul(
+            {'id': 'data-status-list'},
+            *[
+                ui.tags.li({'class': f'data-status-{value}'}, f'{name}: {value}')
+                for name, value in status.items()
+            ],
+        )
 
     @render.ui
     def sidebar_content():
-        if data_has_loaded():
+        if countries() is not None and required_data_ready():
             sidebar_content = ui.TagList(
                 ui.div(
                     {'id': 'sidebar'},
@@ -312,7 +389,7 @@ def server(input: Inputs, output: Outputs, session: Session):
                         ),
                         ui.input_text('country_filter', label='', placeholder='Filter by name'),
                         # https://shiny.posit.co/py/api/core/ui.update_select.html
-                        ui.input_select('country_select', '', countries_list, size=5),
+                        ui.input_select('country_select', '', countries_list(), size=5),
                         ui.div(
                             {'class': 'select-label-container'},
                             ui.p({'class': 'select-label'}, 'Select a state:'),
@@ -353,11 +430,9 @@ def server(input: Inputs, output: Outputs, session: Session):
                 ui.div(
                     {'id': 'load-data-container'},
                     ui.div(
-                        ui.p({'id': 'load-data-message'}, 'Please load data before continuing'),
-                    ),
-                    ui.input_task_button(
-                        "load_data_button", label='Load Data', label_busy='Loading...'
+                        ui.p({'id': 'load-data-message'}, 'Loading data, please wait...'),
                     ),
+                    ui.output_ui('data_status_list'),
                 ),
             )
 
@@ -400,12 +475,13 @@ def server(input: Inputs, output: Outputs, session: Session):
 
     @reactive.effect
     @reactive.event(country_filter_text)
+    @metrics.handler
     def update_country_list():
         query = country_filter_text()
         country_options.set(
-            countries_list
+            countries_list()
             if query == ''
-            else [value for value in countries_list if query.lower() in value.lower()]
+            else [value for value in countries_list() if query.lower() in value.lower()]
         )
 
     @reactive.effect
@@ -427,13 +503,14 @@ def server(input: Inputs, output: Outputs, session: Session):
 
     @reactive.effect
     @reactive.event(country_name)
+    @metrics.handler
     def update_state_list():
         cname = country_name()
 
         if cname == '':
             return
 
-        df = states.query(" country == @cname ")
+        df = states().query(" country == @cname ")
         slist = sorted(df.name.values.tolist())
         # slist = states_dict[cname]
         # some countries have no administrative states / regions
@@ -464,6 +541,7 @@ def server(input: Inputs, output: Outputs, session: Session):
 
     @reactive.effect
     @reactive.event(country_name, state_name)
+    @metrics.handler
     def update_bounds():
         cname = country_name()
         sname = state_name()
@@ -474,10 +552,10 @@ def server(input: Inputs, output: Outputs, session: Session):
 
         # https://stackoverflow.com/questions/1894269/how-to-convert-string-representation-of-list-to-a-list#1894296
         if sname == 'All':
-            new_bounds = json.loads(countries.query(" name == @cname ").bbox.values[0])
+            new_bounds = json.loads(countries().query(" name == @cname ").bbox.values[0])
         else:
             new_bounds = json.loads(
-                states.query(" name == @sname and country == @cname ").bbox.values[0]
+                states().query(" name == @sname and country == @cname ").bbox.values[0]
             )
         bounds.set(new_bounds)
 
@@ -604,13 +682,6 @@ def server(input: Inputs, output: Outputs, session: Session):
         new_crop = input.crop_select().lower()
         crop_name.set(new_crop)
 
-        if new_crop == '' or new_crop == 'none':
-            crop_layer.set(None)
-            crop_production.set(None)
-        else:
-            crop_layer.set(load_crop_extent_vector(new_crop))
-            crop_production.set(load_crop_production_raster(new_crop))
-
     @render.text
     def crop_name_text():
         return crop_name()
@@ -622,11 +693,25 @@ def server(input: Inputs, output: Outputs, session: Session):
                 'input.historical_checkbox == true',
                 ui.div(
                     {'id': 'time-slider-container'},
+                    # the interactive chart moves the time slider to these indexes in the browser
+                    ui.input_action_link(
+                        'skip_months_button',
+                        'Last 5 months',
+                        class_='skip-button',
+                        data_slider_index=max_index,
+                    ),
+                    ui.input_action_link(
+                        'skip_years_button',
+                        'Last 5 years',
+                        class_='skip-button',
+                        data_slider_index=skip_index,
+                    ),
                     ui.input_action_link(
-                        'skip_months_button', 'Last 5 months', class_='skip-button'
+                        'reset_skip_button',
+                        'All data',
+                        class_='skip-button',
+                        data_slider_index=min_index,
                     ),
-                    ui.input_action_link('skip_years_button', 'Last 5 years', class_='skip-button'),
-                    ui.input_action_link('reset_skip_button', 'All data', class_='skip-button'),
                     ui.div(
                         {'id': 'time-slider-labels-container'},
                         ui.div({'class': 'time-slider-label'}, min_slider_date),
@@ -649,16 +734,25 @@ def server(input: Inputs, output: Outputs, session: Session):
     @reactive.effect
     @reactive.event(input.reset_skip_button)
     def reset_skip_button():
+        if TIMESERIES_MODE == 'interactive':
+            return
+
         ui.update_slider('time_slider', value=min_index)
 
     @reactive.effect
     @reactive.event(input.skip_years_button)
     def update_skip_years_button():
+        if TIMESERIES_MODE == 'interactive':
+            return
+
         ui.update_slider('time_slider', value=skip_index)
 
     @reactive.effect
     @reactive.event(input.skip_months_button)
     def update_skip_months_button():
+        if TIMESERIES_MODE == 'interactive':
+            return
+
         ui.update_slider('time_slider', value=max_index)
 
     @reactive.effect
@@ -675,142 +769,56 @@ def server(input: Inputs, output: Outputs, session: Session):
 
     @reactive.effect
     @reactive.event(input.process_data_button)
+    @metrics.handler
     def update_wb_data():
         crop = crop_name()
-        crop_extent = crop_layer()
 
         cname = country_name()
         sname = state_name()
 
         window_size = integration_window()
 
-        if window_size == '3' or window_size == '12':
-            historical = load_historical_wb(window_size)
-            forecast = load_forecast_wb(window_size)
-        else:
-            raise ValueError('The integration window should be either 3 or 12 months.')
-
-        # on app start or page reload, these variables will be empty
-        if cname == '' or sname == '' or crop == '' or historical is None or forecast is None:
+        # data that could not be loaded in the background is loaded again when a user asks for it
+        window_datasets = [f'forecast-{window_size}', f'historical-{window_size}']
+        if prefetch.failed(*window_datasets):
+            prefetch.retry(*window_datasets)
+            status_checks.set(status_checks() + 1)
+            ui.notification_show(
+                f'The {window_size} month data could not be loaded, so it is being loaded again. '
+                'Please try again in a moment.',
+                type='error',
+            )
             return
 
-        xmin, ymin, xmax, ymax = bounds.get()
-        country = countries.query(" name == @cname ")
-        state = states.query(" name == @sname and country == @cname ")
-
-        # we have already filtered countries where we don't have data, so clipping by country extent
-        # should never produce a rioxarray.exceptions.NoDataInBounds error at this step
-        if sname == 'All':
-            historical = historical.rio.clip(country.geometry, all_touched=True, drop=True)
-            forecast = forecast.rio.clip(country.geometry, all_touched=True, drop=True)
-        else:
-            historical = historical.rio.clip(state.geometry, all_touched=True, drop=True)
-            forecast = forecast.rio.clip(state.geometry, all_touched=True, drop=True)
+        # users can start with whatever data has finished loading in the background
+        if not prefetch.ready(*window_datasets):
+            ui.notification_show(
+                f'The {window_size} month data is still loading, please try again in a moment.',
+                type='warning',
+            )
+            return
 
-        historical = historical.assign_attrs({'crop': crop})
-        forecast = forecast.assign_attrs({'crop': crop})
+        # on app start or page reload, these variables will be empty
+        if cname == '' or sname == '' or crop == '':
+            return
 
-        if crop == 'none':
-            display_bounds_error.set(False)
-            historical_wb.set(historical)
-            forecast_wb.set(forecast)
-            unweighted_historical_wb.set(historical)
-            unweighted_forecast_wb.set(forecast)
+        forecast, series = select_region(cname, sname, crop, window_size)
 
+        if series is None:
+            display_bounds_error.set(True)
+            selection.set(None)
+            regional_series.set(None)
+            unweighted_forecast_wb.set(None)
             return
-        else:  # we need to production weight the timeseries
-            try:
-                historical = historical.rio.clip(crop_extent.geometry, all_touched=True, drop=True)
-                forecast = forecast.rio.clip(crop_extent.geometry, all_touched=True, drop=True)
-
-                # sometimes, this is silently failing when there is no data to show, but instead returns an empty dataset
-                if historical.perc.isnull().all() or forecast.perc.isnull().all():
-                    print('No data in bounds, but silently failing!')
-                    display_bounds_error.set(True)
-                    historical_wb.set(None)
-                    forecast_wb.set(None)
-                    unweighted_historical_wb.set(None)
-                    unweighted_forecast_wb.set(None)
-                    return
-
-                # but we don't need to production weight the forecast map data
-                unweighted_historical_wb.set(historical)
-                unweighted_forecast_wb.set(forecast)
-
-                # clip production data to country extent, then standardize
-                production = crop_production()
-                production = production.rio.write_crs(4236)
-                if sname == 'All':
-                    clipped_production = production.rio.clip(
-                        country.geometry, all_touched=True, drop=True
-                    )
-                else:
-                    clipped_production = production.rio.clip(
-                        state.geometry, all_touched=True, drop=True
-                    )
-                standardized_production = clipped_production / clipped_production.sum(skipna=True)
-                standardized_production = standardized_production[['x', 'y', 'production']]
-
-                # multiply water balance data by standardized production values
-                historical = xr.merge([historical, standardized_production])
-                historical = historical * historical.production
-
-                forecast = xr.merge([forecast, standardized_production])
-                forecast['5%'] = forecast['5%'] * forecast.production
-                forecast['20%'] = forecast['20%'] * forecast.production
-                forecast['perc'] = forecast['perc'] * forecast.production
-                forecast['80%'] = forecast['80%'] * forecast.production
-                forecast['95%'] = forecast['95%'] * forecast.production
-
-                # next, multiply the water balance data by the number of rows in the dataset
-                # in this case, it is the number of rows in the first (and every individual) month
-                nrows_historical = (
-                    historical.drop_vars('spatial_ref')
-                    .sel(time=min_date)
-                    .to_dataframe()
-                    .dropna()
-                    .shape[0]
-                )
-                nrows_forecast = (
-                    forecast.drop_vars('spatial_ref')
-                    .sel(time=forecast_date)
-                    .to_dataframe()
-                    .dropna()
-                    .shape[0]
-                )
-
-                historical *= nrows_historical
-
-                forecast['5%'] = forecast['5%'] * nrows_forecast
-                forecast['20%'] = forecast['20%'] * nrows_forecast
-                forecast['perc'] = forecast['perc'] * nrows_forecast
-                forecast['80%'] = forecast['80%'] * nrows_forecast
-                forecast['95%'] = forecast['95%'] * nrows_forecast
-
-                # lastly, drop the production row from the dataframes
-                historical = historical[['time', 'x', 'y', 'perc']]
-
-                # forecast = forecast[['time', 'x', 'y', 'agree', '5%', '20%', 'perc', '80%', '95%']]
-                forecast = forecast[['time', 'x', 'y', '5%', '20%', 'perc', '80%', '95%']]
-
-            except rioxarray.exceptions.NoDataInBounds:
-                print('No data in bounds!')
-                display_bounds_error.set(True)
-                historical_wb.set(None)
-                forecast_wb.set(None)
-                unweighted_historical_wb.set(None)
-                unweighted_forecast_wb.set(None)
-                return
-
-            except Exception as error:
-                print(error)
-
-            display_bounds_error.set(False)
-            historical_wb.set(historical)
-            forecast_wb.set(forecast)
+
+        display_bounds_error.set(False)
+        selection.set((cname, sname, crop, window_size))
+        regional_series.set(series)
+        unweighted_forecast_wb.set(forecast)
 
     @reactive.effect
     @reactive.event(display_bounds_error)
+    @metrics.handler
     def update_bounds_error():
         crop = crop_name()
         cname = country_name()
@@ -850,213 +858,20 @@ def server(input: Inputs, output: Outputs, session: Session):
             ui.remove_ui('.bounds-error-container', multiple=True)
 
     @reactive.effect
-    @reactive.event(historical_wb, forecast_wb, input.historical_checkbox, input.forecast_checkbox)
+    @reactive.event(regional_series, input.historical_checkbox, input.forecast_checkbox)
+    @metrics.handler
     def update_dataframe():
-        crop = crop_name()
-        cname = country_name()
-        sname = state_name()
-        window_size = integration_window()
-
         show_historical = input.historical_checkbox()
         show_forecast = input.forecast_checkbox()
 
-        historical = historical_wb()
-        forecast = forecast_wb()
-
-        # if the xarray data is empty (on initial load) or if the toggles controlling which datasets to show are both false, then return empty dataframe
-        if (forecast is None and historical is None) or (
-            show_forecast is False and show_historical is False
-        ):
-            # df = pd.DataFrame({
-            #     'country': [], 'states': [], 'type': [], 'crop': [], 'time': [], 'percentile': [], 'agreement': [],
-            #     '5%': [], '20%': [], '80%': [], '95%': [],
-            # })
-            df = pd.DataFrame(
-                {
-                    'country': [],
-                    'states': [],
-                    'type': [],
-                    'crop': [],
-                    'window': [],
-                    'time': [],
-                    'percentile': [],
-                    '5%': [],
-                    '20%': [],
-                    '80%': [],
-                    '95%': [],
-                }
-            )
-        else:
-            # include just historical
-            if show_historical is True and show_forecast is False:
-                df = (
-                    historical.mean(dim=['x', 'y'])
-                    .drop_vars('spatial_ref')
-                    .to_pandas()
-                    .reset_index()
-                )
-                df['perc'] = df['perc'].astype(float).round(4)
-                # df['agree'] = np.nan
-                df['time'] = df['time'].dt.date
-                # df.columns = ['time', 'percentile', 'agreement']
-                df.columns = ['time', 'percentile']
-                df['country'] = cname
-                df['states'] = sname
-                df['crop'] = crop
-                df['type'] = 'historical'
-                df['window'] = int(window_size)
-                df['5%'] = np.nan
-                df['20%'] = np.nan
-                df['80%'] = np.nan
-                df['95%'] = np.nan
-
-                # df = df[['country', 'state', 'crop', 'type', 'window', 'time', 'percentile', 'agreement', '5%', '20%', '80%', '95%']].sort_values('time', ascending=False).reset_index(drop=True)
-                df = (
-                    df[
-                        [
-                            'country',
-                            'states',
-                            'crop',
-                            'type',
-                            'window',
-                            'time',
-                            'percentile',
-                            '5%',
-                            '20%',
-                            '80%',
-                            '95%',
-                        ]
-                    ]
-                    .sort_values('time', ascending=False)
-                    .reset_index(drop=True)
-                )
-
-            # include just forecast
-            elif show_historical is False and show_forecast is True:
-                df = (
-                    forecast.mean(dim=['x', 'y']).drop_vars('spatial_ref').to_pandas().reset_index()
-                )
-                # this is the 50% line in the forecast data
-                df['perc'] = df['perc'].astype(float).round(4)
-                # df['agree'] = df['agree'].astype(float).round(4)
-                df['5%'] = df['5%'].astype(float).round(4)
-                df['20%'] = df['20%'].astype(float).round(4)
-                df['80%'] = df['80%'].astype(float).round(4)
-                df['95%'] = df['95%'].astype(float).round(4)
-                df['time'] = df['time'].dt.date
-                # df.columns = ['time', 'agreement', '5%', '20%', 'percentile', '80%', '95%']
-                df.columns = ['time', '5%', '20%', 'percentile', '80%', '95%']
-                df['country'] = cname
-                df['states'] = sname
-                df['crop'] = crop
-                df['type'] = 'forecast'
-                df['window'] = int(window_size)
-
-                # df = df[['country', 'states', 'crop', 'type', 'window', 'time', 'percentile', 'agreement', '5%', '20%', '80%', '95%']].sort_values('time', ascending=False).reset_index(drop=True)
-                df = (
-                    df[
-                        [
-                            'country',
-                            'states',
-                            'crop',
-                            'type',
-                            'window',
-                            'time',
-                            'percentile',
-                            '5%',
-                            '20%',
-                            '80%',
-                            '95%',
-                        ]
-                    ]
-                    .sort_values('time', ascending=False)
-                    .reset_index(drop=True)
-                )
-
-            # else both are active, include both
-            else:
-                df_historical = (
-                    historical.mean(dim=['x', 'y'])
-                    .drop_vars('spatial_ref')
-                    .to_pandas()
-                    .reset_index()
-                )
-                df_historical['perc'] = df_historical['perc'].astype(float).round(4)
-                # df_historical['agree'] = np.nan
-                df_historical['time'] = df_historical['time'].dt.date
-                # df_historical.columns = ['time', 'percentile', 'agreement']
-                df_historical.columns = ['time', 'percentile']
-                df_historical['country'] = cname
-                df_historical['states'] = sname
-                df_historical['crop'] = crop
-                df_historical['type'] = 'historical'
-                df_historical['window'] = int(window_size)
-                df_historical['5%'] = np.nan
-                df_historical['20%'] = np.nan
-                df_historical['80%'] = np.nan
-                df_historical['95%'] = np.nan
-                # df_historical = df_historical[['country', 'state', 'crop', 'type', 'window', 'time', 'percentile', 'agreement', '5%', '20%', '80%', '95%']]
-                df_historical = df_historical[
-                    [
-                        'country',
-                        'states',
-                        'crop',
-                        'type',
-                        'window',
-                        'time',
-                        'percentile',
-                        '5%',
-                        '20%',
-                        '80%',
-                        '95%',
-                    ]
-                ]
-
-                df_forecast = (
-                    forecast.mean(dim=['x', 'y']).drop_vars('spatial_ref').to_pandas().reset_index()
-                )
-                df_forecast['perc'] = df_forecast['perc'].astype(float).round(4)
-                # df_forecast['agree'] = df_forecast['agree'].astype(float).round(4)
-                df_forecast['5%'] = df_forecast['5%'].astype(float).round(4)
-                df_forecast['20%'] = df_forecast['20%'].astype(float).round(4)
-                df_forecast['80%'] = df_forecast['80%'].astype(float).round(4)
-                df_forecast['95%'] = df_forecast['95%'].astype(float).round(4)
-                df_forecast['time'] = df_forecast['time'].dt.date
-                # df_forecast.columns = ['time', 'agreement', '5%', '20%', 'percentile', '80%', '95%']
-                df_forecast.columns = ['time', '5%', '20%', 'percentile', '80%', '95%']
-                df_forecast['country'] = cname
-                df_forecast['states'] = sname
-                df_forecast['crop'] = crop
-                df_forecast['type'] = 'forecast'
-                df_forecast['window'] = int(window_size)
-                # df_forecast = df_forecast[['country', 'state', 'crop', 'type', 'window', 'time', 'percentile', 'agreement', '5%', '20%', '80%', '95%']]
-                df_forecast = df_forecast[
-                    [
-                        'country',
-                        'states',
-                        'crop',
-                        'type',
-                        'window',
-                        'time',
-                        'percentile',
-                        '5%',
-                        '20%',
-                        '80%',
-                        '95%',
-                    ]
-                ]
-
-                df = (
-                    pd.concat([df_historical, df_forecast])
-                    .sort_values('time', ascending=False)
-                    .reset_index(drop=True)
-                )
+        df = series_table(regional_series(), show_historical, show_forecast)
 
         table_to_save.set(df)
         return df
 
     @reactive.effect
     @reactive.event(table_to_save)
+    @metrics.handler
     def set_download_button_states():
         """
         If there is nothing to download, then we want to disable the user's ability to download empty figures and tables.
@@ -1066,6 +881,8 @@ def server(input: Inputs, output: Outputs, session: Session):
         if df.empty:
             ui.remove_ui(selector='#download_timeseries_link')
             ui.remove_ui(selector='#download_csv_link')
+            ui.remove_ui(selector='#download_parquet_link')
+            ui.remove_ui(selector='#download_arrow_link')
             add_download_links.set(True)
         else:
             if add_download_links():
@@ -1079,279 +896,101 @@ def server(input: Inputs, output: Outputs, session: Session):
                     selector='#download-csv-container',
                     where='beforeEnd',
                 ),
+                ui.insert_ui(
+                    ui.download_link('download_parquet_link', 'Parquet'),
+                    selector='#download-csv-container',
+                    where='beforeEnd',
+                ),
+                ui.insert_ui(
+                    ui.download_link('download_arrow_link', 'Arrow'),
+                    selector='#download-csv-container',
+                    where='beforeEnd',
+                ),
                 add_download_links.set(False)
 
-    @render.plot
-    @reactive.event(table_to_save, slider_date)
-    def timeseries(alt='A graph showing a timeseries of historical and forecasted water balance'):
-        # later if we want to make it so that we can dynamically change the timeframe:
-        # https://plotly.com/python/range-slider/
-        historical = historical_wb()
-        forecast = forecast_wb()
+    def timeseries_size():
+        return (
+            session.clientdata.output_width('timeseries'),
+            session.clientdata.output_height('timeseries'),
+            session.clientdata.pixelratio(),
+        )
 
-        if historical is None or forecast is None:
+    # the figures are rendered in a thread and cached for every session, so scrubbing the time slider
+    # back and forth only renders every date once
+    @render_png
+    @reactive.event(table_to_save, slider_date, timeseries_size)
+    @metrics.handler
+    async def timeseries():
+        width, height, pixelratio = timeseries_size()
+        if regional_series() is None or not width or not height:
             return
 
         show_historical = input.historical_checkbox()
         show_forecast = input.forecast_checkbox()
-        filter_date = slider_date()
 
-        df = table_to_save()
-        df = df[pd.to_datetime(df['time'], format='%Y-%m-%d') >= pd.Timestamp(filter_date)]
-
-        timeseries_color = '#1b1e23'
-        high_certainty_color = '#f4c1c1'
-        medium_certainty_color = '#f69a9a'
-
-        legend_options = {
-            'xdata': [0],
-            'ydata': [0],
-        }
-
-        historical_label = Line2D(
-            color=timeseries_color,
-            markerfacecolor=timeseries_color,
-            label='Historical',
-            linewidth=1.25,
-            **legend_options,
+        args = (
+            *selection(),
+            show_historical,
+            show_forecast,
+            slider_date(),
+            int(width),
+            int(height),
         )
-        forecast_label = Line2D(
-            color=timeseries_color,
-            markerfacecolor=timeseries_color,
-            label='Mean forecast',
-            linestyle='--',
-            linewidth=1.25,
-            **legend_options,
-        )
-        medium_certainty_label = Line2D(
-            color=medium_certainty_color,
-            markerfacecolor=medium_certainty_color,
-            label='60%',
-            linewidth=3,
-            **legend_options,
-        )
-        high_certainty_label = Line2D(
-            color=high_certainty_color,
-            markerfacecolor=high_certainty_color,
-            label='90%',
-            linewidth=3,
-            **legend_options,
-        )
-        legend_elements = []
-
-        fig, ax = plt.subplots()
-
-        # if both are true, we need to stitch together the historical and forecast timeseries
-        if show_historical is True and show_forecast is True:
-            # this is the historical data plus the first entry for forecast data
-            df_historical = df.iloc[6:, :]
-
-            # this is the 6-month forecast plus the last data entry for historical data
-            df_forecast = df.iloc[0:7, :]
+        png = await render_async(render_timeseries, *args, 100 * (pixelratio or 1))
+
+        timeseries_to_save.set(args)
+        return {
+            'src': png,
+            'width': '100%',
+            'height': '100%',
+            'alt': 'A graph showing a timeseries of historical and forecasted water balance',
+        }
 
-            # this dataframe is purely aesthetic; it covers up the gap in the historical and forecast data in the plot
-            df_bridge = df.iloc[5:7]
+    # the interactive chart gets the whole timeseries of a selection once, and the browser filters it
+    # to the dates of the time slider, so moving the time slider does not run anything on the server
+    @reactive.effect
+    @reactive.event(table_to_save)
+    @metrics.handler
+    async def update_timeseries_chart():
+        if TIMESERIES_MODE != 'interactive':
+            return
 
-            # forecast data needs to be plotted first because of the uncertainty bounds
-            ax.fill_between(
-                df_forecast['time'],
-                df_forecast['5%'],
-                df_forecast['95%'],
-                color=high_certainty_color,
-            )
-            ax.fill_between(
-                df_forecast['time'],
-                df_forecast['20%'],
-                df_forecast['80%'],
-                color=medium_certainty_color,
-            )
-            ax.plot(
-                df_forecast['time'],
-                df_forecast['percentile'],
-                color=timeseries_color,
-                linestyle='--',
-            )
-            ax.plot(df_historical['time'], df_historical['percentile'], color=timeseries_color)
-            ax.plot(df_bridge['time'], df_bridge['percentile'], color=timeseries_color)
-
-            legend_elements = [
-                historical_label,
-                forecast_label,
-                medium_certainty_label,
-                high_certainty_label,
-            ]
-
-        if show_historical is True and show_forecast is False:
-            ax.plot(df['time'], df['percentile'], color=timeseries_color)
-
-            if len(df) == 5:
-                ax.set_xticks([date for date in df.time.values])
-
-            legend_elements = [historical_label]
-
-        if show_historical is False and show_forecast is True:
-            ax.fill_between(df['time'], df['5%'], df['95%'], color=high_certainty_color)
-            ax.fill_between(df['time'], df['20%'], df['80%'], color=medium_certainty_color)
-            ax.plot(df['time'], df['percentile'], color=timeseries_color, linestyle='--')
-
-            forecast_date_format = mdates.DateFormatter('%m-%y')
-            ax.xaxis.set_major_formatter(forecast_date_format)
-
-            legend_elements = [forecast_label, medium_certainty_label, high_certainty_label]
-
-        ax.set_xlabel('Time', fontproperties=ginto_medium)
-        # ax.set_ylabel('Mean water balance', fontproperties=ginto_medium)
-        ax.set_ylabel('Water balance percentile', fontproperties=ginto_medium)
-
-        # when there are 60 or more entries in the dataframe,
-        # the date labels along the x-axis get crowded and difficult to read
-        if len(df) <= 60:
-            date_format = mdates.DateFormatter('%m-%y')
-            ax.xaxis.set_major_formatter(date_format)
-
-        # use custom fonts for x and y axes labels
-        for label in ax.get_xticklabels():
-            label.set_fontproperties(ginto)
-
-        for label in ax.get_yticklabels():
-            label.set_fontproperties(ginto)
-
-        ax.margins(0, 0)
-        ax.set_ylim(-0.05, 1.05)
-
-        if not show_forecast and not show_historical:
-            ax.set_xticks([0, 1, 2, 3, 4, 5])
-            ax.set_xticklabels(['', '', '', '', '', ''])
-
-        # you need both of these to change the colors
-        fig.patch.set_facecolor('#f7f7f7')
-        ax.set_facecolor('#f7f7f7')
-
-        plt.tight_layout()
-        fig.subplots_adjust(bottom=0.25)
-
-        if len(legend_elements) > 0:
-            fig.legend(
-                handles=legend_elements,
-                ncols=len(legend_elements),
-                loc='lower center',
-                bbox_to_anchor=(0 if len(legend_elements) == 3 else 0.025, 0, 1, 0.5),
-                fontsize='small',
-                facecolor='white',
-                frameon=False,
-            )
+        show_historical = input.historical_checkbox()
+        show_forecast = input.forecast_checkbox()
+        df = table_to_save()
 
-        timeseries_to_save.set(fig)
-        return fig
+        # the chart is cleared when there is nothing to show
+        figure = None
+        if regional_series() is not None and not df.empty:
+            figure = timeseries_chart(df, show_historical, show_forecast)
+
+        await session.send_custom_message(
+            'timeseries_chart',
+            {
+                'figure': figure,
+                'historical': show_historical,
+                'dates': slider_dates,
+                'start': slider_date(),
+                'end': None if figure is None else str(df['time'].max()),
+            },
+        )
 
-    @render.ui
+    # only the figure of the map is sent, and the browser updates the map that it already shows
+    @reactive.effect
     @reactive.event(unweighted_forecast_wb)
-    def forecast_map(alt='a map showing the borders of a country of interest'):
+    @metrics.handler
+    async def update_forecast_map():
         forecast = unweighted_forecast_wb()
-        if not forecast:
-            return
-
-        cname = country_name()
-        sname = state_name()
-        country = countries.query(" name == @cname ")
-        # state = states.query(" name == @sname and country == @cname ")
-
-        bbox = bounds()
-        xmin, ymin, xmax, ymax = bbox
-
-        if cname == '' or sname == '' or forecast is None:
-            return
-
-        if any(x is None for x in (xmin, ymin, xmax, ymax)):
-            return
-
-        config = {
-            # 'staticPlot': False,
-            'displaylogo': False,
-            # 'displayModeBar': False,
-            'scrollZoom': True,
-            # 'modeBarButtonsToRemove': ['zoom', 'pan', 'select', 'lasso2d', 'toImage']
-            'modeBarButtonsToRemove': ['pan', 'select', 'lasso2d', 'toImage'],
-        }
 
-        max_bounds = max(abs(xmin - xmax), abs(ymin - ymax)) * 111
-        zoom = 11 - np.log(max_bounds)
-
-        country_forecast = forecast.rio.clip(country.geometry, all_touched=True, drop=True)
-        df = country_forecast['perc'].drop_vars('spatial_ref').to_dataframe().dropna().reset_index()
-        df.columns = ['time', 'y', 'x', 'Percentile']
-
-        formatted_dates = [pd.to_datetime(date).strftime('%b-%Y') for date in forecast_dates]
-
-        fig = px.scatter_map(
-            data_frame=df,
-            lat=df.y,
-            lon=df.x,
-            color=df['Percentile'],
-            color_continuous_scale=px.colors.diverging.RdYlBu,
-            # color_continuous_scale = px.colors.sequential.Plasma,
-            range_color=[0, 1],
-            hover_data={'time': False, 'x': False, 'y': False, 'Percentile': ':.3f'},
-            map_style='carto-positron-nolabels',
-            # map_style = 'carto-darkmatter-nolabels',
-            zoom=zoom,
-            height=495,
-            animation_frame='time',
-        )
+        # the map is cleared when there is nothing to show, and otherwise it is usually cached
+        figure = None
+        if forecast is not None and country_name() != '' and state_name() != '':
+            figure = await render_async(forecast_map_payload, *selection())
 
-        fig['layout'].pop('updatemenus')
-
-        steps = []
-        for idx in range(len(formatted_dates)):
-            step = dict(method='animate', label=formatted_dates[idx])
-            steps.append(step)
-
-        fig.update_layout(
-            sliders=[
-                {
-                    'currentvalue': {'prefix': 'Time: '},
-                    'len': 0.8,
-                    'pad': {'b': 10, 't': 0},
-                    'steps': steps,
-                    # 'transition': {'easing': 'circle-in'},
-                    'bgcolor': '#f7f7f7',
-                    'bordercolor': '#1b1e23',
-                    'activebgcolor': '#1b1e23',
-                    'tickcolor': '#1b1e23',
-                    'font': {'color': '#1b1e23', 'family': 'Ginto normal'},
-                }
-            ],
-            margin=dict(l=0, r=0, t=0, b=0),
-            paper_bgcolor='#f7f7f7',
+        await session.send_custom_message(
+            'forecast_map', {'figure': figure, 'config': FORECAST_MAP_CONFIG}
         )
 
-        fig.update_coloraxes(
-            colorbar_title_side='right',
-            colorbar_title_font=dict(color='#1b1e23', family='Ginto normal'),
-            # colorbar_title_font=dict(color='#f7f7f7', family='Ginto normal'),
-            colorbar_len=0.8,
-            colorbar_thickness=20,
-            colorbar_tickfont=dict(color='#1b1e23', family='Ginto normal'),
-            # colorbar_tickfont=dict(color='#f7f7f7', family='Ginto normal'),
-        )
-
-        fig.update_layout(coloraxis_colorbar_x=0.01, hoverlabel=dict(font_family='Ginto normal'))
-
-        # https://stackoverflow.com/questions/78834353/animated-plotly-graph-in-pyshiny-express
-        """
-        The below is not working in CSS: the background color and border radius change, but not the padding.
-        So I could try to directly change the HTML string to add the padding in myself.
-
-        .maplibregl-ctrl-attrib-inner {
-            background-color: lightgray;
-            border-radius: 10px;
-            padding: 2px 5px;
-        }
-        """
-
-        # to save individual images later: https://github.com/plotly/plotly.py/issues/664
-        return ui.HTML(fig.to_html(config=config, auto_play=False))
-
     @render.download(
         filename=lambda: f'drought-timeseries-{country_name().lower()}-{"" if state_name() == "" else state_name().lower()}-{"historical" if input.historical_checkbox() else ""}-{"forecast" if input.forecast_checkbox() else ""}-{"" if crop_name() == "none" else crop_name()}-{str(integration_window())+"month"}-{forecast_date}.png'.replace(
             ' ', '-'
@@ -1359,65 +998,25 @@ def server(input: Inputs, output: Outputs, session: Session):
         .replace('--', '-')
         .replace('--', '-')
     )
-    def download_timeseries_link():
+    @metrics.handler
+    async def download_timeseries_link():
+        args = timeseries_to_save()
 
-        cname = country_name()
-        sname = state_name()
-        crop = crop_name()
-        window_size = input.window_select()
-
-        forecast = forecast_wb()
-        historical = historical_wb()
-
-        if forecast is None and historical is None:
+        if regional_series() is None:
             return
 
-        # show_historical = input.historical_checkbox()
-        # show_forecast = input.forecast_checkbox()
-
-        fig = timeseries_to_save()
-        plt.figure(fig)
-        ax = plt.gca()
-
-        fig.patch.set_facecolor('white')
-        ax.set_facecolor('white')
-
-        # if(show_historical is True and show_forecast is False):
-        #     historical_and_forecast_label = 'Historical'
-        # elif(show_historical is False and show_forecast is True):
-        #     historical_and_forecast_label = 'Forecasted'
-        # elif(show_historical is True and show_forecast is True):
-        #     historical_and_forecast_label = 'Historical and forecasted'
-
-        cname_label = cname
-
-        if sname == 'CONUS':
-            sname_label = 'CONUS'
-            cname_label = ''
-        elif sname != '' and sname != 'All':
-            sname_label = sname + ', '
-        else:
-            sname_label = ''
-
-        if crop != '' and crop != 'none':
-            crop_label = f' {crop}-growing regions'
-        else:
-            crop_label = ''
-
-        window_label = f', {window_size}-month integration window'
-
-        # title = f'{historical_and_forecast_label} water balance percentile for {sname_label}{cname_label}{crop_label}'
-        title = f'{sname_label}{cname_label}{crop_label}{window_label}'
-        ax.set_title(title, fontproperties=ginto_medium)
+        # the interactive chart is not rendered on the server, so its arguments are only known now
+        if TIMESERIES_MODE == 'interactive' or args is None:
+            show_historical = input.historical_checkbox()
+            show_forecast = input.forecast_checkbox()
+            args = (*selection(), show_historical, show_forecast, slider_date(), *DOWNLOAD_SIZE)
 
-        fig.subplots_adjust(top=0.9)
-
-        with io.BytesIO() as buffer:
-            plt.savefig(buffer, format='png', dpi=300)
-            yield buffer.getvalue()
+        # the downloaded figure has the size of the figure on the screen
+        yield await render_async(render_timeseries, *args, 300, True)
 
     @render.data_frame
     @reactive.event(table_to_save)
+    @metrics.handler
     def timeseries_table():
         df = table_to_save()
 
@@ -1428,19 +1027,44 @@ def server(input: Inputs, output: Outputs, session: Session):
             editable=False,
         )
 
-    @render.download(
-        filename=lambda: f'drought-table-{country_name().lower()}-{"" if state_name() == "" else state_name().lower()}-{"historical" if input.historical_checkbox() else ""}-{"forecast" if input.forecast_checkbox() else ""}-{"" if crop_name() == "none" else crop_name()}-{str(integration_window())+"month"}-{forecast_date}.csv'.replace(
-            ' ', '-'
+    def table_filename(extension: str) -> str:
+        return (
+            f'drought-table-{country_name().lower()}-{"" if state_name() == "" else state_name().lower()}-{"historical" if input.historical_checkbox() else ""}-{"forecast" if input.forecast_checkbox() else ""}-{"" if crop_name() == "none" else crop_name()}-{str(integration_window())+"month"}-{forecast_date}.{extension}'.replace(
+                ' ', '-'
+            )
+            .replace('--', '-')
+            .replace('--', '-')
         )
-        .replace('--', '-')
-        .replace('--', '-')
-    )
+
+    @render.download(filename=lambda: table_filename('csv'))
+    @metrics.handler
     def download_csv_link():
-        df = table_to_save()
+        yield table_csv(table_to_save())
 
-        with io.BytesIO() as buffer:
-            df.to_csv(buffer)
-            yield buffer.getvalue()
+    # the columnar files keep the types of the columns, and are written in chunks
+    @render.download(
+        filename=lambda: table_filename('parquet'), media_type='application/vnd.apache.parquet'
+    )
+    @metrics.handler
+    def download_parquet_link():
+        yield from table_chunks([table_to_save()], 'parquet')
+
+    @render.download(
+        filename=lambda: table_filename('arrow'), media_type='application/vnd.apache.arrow.file'
+    )
+    @metrics.handler
+    def download_arrow_link():
+        yield from table_chunks([table_to_save()], 'arrow')
 
 
-app = App(app_ui, server, static_assets=static_dir)
+# start loading data as soon as the app process starts, instead of when the first user asks for it
+prefetch.start()
+
+# the metrics of the app process and the images of the forecast maps are served next to the app
+app = metrics.with_metrics(
+    frames.with_forecast_frames(
+        assets.with_cache_control(
+            App(app_ui, server, static_assets={'/': static_dir, **assets.static_assets})
+        )
+    )
+)
@@ -0,0 +1,150 @@
+"""
+How the water balance percentiles are stored in the analysis Zarr stores.
+
+The percentiles are bounded in [0, 1], so they do not need to be stored as float64. The data pipeline
+can store them as:
+
+    'uint16'   integers from 0 to 65534 with a scale factor of 1 / 65534, and 65535 for missing data.
+               The largest absolute error versus float64 is half a step, 1 / (2 * 65534) ~ 7.6e-6.
+    'float32'  the largest absolute error versus float64 is 2 ** -25 ~ 3.0e-8 for values in [0, 1].
+    'float64'  no error.
+
+Float percentiles can also be bit-rounded (`bit_round`) to keep only the first `keep_bits` bits of
+their mantissa, which compresses much better since the dropped bits are zeros. Rounding to the nearest
+value with `keep_bits` bits has a relative error of at most 2 ** -(keep_bits + 1), which bounds
+the absolute error for values in [0, 1] too, for example ~ 3.1e-5 with 14 bits. Bit-rounded values are
+still plain floats, so they are read without any extra codec.
+
+The encoding is written as CF attributes (`scale_factor`, `add_offset`, and `_FillValue`), so any CF
+reader like `xr.open_dataset` decodes the data by default. The app instead opens the stores with
+`mask_and_scale=False`, which keeps the compact values in memory (a quarter of the size of float64
+for uint16), and only decodes the pixels that it clips or aggregates with `decode_values`.
+
+Weighted means are convex combinations of the decoded pixels, so the error bound of a single pixel
+also bounds the error of the regional timeseries calculated from them.
+"""
+
+import numcodecs
+import numpy as np
+import xarray as xr
+
+PERCENTILE_DTYPES = ['uint16', 'float32', 'float64']
+
+# the largest integer is kept for missing data
+UINT16_FILL_VALUE = 65535
+UINT16_SCALE_FACTOR = 1 / 65534
+
+# the attributes that describe how the values are encoded, which are dropped once the values are decoded
+ENCODING_ATTRS = ['scale_factor', 'add_offset', '_FillValue', 'missing_value']
+
+
+def percentile_encoding(ds: xr.Dataset, dtype: str) -> dict:
+    """
+    Return the encoding that `ds.to_zarr(encoding=...)` needs to store the percentiles of a Dataset.
+
+    Parameters:
+        ds(xarray.core.dataset.Dataset): water balance data with dims (time, y, x)
+
+        dtype(str): one of 'uint16', 'float32', or 'float64'
+
+    Returns:
+        encoding(dict): the encoding of every data variable with dims (time, y, x)
+    """
+    if dtype not in PERCENTILE_DTYPES:
+        raise ValueError(f'The percentile dtype should be one of {PERCENTILE_DTYPES}.')
+
+    if dtype == 'uint16':
+        encoding = {
+            'dtype': 'uint16',
+            'scale_factor': UINT16_SCALE_FACTOR,
+            'add_offset': 0.0,
+            '_FillValue': UINT16_FILL_VALUE,
+        }
+    else:
+        encoding = {'dtype': dtype, '_FillValue': np.nan}
+
+    return {
+        name: dict(encoding) for name in ds.data_vars if set(ds[name].dims) == {'time', 'y', 'x'}
+    }
+
+
+def decode_values(values: np.ndarray, attrs: dict, dtype: None | str = None) -> np.ndarray:
+    """
+    Decode values that were read without CF decoding (`mask_and_scale=False`) into floats,
+    with NaN for missing data. Values without encoding attributes are only cast to the dtype.
+
+    Parameters:
+        values(numpy.ndarray): the values as they are stored
+
+        attrs(dict): the attributes of the variable the values come from
+
+        dtype(str): the float dtype of the decoded values, by default the dtype of float values
+            and float32 for integers
+
+    Returns:
+        decoded(numpy.ndarray): the decoded values
+    """
+    values = np.asarray(values)
+    if dtype is None:
+        dtype = values.dtype if np.issubdtype(values.dtype, np.floating) else 'float32'
+    decoded = values.astype(dtype)
+
+    fill_value = attrs.get('_FillValue', attrs.get('missing_value'))
+    if fill_value is not None and not np.isnan(fill_value):
+        decoded[values == fill_value] = np.nan
+
+    if 'scale_factor' in attrs:
+        decoded *= attrs['scale_factor']
+    if 'add_offset' in attrs:
+        decoded += attrs['add_offset']
+
+    return decoded
+
+
+def decode_dataset(ds: xr.Dataset) -> xr.Dataset:
+    """
+    Decode the variables of a Dataset that was opened with `mask_and_scale=False`. This reads all of
+    their values, so lazily opened data should be sliced to the pixels that are needed first.
+    """
+    ds = ds.copy()
+
+    for name, da in list(ds.data_vars.items()):
+        if any(key in da.attrs for key in ENCODING_ATTRS):
+            ds[name] = da.copy(data=decode_values(da.values, da.attrs))
+            ds[name].attrs = {
+                key: value for key, value in da.attrs.items() if key not in ENCODING_ATTRS
+            }
+
+    return ds
+
+
+def bit_round(ds: xr.Dataset, keep_bits: int) -> xr.Dataset:
+    """
+    Round the float percentiles of a Dataset to `keep_bits` bits of mantissa, so that they compress better.
+
+    Parameters:
+        ds(xarray.core.dataset.Dataset): water balance data with dims (time, y, x)
+
+        keep_bits(int): the number of mantissa bits to keep, from 1 to 23 so that it also holds for float32
+
+    Returns:
+        ds(xarray.core.dataset.Dataset): the rounded data
+    """
+    if not 1 <= keep_bits <= 23:
+        raise ValueError('The number of mantissa bits to keep should be from 1 to 23.')
+
+    codec = numcodecs.BitRound(keepbits=keep_bits)
+
+    def round_percentiles(da: xr.DataArray) -> xr.DataArray:
+        if set(da.dims) != {'time', 'y', 'x'} or not np.issubdtype(da.dtype, np.floating):
+            return da
+        return xr.apply_ufunc(
+            # the codec returns the rounded bits as integers
+            lambda values: codec.encode(values).view(values.dtype).reshape(values.shape),
+            da,
+            dask='parallelized',
+            output_dtypes=[da.dtype],
+            keep_attrs=True,
+        )
+
+    return ds.map(round_percentiles, keep_attrs=True)
@@ -0,0 +1,176 @@
+"""
+Extract the historical and forecast timeseries of many regions, crops, and integration windows at once.
+
+This calculates the timeseries with the loaders and the zonal engine of the app, without the app,
+and writes them to a single Parquet file with the columns and types of the app's Parquet download.
+The regions of each crop and window are split into batches that run in parallel processes, and every
+batch is written to the file as soon as it is done, so the whole export is never held in memory.
+
+Pointing `--root` (or `DATA_ROOT`) at a local directory with the layout of the bucket reads every
+artifact from there, so it works offline:
+
+    python extract_series.py drought-series.parquet --root /data/bucket --countries Kenya Ethiopia
+    python extract_series.py drought-series.parquet --root /data/bucket --states All --crops none maize
+"""
+
+import argparse
+import multiprocessing
+import os
+import timeit
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import utils
+from views import table_chunks
+from zonal import CROPS
+
+# the number of regions that a process calculates at once, which read the data they share only once
+BATCH_SIZE = 64
+
+
+def select_regions(countries: None | list[str], states: None | list[str]) -> np.ndarray:
+    """
+    Find the positions of regions in the region index of the release.
+
+    Parameters:
+        countries(list): the names of the countries to keep, or None for every country
+
+        states(list): the names of the states to keep, where 'All' is a whole country, or None for every state
+
+    Returns:
+        selection(numpy.ndarray): the positions of the regions in the region index from `load_regions`
+    """
+    regions = utils.load_regions()
+    if regions is None:
+        raise ValueError('The region index has not been published for this release.')
+
+    keep = np.ones(regions.sizes['region'], dtype=bool)
+
+    if countries is not None:
+        keep &= np.isin(regions.region_country.values.astype(str), countries)
+    if states is not None:
+        keep &= np.isin(regions.region_state.values.astype(str), states)
+
+    return np.flatnonzero(keep)
+
+
+def extract_batch(selection: np.ndarray, crop: str, window: str) -> pd.DataFrame:
+    """
+    Calculate the timeseries of a batch of regions for one crop and window, like the pipeline sorts them.
+    """
+    return (
+        utils.calculate_series(selection, crop, window)
+        .sort_values(['country', 'states', 'crop', 'window', 'type', 'time'])
+        .reset_index(drop=True)
+    )
+
+
+def extract_series(
+    path: str,
+    countries: None | list[str],
+    states: None | list[str],
+    crops: list[str],
+    windows: list[str],
+    workers: int,
+) -> int:
+    """
+    Write the timeseries of every region, crop, and window of a selection to a Parquet file.
+
+    The app reads its settings when it is imported, so `DATA_ROOT` and `WB_LOAD_MODE` should be set
+    in the environment before this is called. The batches run in new processes that start with them.
+
+    Parameters:
+        path(str): the path of the Parquet file
+
+        countries(list): the names of the countries, or None for every country
+
+        states(list): the names of the states, where 'All' is a whole country, or None for every state
+
+        crops(list): the crops, where 'none' is the whole region
+
+        windows(list): the integration windows, '3' and/or '12'
+
+        workers(int): the number of processes
+
+    Returns:
+        rows(int): the number of rows written
+    """
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context) as executor:
+        selection = executor.submit(select_regions, countries, states).result()
+        if len(selection) == 0:
+            raise ValueError('No regions match the countries and states.')
+
+        batches = [
+            (selection[start : start + BATCH_SIZE], crop, window)
+            for window in windows
+            for crop in crops
+            for start in range(0, len(selection), BATCH_SIZE)
+        ]
+        print(f'Extracting {len(selection)} regions in {len(batches)} batches...')
+
+        # the batches are written in order while later batches are still running
+        tables = executor.map(extract_batch, *zip(*batches))
+
+        rows = 0
+
+        def counted(tables):
+            nonlocal rows
+            for number, df in enumerate(tables, start=1):
+                rows += len(df)
+                print(f'    {number}/{len(batches)} batches, {rows} rows')
+                yield df
+
+        with open(path, 'wb') as f:
+            for chunk in table_chunks(counted(tables), 'parquet'):
+                f.write(chunk)
+
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('path', help='the Parquet file to write')
+    parser.add_argument(
+        '--root',
+        default=os.getenv('DATA_ROOT'),
+        help='a local directory with the layout of the bucket (DATA_ROOT by default, '
+        'and the bucket of BUCKET_NAME if neither is set)',
+    )
+    parser.add_argument('--countries', nargs='+', help='the countries (every country by default)')
+    parser.add_argument(
+        '--states',
+        nargs='+',
+        help='the states, where All is a whole country (every state and country by default)',
+    )
+    parser.add_argument(
+        '--crops',
+        nargs='+',
+        choices=['none'] + CROPS,
+        default=['none'] + CROPS,
+        help='the crops, where none is the whole region (every crop by default)',
+    )
+    parser.add_argument('--windows', nargs='+', choices=['3', '12'], default=['3', '12'])
+    parser.add_argument(
+        '--workers', type=int, default=os.cpu_count(), help='the number of processes'
+    )
+    parser.add_argument(
+        '--load-mode',
+        choices=['eager', 'lazy', 'shared'],
+        default='lazy',
+        help='how each process loads the water balance data (lazy only reads the chunks of its regions)',
+    )
+    args = parser.parse_args()
+
+    # the processes of the batches start with these settings
+    if args.root:
+        os.environ['DATA_ROOT'] = args.root
+    os.environ['WB_LOAD_MODE'] = args.load_mode
+
+    start = timeit.default_timer()
+    rows = extract_series(
+        args.path, args.countries, args.states, args.crops, args.windows, args.workers
+    )
+    print(f'Wrote {rows} rows to {args.path} in {timeit.default_timer() - start:.1f} s')
@@ -0,0 +1,75 @@
+"""
+Serve the images of the forecast maps on /forecast-frames, next to the Shiny app.
+
+The images are not served per session, so the forecast maps that link to them can be shared by every
+session (see `views.forecast_map_payload`). Their URLs include the release and the selection:
+
+    forecast-frames/2026-07/3/0.png?country=Germany&state=All&crop=none
+"""
+
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+import metrics
+from utils import forecast_dates, known_region, month_ic, year_ic
+from views import FRAME_ROUTE, render_async, render_forecast_frame
+from zonal import CROPS
+
+
+def valid_selection(country: str, state: str, crop: str, window: str, month: int) -> bool:
+    """
+    Check that the selection of an image is one that the app can show, before anything is loaded for it,
+    since anyone can request any URL (and every new selection would fill the caches).
+    """
+    return (
+        crop in ['none'] + CROPS
+        and window in ('3', '12')
+        and 0 <= month < len(forecast_dates)
+        and known_region(country, state)
+    )
+
+
+@metrics.handler
+async def forecast_frame(request: Request) -> Response:
+    """
+    Serve the image of a forecast month of a forecast map, which the map only requests
+    when its slider shows that month.
+    """
+    params = request.query_params
+    try:
+        release, window, name = request.url.path.split('/')[-3:]
+        month = int(name.removesuffix('.png'))
+        selection = (params['country'], params['state'], params['crop'], window)
+
+        # the images of other releases are not available anymore
+        png = None
+        if release == f'{year_ic}-{month_ic}' and await render_async(
+            valid_selection, *selection, month
+        ):
+            png = await render_async(render_forecast_frame, *selection, month)
+    except (KeyError, ValueError, IndexError):
+        png = None
+
+    if png is None:
+        return Response(status_code=404)
+
+    # an image never changes at its URL within a release
+    return Response(png, media_type='image/png', headers={'Cache-Control': 'public, max-age=86400'})
+
+
+def with_forecast_frames(app: ASGIApp) -> ASGIApp:
+    """
+    Serve the images of the forecast maps, and pass every other request (and the lifespan events)
+    on to an ASGI app, like the Shiny app.
+    """
+
+    async def frames_app(scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'http' and scope['path'].startswith(f'/{FRAME_ROUTE}/'):
+            response = await forecast_frame(Request(scope))
+            await response(scope, receive, send)
+            return
+
+        await app(scope, receive, send)
+
+    return frames_app
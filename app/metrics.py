@@ -0,0 +1,295 @@
+"""
+Prometheus metrics of the app process, served on `/metrics` next to the Shiny app.
+
+    wb_handler_seconds{handler}          latency histogram (and call count) of reactive effects and renderers
+    wb_handler_errors_total{handler}     number of calls of a handler that raised an exception
+    wb_loader_seconds{loader}            latency histogram (and call count) of loading data or results
+    wb_loader_bytes_total{loader}        number of bytes of loaded data that is held in memory
+    wb_cache_hits_total{cache}           hits of the caches of loaded data, results, and Zarr chunks
+    wb_cache_misses_total{cache}         misses of those caches
+    wb_cache_entries{cache}              number of entries in those caches
+    wb_cache_bytes{cache}                number of bytes in the caches that are bounded by bytes
+    wb_active_sessions                   number of sessions that are connected
+    wb_sessions_total                    number of sessions since the app process started
+
+Loaders are instrumented inside their caches, so they are only timed when the data is actually loaded:
+
+    @functools.lru_cache(maxsize=1)
+    @metrics.loader
+    def load_countries():
+        ...
+
+    metrics.watch_cache('load_countries', load_countries.cache_info)
+
+With several worker processes (`shiny run --workers`), every process only knows its own metrics, so
+`PROMETHEUS_MULTIPROC_DIR` should be set to an empty directory that the workers share. Each process then
+writes its metrics to files in that directory, and `/metrics` adds up the metrics of every process,
+whichever process serves it. The directory should be emptied whenever the app is started again.
+"""
+
+import atexit
+import functools
+import inspect
+import os
+import threading
+import time
+import timeit
+from collections.abc import Callable
+
+import numpy as np
+import xarray as xr
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from starlette.responses import Response
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from results import result_nbytes
+
+# whether the metrics of several worker processes are added up, see above
+MULTIPROCESS = bool(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+
+# with several worker processes, how often each of them reports its caches, in seconds
+CACHE_METRICS_INTERVAL = float(os.getenv('CACHE_METRICS_INTERVAL', '5'))
+
+# from a few milliseconds for small reactive effects to minutes for loading the historical data
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+handler_seconds = Histogram(
+    'wb_handler_seconds',
+    'Time spent in a reactive effect or renderer.',
+    ['handler'],
+    buckets=LATENCY_BUCKETS,
+)
+handler_errors = Counter(
+    'wb_handler_errors_total', 'Calls of a reactive effect or renderer that raised.', ['handler']
+)
+loader_seconds = Histogram(
+    'wb_loader_seconds',
+    'Time spent loading data or calculating a cached result.',
+    ['loader'],
+    buckets=LATENCY_BUCKETS,
+)
+loader_bytes = Counter(
+    'wb_loader_bytes_total', 'Bytes of loaded data that are held in memory.', ['loader']
+)
+active_sessions = Gauge(
+    'wb_active_sessions', 'Sessions that are connected.', multiprocess_mode='livesum'
+)
+sessions = Counter('wb_sessions_total', 'Sessions since the app process started.')
+cache_hits = Counter('wb_cache_hits', 'Hits of a cache.', ['cache'])
+cache_misses = Counter('wb_cache_misses', 'Misses of a cache.', ['cache'])
+cache_entries = Gauge(
+    'wb_cache_entries', 'Entries in a cache.', ['cache'], multiprocess_mode='livesum'
+)
+cache_bytes = Gauge('wb_cache_bytes', 'Bytes in a cache.', ['cache'], multiprocess_mode='livesum')
+
+
+def loaded_nbytes(value, lazy: bool = False) -> int:
+    """
+    Return the number of bytes that loaded data holds in memory. Only the coordinates of lazily opened
+    Datasets are counted, since their data variables are only read when they are indexed (and asking for
+    their data would read it), and the memory-mapped variables that every worker process shares
+    (see `shared.py`) are not counted either.
+    """
+    if isinstance(value, xr.Dataset):
+        variables = value.coords.values() if lazy else value.variables.values()
+        return sum(
+            int(variable.nbytes)
+            for variable in variables
+            if isinstance(variable.data, np.ndarray) and not isinstance(variable.data, np.memmap)
+        )
+
+    return result_nbytes(value)
+
+
+def handler(function: Callable) -> Callable:
+    """
+    Record the latency and errors of a reactive effect or renderer, labeled with its name.
+    Generators (like the functions of download handlers) are timed until they are exhausted.
+    Coroutine functions stay coroutine functions, so that Shiny still runs them asynchronously.
+    """
+    name = function.__name__
+
+    if inspect.iscoroutinefunction(function):
+
+        @functools.wraps(function)
+        async def coroutine_wrapper(*args, **kwargs):
+            start = timeit.default_timer()
+            try:
+                return await function(*args, **kwargs)
+            except Exception:
+                handler_errors.labels(name).inc()
+                raise
+            finally:
+                handler_seconds.labels(name).observe(timeit.default_timer() - start)
+
+        return coroutine_wrapper
+
+    if inspect.isasyncgenfunction(function):
+
+        @functools.wraps(function)
+        async def async_generator_wrapper(*args, **kwargs):
+            start = timeit.default_timer()
+            try:
+                async for value in function(*args, **kwargs):
+                    yield value
+            except Exception:
+                handler_errors.labels(name).inc()
+                raise
+            finally:
+                handler_seconds.labels(name).observe(timeit.default_timer() - start)
+
+        return async_generator_wrapper
+
+    if inspect.isgeneratorfunction(function):
+
+        @functools.wraps(function)
+        def generator_wrapper(*args, **kwargs):
+            start = timeit.default_timer()
+            try:
+                yield from function(*args, **kwargs)
+            except Exception:
+                handler_errors.labels(name).inc()
+                raise
+            finally:
+                handler_seconds.labels(name).observe(timeit.default_timer() - start)
+
+        return generator_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = timeit.default_timer()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            handler_errors.labels(name).inc()
+            raise
+        finally:
+            handler_seconds.labels(name).observe(timeit.default_timer() - start)
+
+    return wrapper
+
+
+def loader(function: None | Callable = None, *, lazy: bool = False) -> Callable:
+    """
+    Record the latency of loading data or calculating a result, and the bytes of what was loaded.
+    Loaders that open Datasets lazily pass `lazy=True`, so that their data is not counted (see `loaded_nbytes`):
+
+        @metrics.loader(lazy=LOAD_MODE == 'lazy')
+        def load_forecast_wb(window):
+            ...
+    """
+    if function is None:
+        return functools.partial(loader, lazy=lazy)
+
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = timeit.default_timer()
+        result = function(*args, **kwargs)
+        loader_seconds.labels(name).observe(timeit.default_timer() - start)
+        loader_bytes.labels(name).inc(loaded_nbytes(result, lazy))
+
+        return result
+
+    return wrapper
+
+
+class CacheCollector:
+    """
+    Report the `cache_info()` of caches in the cache metrics. This works with `functools.lru_cache`,
+    `results.byte_lru_cache`, and `stores.ChunkCacheStore`.
+
+    The caches are reported when the metrics are scraped, and with several worker processes,
+    every process also reports its own caches every `CACHE_METRICS_INTERVAL` seconds.
+    """
+
+    def __init__(self) -> None:
+        self.caches = {}
+        # the hits and misses of each cache that have been reported
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def watch(self, name: str, cache_info: Callable) -> None:
+        with self._lock:
+            self.caches[name] = cache_info
+
+    def update(self) -> None:
+        with self._lock:
+            for name, cache_info in self.caches.items():
+                info = cache_info()
+                hits, misses = self.counts.get(name, (0, 0))
+
+                # the counts start from 0 again when a cache is cleared
+                cache_hits.labels(name).inc(info.hits - hits if info.hits >= hits else info.hits)
+                cache_misses.labels(name).inc(
+                    info.misses - misses if info.misses >= misses else info.misses
+                )
+                self.counts[name] = (info.hits, info.misses)
+
+                # functools.lru_cache counts its entries as currsize
+                cache_entries.labels(name).set(
+                    getattr(info, 'entries', getattr(info, 'currsize', 0))
+                )
+                if hasattr(info, 'nbytes'):
+                    cache_bytes.labels(name).set(info.nbytes)
+
+    def update_periodically(self) -> None:
+        while True:
+            time.sleep(CACHE_METRICS_INTERVAL)
+            self.update()
+
+
+caches = CacheCollector()
+
+if MULTIPROCESS:
+    threading.Thread(target=caches.update_periodically, name='cache-metrics', daemon=True).start()
+
+    # the sessions and caches of a process that has exited are not added up anymore
+    atexit.register(multiprocess.mark_process_dead, os.getpid())
+
+
+def watch_cache(name: str, cache_info: Callable) -> None:
+    """
+    Report the hits, misses, and size of a cache on `/metrics`, given its `cache_info` method.
+    """
+    caches.watch(name, cache_info)
+
+
+def collect_metrics() -> bytes:
+    """
+    Return the metrics in the text format of Prometheus, added up over every worker process if there are several.
+    """
+    if not MULTIPROCESS:
+        return generate_latest(REGISTRY)
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def with_metrics(app: ASGIApp) -> ASGIApp:
+    """
+    Serve the metrics on `/metrics`, and pass every other request (and the lifespan events)
+    on to an ASGI app, like the Shiny app.
+    """
+
+    async def metrics_app(scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'http' and scope['path'] == '/metrics':
+            caches.update()
+            response = Response(collect_metrics(), media_type=CONTENT_TYPE_LATEST)
+            await response(scope, receive, send)
+            return
+
+        await app(scope, receive, send)
+
+    return metrics_app
@@ -0,0 +1,161 @@
+"""
+Load the data that the app needs in the background as soon as the app process starts,
+so that it is usually ready before the first user makes a selection.
+
+With PREWARM_FORECAST_MAPS=1, the forecast map of every country is also created once the data has loaded,
+so that the first user to select a country does not wait for it either.
+"""
+
+import functools
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from utils import (
+    load_countries,
+    load_crop_extent_vector,
+    load_crop_production_raster,
+    load_forecast_wb,
+    load_historical_wb,
+    load_region_lookup,
+    load_states,
+    regional_series_available,
+)
+from views import forecast_map_payload
+from zonal import CROPS
+
+# the number of datasets that are loaded at the same time
+PREFETCH_WORKERS = int(os.getenv('PREFETCH_WORKERS', '8'))
+
+# whether the forecast maps of every country are created in the background
+PREWARM_FORECAST_MAPS = os.getenv('PREWARM_FORECAST_MAPS', '').lower() in ('1', 'true')
+
+# the datasets that need to be loaded before a user can make a selection
+REQUIRED_DATASETS = ['countries', 'states']
+
+executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='prefetch')
+datasets: dict[str, Future] = {}
+
+# the functions that load each dataset, so that datasets that failed to load can be loaded again
+loaders: dict[str, callable] = {}
+
+
+def start() -> dict[str, Future]:
+    """
+    Start loading every dataset in the background. Calling this more than once has no effect.
+    """
+    if len(datasets) > 0:
+        return datasets
+
+    tasks = {
+        'countries': load_countries,
+        'states': load_states,
+        'regions': load_region_lookup,
+        'forecast-3': functools.partial(load_forecast_wb, '3'),
+        'forecast-12': functools.partial(load_forecast_wb, '12'),
+    }
+
+    # the historical data is only needed if the regional timeseries table has not been published
+    tasks['historical-3'] = functools.partial(load_historical_if_needed, '3')
+    tasks['historical-12'] = functools.partial(load_historical_if_needed, '12')
+
+    # the crop extents and the production that the crop timeseries are weighted by
+    for crop in CROPS:
+        tasks[f'crop-{crop}'] = functools.partial(load_crop_extent_vector, crop)
+        tasks[f'production-{crop}'] = functools.partial(load_crop_production_raster, crop)
+
+    for name, task in tasks.items():
+        loaders[name] = task
+        datasets[name] = executor.submit(task)
+
+    # this is submitted last, since it waits for the other datasets
+    if PREWARM_FORECAST_MAPS:
+        datasets['forecast-maps'] = executor.submit(prewarm_forecast_maps)
+
+    return datasets
+
+
+def load_historical_if_needed(window: str) -> None:
+    """
+    Load the historical data unless the regional timeseries table has been published. Checking for the
+    table reads from the bucket, so it runs in the background too instead of when the app is imported.
+    """
+    if not regional_series_available():
+        load_historical_wb(window)
+
+
+def prewarm_forecast_maps() -> int:
+    """
+    Create the forecast map of every country for both integration windows, once the other datasets
+    have loaded, and return the number of forecast maps with data to show.
+    """
+    for name, future in list(datasets.items()):
+        if name != 'forecast-maps':
+            future.result()
+
+    count = 0
+    for country in load_countries().name.values:
+        for window in ['3', '12']:
+            # a country that fails here fails the same way when a user selects it,
+            # so it does not stop the other countries from being created
+            try:
+                count += forecast_map_payload(country, 'All', 'none', window) is not None
+            except Exception as error:
+                print(f'Could not create the forecast map of {country}: {error!r}')
+
+    return count
+
+
+def status() -> dict[str, str]:
+    """
+    Return whether each dataset is 'loading', 'ready', or 'failed'.
+    """
+    return {
+        name: (
+            'loading'
+            if not future.done()
+            else 'failed' if future.exception() is not None else 'ready'
+        )
+        for name, future in datasets.items()
+    }
+
+
+def ready(*names: str) -> bool:
+    """
+    Check whether datasets have finished loading. Datasets that are not prefetched are always ready.
+    """
+    return all(
+        datasets[name].done() and datasets[name].exception() is None
+        for name in names
+        if name in datasets
+    )
+
+
+def failed(*names: str) -> list[str]:
+    """
+    Return the datasets that could not be loaded, out of the given names.
+    """
+    return [
+        name
+        for name in names
+        if name in datasets and datasets[name].done() and datasets[name].exception() is not None
+    ]
+
+
+def retry(*names: str) -> None:
+    """
+    Start loading datasets that could not be loaded again. The loaders do not cache exceptions,
+    so this loads them from scratch.
+    """
+    for name in failed(*names):
+        print(f'Loading {name} again after: {datasets[name].exception()!r}')
+        datasets[name] = executor.submit(loaders[name])
+
+
+def get(name: str, loader: callable):
+    """
+    Wait for a prefetched dataset, or load it directly if it is not being prefetched.
+    """
+    if name in datasets:
+        return datasets[name].result()
+
+    return loader()
@@ -0,0 +1,122 @@
+"""
+A cache of results that is shared by every session of the app process.
+
+`byte_lru_cache` works like `functools.lru_cache`, but it is bounded by the number of bytes of the
+cached results instead of their number, since a clipped country can be a thousand times the size of
+a clipped state. Its `cache_info()` also counts how many results were evicted.
+
+    @byte_lru_cache(max_bytes=512 * 1024**2)
+    def reduce_selection(country, state, crop, window):
+        ...
+
+    reduce_selection.cache_info()
+"""
+
+import functools
+import threading
+from collections import OrderedDict, namedtuple
+from collections.abc import Callable
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+CacheInfo = namedtuple(
+    'CacheInfo', ['hits', 'misses', 'evictions', 'entries', 'nbytes', 'max_bytes']
+)
+
+
+def result_nbytes(value) -> int:
+    """
+    Estimate the number of bytes that a result holds in memory.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if isinstance(value, (xr.Dataset, xr.DataArray, np.ndarray)):
+        return int(value.nbytes)
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (tuple, list)):
+        return sum(result_nbytes(item) for item in value)
+    if isinstance(value, dict):
+        return sum(result_nbytes(item) for item in value.values())
+
+    return 0
+
+
+def byte_lru_cache(max_bytes: int, key: None | Callable = None) -> Callable:
+    """
+    Cache the results of a function, dropping the least recently used results once they are larger
+    than `max_bytes` in total. Results larger than `max_bytes` are not cached, nor are exceptions.
+
+    Parameters:
+        max_bytes(int): the number of bytes that the cached results can use
+
+        key(callable): returns the cache key from the arguments of the function,
+            by default the positional arguments
+
+    Returns:
+        decorator(callable): a decorator that adds `cache_info()` and `cache_clear()` to the function
+    """
+    if key is None:
+
+        def key(*args):
+            return args
+
+    def decorator(function: callable) -> callable:
+        cache = OrderedDict()
+        lock = threading.Lock()
+        counts = {'hits': 0, 'misses': 0, 'evictions': 0, 'nbytes': 0}
+
+        @functools.wraps(function)
+        def wrapper(*args):
+            cache_key = key(*args)
+
+            with lock:
+                if cache_key in cache:
+                    cache.move_to_end(cache_key)
+                    counts['hits'] += 1
+                    return cache[cache_key][0]
+                counts['misses'] += 1
+
+            result = function(*args)
+            size = result_nbytes(result)
+            if size > max_bytes:
+                return result
+
+            with lock:
+                if cache_key not in cache:
+                    cache[cache_key] = (result, size)
+                    counts['nbytes'] += size
+
+                while counts['nbytes'] > max_bytes:
+                    _, (_, evicted) = cache.popitem(last=False)
+                    counts['nbytes'] -= evicted
+                    counts['evictions'] += 1
+
+            return result
+
+        def cache_info() -> CacheInfo:
+            with lock:
+                return CacheInfo(
+                    counts['hits'],
+                    counts['misses'],
+                    counts['evictions'],
+                    len(cache),
+                    counts['nbytes'],
+                    max_bytes,
+                )
+
+        def cache_clear() -> None:
+            with lock:
+                cache.clear()
+                counts.update({'hits': 0, 'misses': 0, 'evictions': 0, 'nbytes': 0})
+
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+
+        return wrapper
+
+    return decorator
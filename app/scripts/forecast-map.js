@@ -0,0 +1,32 @@
+// the server only sends the figure of the forecast map, and the map that is already shown is updated
+// with it, so plotly.js and the base map are not loaded again for every selection
+document.addEventListener('DOMContentLoaded', function () {
+  let shown = false;
+
+  // the map can be drawn while its tab is hidden, so it is resized once the tab is shown
+  let resizeObserver = new ResizeObserver(function (entries) {
+    entries.forEach(entry => {
+      if (shown && entry.contentRect.width > 0) {
+        Plotly.Plots.resize(entry.target);
+      }
+    });
+  });
+
+  Shiny.addCustomMessageHandler('forecast_map', function (message) {
+    let container = document.querySelector('#forecast_map');
+    if (container === null) {
+      return;
+    }
+    resizeObserver.observe(container);
+
+    if (message.figure === null) {
+      Plotly.purge(container);
+      shown = false;
+      return;
+    }
+
+    let figure = JSON.parse(message.figure);
+    Plotly.react(container, figure.data, figure.layout, message.config);
+    shown = true;
+  });
+});
@@ -0,0 +1,72 @@
+// the server sends the whole timeseries of a selection once, and the chart is filtered to the dates
+// of the time slider here, so moving the time slider does not wait for the server
+document.addEventListener('DOMContentLoaded', function () {
+  let chart = null;
+  let figure = null;
+
+  // the chart can be drawn while its tab is hidden, so it is resized once the tab is shown
+  let resizeObserver = new ResizeObserver(function (entries) {
+    entries.forEach(entry => {
+      if (figure !== null && entry.contentRect.width > 0) {
+        Plotly.Plots.resize(entry.target);
+      }
+    });
+  });
+
+  function startDate() {
+    let slider = $('#time_slider').data('ionRangeSlider');
+
+    // the time slider is only shown with the historical data
+    if (!chart.historical || slider === undefined) {
+      return chart.start;
+    }
+
+    return chart.dates[slider.result.from];
+  }
+
+  function drawChart() {
+    let container = document.querySelector('#timeseries_chart');
+    if (container === null) {
+      return;
+    }
+    resizeObserver.observe(container);
+
+    if (figure === null) {
+      Plotly.purge(container);
+      return;
+    }
+
+    figure.layout.xaxis.range = [startDate(), chart.end];
+    Plotly.react(container, figure.data, figure.layout, {
+      displayModeBar: false,
+      responsive: true,
+    });
+  }
+
+  function windowChart() {
+    let container = document.querySelector('#timeseries_chart');
+    if (figure === null || container === null || !chart.historical) {
+      return;
+    }
+
+    Plotly.relayout(container, { 'xaxis.range': [startDate(), chart.end] });
+  }
+
+  Shiny.addCustomMessageHandler('timeseries_chart', function (message) {
+    chart = message;
+    figure = message.figure === null ? null : JSON.parse(message.figure);
+    drawChart();
+  });
+
+  $(document).on('change', '#time_slider', windowChart);
+
+  // the skip buttons move the time slider here, which filters the chart
+  $(document).on('click', '.skip-button[data-slider-index]', function (event) {
+    event.preventDefault();
+
+    let slider = $('#time_slider').data('ionRangeSlider');
+    if (slider !== undefined) {
+      slider.update({ from: Number(this.dataset.sliderIndex) });
+    }
+  });
+});
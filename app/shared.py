@@ -0,0 +1,177 @@
+"""
+Share the water balance data between the worker processes of the app through memory-mapped files.
+
+With `WB_LOAD_MODE=shared`, the first process to load a Zarr store writes its arrays once into
+`WB_SHARED_DIR` (in `/dev/shm` by default, which is shared memory), and every process maps those
+files read-only instead of loading its own copy. The operating system keeps a single copy of the data
+in memory however many workers there are, so `shiny run --workers` can use every core of an instance
+without multiplying the memory used by the data.
+Containers need a `/dev/shm` that fits the data (Docker's is 64 MB unless `shm_size` is set).
+
+Like the disk cache (see `artifacts.py`), the files are keyed by the release date and the version of
+the store, and they are written into a temporary directory that is renamed once it is complete, so that
+no process ever maps a partially written store. A lock file makes the other processes wait for the
+store instead of loading it too. Once a store is written for a new release, the stores of other
+releases (and older versions of the same store) are removed. Processes that still use them keep their
+mappings until they exit, since removing a mapped file only frees its memory once it is unmapped.
+
+    from shared import shared_dataset
+
+    ds = shared_dataset('zarr/analysis/wb-f3-2026-07-01.zarr', release='2026-07-01')
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+import fsspec
+import numpy as np
+import xarray as xr
+
+from artifacts import artifact_version
+
+# the directory that the shared stores are written to, which should be on a filesystem in memory
+WB_SHARED_DIR = os.getenv(
+    'WB_SHARED_DIR',
+    (
+        '/dev/shm/water-balance'
+        if os.path.isdir('/dev/shm')
+        else os.path.join(tempfile.gettempdir(), 'water-balance')
+    ),
+)
+
+# the number of time steps that are copied from the Zarr store at once while a store is written
+COPY_BLOCK_SIZE = 12
+
+MANIFEST = 'shared.json'
+DATASET = 'dataset.pkl'
+
+
+def write_shared_dataset(ds: xr.Dataset, path: str) -> None:
+    """
+    Write the arrays of a lazily opened Dataset to `.npy` files in a directory, block by block along
+    their first dimension, so that the whole Dataset is never held in memory. The rest of the Dataset
+    (coordinates, attributes, and encoding) is pickled next to them.
+    """
+    arrays = [name for name, da in ds.data_vars.items() if da.ndim >= 2]
+
+    for name in arrays:
+        da = ds[name]
+        array = np.lib.format.open_memmap(
+            os.path.join(path, f'{name}.npy'), mode='w+', dtype=da.dtype, shape=da.shape
+        )
+        for start in range(0, da.shape[0], COPY_BLOCK_SIZE):
+            stop = min(start + COPY_BLOCK_SIZE, da.shape[0])
+            array[start:stop] = da[start:stop].values
+        array.flush()
+        del array
+
+    variables = {
+        name: {'dims': ds[name].dims, 'attrs': ds[name].attrs, 'encoding': ds[name].encoding}
+        for name in arrays
+    }
+    with open(os.path.join(path, DATASET), 'wb') as f:
+        pickle.dump({'dataset': ds.drop_vars(arrays).compute(), 'variables': variables}, f)
+
+
+def open_shared_dataset(path: str) -> xr.Dataset:
+    """
+    Map the arrays of a shared store read-only, without copying them into the memory of the process.
+    """
+    with open(os.path.join(path, DATASET), 'rb') as f:
+        stored = pickle.load(f)
+
+    return stored['dataset'].assign(
+        {
+            name: xr.Variable(
+                variable['dims'],
+                np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'),
+                variable['attrs'],
+                variable['encoding'],
+            )
+            for name, variable in stored['variables'].items()
+        }
+    )
+
+
+def remove_stale(release: str, name: str, key: str) -> None:
+    """
+    Remove the shared stores of other releases, and the older versions of a store in this release.
+    """
+    for other_release in os.listdir(WB_SHARED_DIR):
+        release_dir = os.path.join(WB_SHARED_DIR, other_release)
+        if other_release.startswith('.') or not os.path.isdir(release_dir):
+            continue
+
+        if other_release != release:
+            shutil.rmtree(release_dir, ignore_errors=True)
+            continue
+
+        for other_key in os.listdir(release_dir):
+            manifest = os.path.join(release_dir, other_key, MANIFEST)
+            if other_key == key or not os.path.exists(manifest):
+                continue
+            with open(manifest) as f:
+                if json.load(f)['name'] == name:
+                    shutil.rmtree(os.path.join(release_dir, other_key), ignore_errors=True)
+
+
+def shared_dataset(path: str, release: str = 'static') -> xr.Dataset:
+    """
+    Open a Zarr store from the copy that is shared by every process, writing it first if no process has.
+
+    Parameters:
+        path(str): where the Zarr store can be read from, like the result of `artifacts.cached_path`
+
+        release(str): the release date of the store
+
+    Returns:
+        ds(xarray.core.dataset.Dataset): the store with its arrays mapped read-only,
+            opened like `utils.open_wb` opens it (without CF decoding of the percentiles)
+    """
+    fs, url = fsspec.core.url_to_fs(path)
+    name = os.path.basename(path.rstrip('/'))
+    key = hashlib.sha256(f'{path}@{artifact_version(fs, url)}'.encode()).hexdigest()[:32]
+
+    release_dir = os.path.join(WB_SHARED_DIR, release)
+    entry = os.path.join(release_dir, key)
+    os.makedirs(release_dir, exist_ok=True)
+
+    if os.path.exists(os.path.join(entry, MANIFEST)):
+        return open_shared_dataset(entry)
+
+    # only one process writes a store, while the others wait for it
+    with open(os.path.join(release_dir, f'.{key}.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if not os.path.exists(os.path.join(entry, MANIFEST)):
+            staging_dir = os.path.join(WB_SHARED_DIR, '.staging')
+            os.makedirs(staging_dir, exist_ok=True)
+            staging = tempfile.mkdtemp(dir=staging_dir)
+
+            try:
+                ds = xr.open_dataset(
+                    path,
+                    engine='zarr',
+                    consolidated=True,
+                    decode_coords='all',
+                    mask_and_scale=False,
+                )
+                write_shared_dataset(ds, staging)
+
+                with open(os.path.join(staging, MANIFEST), 'w') as f:
+                    json.dump({'name': name, 'path': path, 'created': time.time()}, f)
+
+                os.rename(staging, entry)
+            except BaseException:
+                shutil.rmtree(staging, ignore_errors=True)
+                raise
+
+            remove_stale(release, name, key)
+
+    return open_shared_dataset(entry)
@@ -0,0 +1,111 @@
+"""
+Zarr stores used when the water balance data is opened lazily instead of loaded into memory.
+"""
+
+import math
+import threading
+from collections import OrderedDict
+
+import xarray as xr
+from zarr.abc.store import ByteRequest
+from zarr.core.buffer import Buffer, BufferPrototype
+from zarr.storage import FsspecStore, WrapperStore
+
+from results import CacheInfo
+
+
+class ChunkCacheStore(WrapperStore):
+    """
+    Keep the most recently read Zarr objects in memory, up to a total number of bytes.
+
+    Reads are cached by object and byte range, since Zarr reads whole objects for the chunks of Zarr v2
+    and unsharded v3 arrays, but byte ranges of shard objects for the chunks of sharded v3 arrays.
+    The least recently used reads are dropped first once the cache is over its byte budget.
+    Like `results.byte_lru_cache`, `cache_info()` counts its hits, misses, and evictions.
+    """
+
+    def __init__(self, store: FsspecStore, max_bytes: int) -> None:
+        super().__init__(store)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _with_store(self, store: FsspecStore) -> 'ChunkCacheStore':
+        return type(self)(store, self.max_bytes)
+
+    async def get(
+        self, key: str, prototype: BufferPrototype, byte_range: ByteRequest | None = None
+    ) -> Buffer | None:
+        # byte ranges are frozen dataclasses, so they can be part of the cache key
+        cache_key = (key, byte_range)
+
+        with self._lock:
+            if cache_key in self._cache:
+                self._cache.move_to_end(cache_key)
+                self.hits += 1
+                return self._cache[cache_key]
+            self.misses += 1
+
+        value = await self._store.get(key, prototype, byte_range)
+        if value is None or len(value) > self.max_bytes:
+            return value
+
+        with self._lock:
+            if cache_key not in self._cache:
+                self._cache[cache_key] = value
+                self.nbytes += len(value)
+
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self.nbytes -= len(evicted)
+                self.evictions += 1
+
+        return value
+
+    def cache_info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(
+                self.hits,
+                self.misses,
+                self.evictions,
+                len(self._cache),
+                self.nbytes,
+                self.max_bytes,
+            )
+
+
+def open_store(path: str, cache_bytes: int = 0) -> str | ChunkCacheStore:
+    """
+    Return something that `xr.open_dataset(..., engine='zarr')` can open,
+    with an in-memory chunk cache if `cache_bytes` is larger than zero.
+    """
+    if cache_bytes <= 0:
+        return path
+
+    return ChunkCacheStore(FsspecStore.from_url(path, read_only=True), cache_bytes)
+
+
+def chunk_reads(da: xr.DataArray, window: dict) -> int:
+    """
+    Count the chunks of a lazily opened DataArray that reading a window of it touches.
+
+    Parameters:
+        da(xarray.DataArray): data opened from a Zarr store
+
+        window(dict): a slice (with a start and a stop) for some of the dims, where the other dims are read whole
+
+    Returns:
+        count(int): the number of chunks that the window intersects
+    """
+    chunks = dict(zip(da.dims, da.encoding.get('chunks', da.shape)))
+
+    count = 1
+    for dim, size in da.sizes.items():
+        start, stop = (0, size) if dim not in window else (window[dim].start, window[dim].stop)
+        count *= math.ceil(stop / chunks[dim]) - start // chunks[dim]
+
+    return count
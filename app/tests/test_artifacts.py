@@ -0,0 +1,139 @@
+"""
+Tests of the disk cache of artifacts in `artifacts.py`, against a temporary directory that stands in
+for the bucket through `DATA_ROOT`.
+
+    python -m pytest app/tests
+"""
+
+import os
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+import pytest
+
+APP_DIR = Path(__file__).resolve().parents[1]
+sys.path.append(str(APP_DIR))
+import artifacts  # isort: skip  # noqa: E402
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    """
+    A local bucket with a file and a Zarr store, and an empty disk cache.
+    """
+    root = tmp_path / 'bucket'
+    (root / 'vector').mkdir(parents=True)
+    (root / 'vector' / 'countries.parquet').write_bytes(b'countries' * 100)
+    (root / 'vector' / 'states.parquet').write_bytes(b'states' * 100)
+    (root / 'zarr' / 'store.zarr' / 'perc').mkdir(parents=True)
+    (root / 'zarr' / 'store.zarr' / '.zmetadata').write_text('{}')
+    (root / 'zarr' / 'store.zarr' / 'perc' / '0.0.0').write_bytes(b'chunk' * 100)
+
+    monkeypatch.setattr(artifacts, 'DATA_ROOT', str(root))
+    monkeypatch.setattr(artifacts, 'DISK_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(artifacts, 'DISK_CACHE_BYTES', 10**9)
+    monkeypatch.setattr(artifacts, '_in_use', {})
+    os.makedirs(artifacts.DISK_CACHE_DIR)
+
+    yield root
+
+    for lock in artifacts._in_use.values():
+        lock.close()
+
+
+def release(path: str) -> None:
+    """
+    Stop using the cache entry of a cached path, like a process that exits.
+    """
+    artifacts._in_use.pop(os.path.dirname(path)).close()
+
+
+def test_data_root_without_cache(bucket, monkeypatch):
+    monkeypatch.setattr(artifacts, 'DISK_CACHE_DIR', None)
+
+    assert artifacts.cached_path('vector/countries.parquet') == str(
+        bucket / 'vector' / 'countries.parquet'
+    )
+
+
+def test_cached_copy_is_reused_until_republished(bucket):
+    path = artifacts.cached_path('vector/countries.parquet', release='2026-07-01')
+
+    assert path.startswith(artifacts.DISK_CACHE_DIR)
+    assert Path(path).read_bytes() == b'countries' * 100
+    assert artifacts.cached_path('vector/countries.parquet', release='2026-07-01') == path
+
+    # a re-published object has a new version, so it is downloaded again
+    (bucket / 'vector' / 'countries.parquet').write_bytes(b'new countries')
+    new_path = artifacts.cached_path('vector/countries.parquet', release='2026-07-01')
+
+    assert new_path != path
+    assert Path(new_path).read_bytes() == b'new countries'
+
+
+def test_zarr_store_is_cached_as_a_directory(bucket):
+    path = artifacts.cached_path('zarr/store.zarr', release='2026-07-01')
+
+    assert Path(path, 'perc', '0.0.0').read_bytes() == b'chunk' * 100
+    assert Path(path, '.zmetadata').exists()
+
+
+def test_evict_drops_least_recently_used(bucket, monkeypatch):
+    countries = artifacts.cached_path('vector/countries.parquet')
+    release(countries)
+
+    # only one of the artifacts fits in the cache
+    monkeypatch.setattr(artifacts, 'DISK_CACHE_BYTES', 1000)
+    states = artifacts.cached_path('vector/states.parquet')
+
+    assert not os.path.exists(countries)
+    assert os.path.exists(states)
+
+
+def test_evict_keeps_entries_used_by_this_process(bucket, monkeypatch):
+    countries = artifacts.cached_path('vector/countries.parquet')
+
+    monkeypatch.setattr(artifacts, 'DISK_CACHE_BYTES', 1000)
+    artifacts.cached_path('vector/states.parquet')
+
+    assert os.path.exists(countries)
+
+
+def test_evict_keeps_entries_used_by_other_processes(bucket, monkeypatch):
+    # another process sharing the cache uses an artifact until it is told to exit
+    script = textwrap.dedent(
+        """
+        import sys
+        import artifacts
+
+        print(artifacts.cached_path('vector/countries.parquet'), flush=True)
+        sys.stdin.readline()
+        """
+    )
+    env = {
+        **os.environ,
+        'PYTHONPATH': str(APP_DIR),
+        'DATA_ROOT': str(bucket),
+        'DISK_CACHE_DIR': artifacts.DISK_CACHE_DIR,
+    }
+    other = subprocess.Popen(
+        [sys.executable, '-c', script],
+        env=env,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        countries = other.stdout.readline().strip()
+
+        monkeypatch.setattr(artifacts, 'DISK_CACHE_BYTES', 1000)
+        artifacts.cached_path('vector/states.parquet')
+        assert os.path.exists(countries)
+    finally:
+        other.communicate('\n', timeout=30)
+
+    # once the other process has exited, the artifact can be evicted
+    artifacts.evict()
+    assert not os.path.exists(countries)
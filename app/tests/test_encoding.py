@@ -0,0 +1,91 @@
+"""
+Tests of how the percentiles are stored in `encoding.py`: data written to a Zarr store with
+`percentile_encoding` and read back with `decode_values` is within the error bound of its dtype.
+
+    python -m pytest app/tests
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+APP_DIR = Path(__file__).resolve().parents[1]
+sys.path.append(str(APP_DIR))
+from encoding import (  # isort: skip  # noqa: E402
+    UINT16_SCALE_FACTOR,
+    bit_round,
+    decode_dataset,
+    decode_values,
+    percentile_encoding,
+)
+
+# the largest absolute error of each dtype versus float64 for values in [0, 1]
+ERROR_BOUNDS = {'uint16': UINT16_SCALE_FACTOR / 2, 'float32': 2**-25, 'float64': 0.0}
+
+
+@pytest.fixture
+def wb():
+    """
+    Percentiles in [0, 1] with both bounds and some missing values.
+    """
+    rng = np.random.default_rng(0)
+    perc = rng.uniform(0, 1, (4, 20, 30))
+    perc[0, 0, :3] = [0.0, 1.0, 0.5]
+    perc[rng.uniform(size=perc.shape) < 0.05] = np.nan
+
+    return xr.Dataset(
+        {'perc': (('time', 'y', 'x'), perc)},
+        coords={
+            'time': pd.date_range('2026-01-01', periods=4, freq='MS'),
+            'y': np.arange(20.0),
+            'x': np.arange(30.0),
+        },
+    )
+
+
+def round_trip(wb, path, dtype: str) -> xr.Dataset:
+    """
+    Write percentiles to a Zarr store and open it like the app does, without CF decoding.
+    """
+    wb.to_zarr(path, encoding=percentile_encoding(wb, dtype), zarr_format=2, mode='w')
+    return xr.open_dataset(path, engine='zarr', mask_and_scale=False).load()
+
+
+@pytest.mark.parametrize('dtype', ['uint16', 'float32', 'float64'])
+def test_decoded_values_are_within_the_error_bound(wb, tmp_path, dtype):
+    stored = round_trip(wb, tmp_path / 'wb.zarr', dtype)
+    assert stored.perc.dtype == dtype
+
+    decoded = decode_values(stored.perc.values, stored.perc.attrs, 'float64')
+
+    np.testing.assert_array_equal(np.isnan(decoded), np.isnan(wb.perc.values))
+    assert np.nanmax(np.abs(decoded - wb.perc.values)) <= ERROR_BOUNDS[dtype]
+
+
+def test_decode_dataset_drops_the_encoding(wb, tmp_path):
+    stored = round_trip(wb, tmp_path / 'wb.zarr', 'uint16')
+    decoded = decode_dataset(stored)
+
+    # integers are decoded as float32, which adds its own rounding to that of the integers
+    assert decoded.perc.dtype == 'float32'
+    assert 'scale_factor' not in decoded.perc.attrs
+    np.testing.assert_allclose(
+        decoded.perc.values,
+        wb.perc.values,
+        atol=ERROR_BOUNDS['uint16'] + ERROR_BOUNDS['float32'],
+        rtol=0,
+    )
+
+
+@pytest.mark.parametrize('keep_bits', [7, 14])
+def test_bit_rounded_values_are_within_the_error_bound(wb, tmp_path, keep_bits):
+    stored = round_trip(bit_round(wb, keep_bits), tmp_path / 'wb.zarr', 'float64')
+    decoded = decode_values(stored.perc.values, stored.perc.attrs)
+
+    valid = ~np.isnan(wb.perc.values)
+    error = np.abs(decoded[valid] - wb.perc.values[valid])
+    assert (error <= np.abs(wb.perc.values[valid]) * 2 ** -(keep_bits + 1)).all()
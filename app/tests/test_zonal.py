@@ -0,0 +1,210 @@
+"""
+Tests of the zonal engine in `zonal.py`, against the clip and mean that the app calculated the
+regional timeseries with before, on a small synthetic global grid.
+
+    python -m pytest app/tests
+"""
+
+import sys
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import rioxarray  # noqa: F401
+import xarray as xr
+from shapely.geometry import MultiPolygon, box
+
+APP_DIR = Path(__file__).resolve().parents[1]
+sys.path.append(str(APP_DIR))
+from zonal import (  # isort: skip  # noqa: E402
+    crop_weights,
+    rasterize_regions,
+    region_weights,
+    regional_series,
+)
+
+
+@pytest.fixture
+def wb():
+    """
+    Water balance data on a global 2 degree grid, with pixels that never have data
+    and pixels that are missing in some months.
+    """
+    rng = np.random.default_rng(0)
+    x = np.arange(-179, 180, 2.0)
+    y = np.arange(89, -90, -2.0)
+
+    perc = rng.uniform(0, 1, (6, len(y), len(x)))
+    perc[:, rng.uniform(size=(len(y), len(x))) < 0.1] = np.nan
+    perc[rng.uniform(size=perc.shape) < 0.02] = np.nan
+
+    ds = xr.Dataset(
+        {'perc': (('time', 'y', 'x'), perc)},
+        coords={'time': pd.date_range('2026-01-01', periods=6, freq='MS'), 'y': y, 'x': x},
+    )
+    return ds.rio.write_crs(4326)
+
+
+@pytest.fixture
+def countries():
+    """
+    A country inside the grid, and a country that crosses the antimeridian, with edges between pixels.
+    """
+    return gpd.GeoDataFrame(
+        {
+            'name': ['Inland', 'Dateline'],
+            'geometry': [
+                box(10.3, 5.7, 31.1, 21.4),
+                MultiPolygon([box(165.5, -20.2, 180, -5.3), box(-180, -20.2, -171.7, -5.3)]),
+            ],
+        },
+        crs=4326,
+    )
+
+
+@pytest.fixture
+def states():
+    return gpd.GeoDataFrame(
+        {'name': ['North'], 'country': ['Inland'], 'geometry': [box(10.3, 13.1, 31.1, 21.4)]},
+        crs=4326,
+    )
+
+
+@pytest.fixture
+def extent():
+    """
+    The extent of a crop, which covers part of both countries.
+    """
+    return gpd.GeoDataFrame(
+        {'geometry': [box(14.2, 3.0, 40.0, 17.5), box(170.1, -30.0, 190.0, -10.0)]}, crs=4326
+    )
+
+
+def production(wb, fraction: float = 0.6, seed: int = 1) -> xr.DataArray:
+    """
+    Crop production on the grid of the water balance data, where a crop is only grown in some pixels.
+    """
+    rng = np.random.default_rng(seed)
+    shape = (wb.sizes['y'], wb.sizes['x'])
+    values = rng.uniform(1, 100, shape) * (rng.uniform(size=shape) < fraction)
+
+    return xr.DataArray(
+        values, dims=('y', 'x'), coords={'y': wb.y, 'x': wb.x}, name='production'
+    ).rio.write_crs(4326)
+
+
+def engine_series(wb, countries, states, weights) -> xr.DataArray:
+    """
+    Calculate the timeseries of the percentiles with the zonal engine.
+    """
+    regions = rasterize_regions(wb, countries, states)
+    matrix, index = weights(regions)
+    return regional_series(wb, matrix, index, ['perc']).perc
+
+
+def region_geometry(countries, states, country: str, state: str) -> gpd.GeoSeries:
+    if state == 'All':
+        return countries.query(" name == @country ").geometry
+    return states.query(" name == @state and country == @country ").geometry
+
+
+def baseline_crop_series(wb, production, geometry, extent) -> np.ndarray:
+    """
+    The production-weighted timeseries of a region, calculated like `update_dataframe` did
+    before the regional timeseries table: the clipped data is multiplied by the production of the
+    region divided by its total production, scaled by the number of pixels with data, and averaged.
+    """
+    clipped = wb.rio.clip(geometry, all_touched=True, drop=True)
+    clipped = clipped.rio.clip(extent.geometry, all_touched=True, drop=True)
+    clipped_production = production.to_dataset().rio.clip(geometry, all_touched=True, drop=True)
+    standardized_production = clipped_production / clipped_production.sum(skipna=True)
+
+    weighted = xr.merge([clipped, standardized_production], join='outer', compat='no_conflicts')
+    weighted = weighted.perc * weighted.production
+    nrows = int(weighted.isel(time=0).notnull().sum())
+
+    return (weighted * nrows).mean(dim=['x', 'y']).values
+
+
+def test_crop_series_match_the_baseline_where_every_producing_pixel_has_data(
+    wb, countries, states, extent
+):
+    # the crop is only produced in the crop extent, in pixels that have data in every month
+    wb = wb.where(wb.perc.notnull().all('time'))
+    in_extent = wb.perc.isel(time=0).rio.clip(extent.geometry, all_touched=True, drop=False)
+    weights = production(wb).where(in_extent.notnull(), 0.0)
+    geometry = countries.geometry.iloc[[0]]
+
+    series = engine_series(
+        wb, countries, states, lambda regions: crop_weights(regions, weights, 'maize', extent)
+    )
+
+    np.testing.assert_allclose(
+        series.sel(country='Inland', state='All', crop='maize').values,
+        baseline_crop_series(wb, weights, geometry, extent),
+    )
+
+
+def test_crop_series_are_weighted_by_the_production_of_pixels_with_data(
+    wb, countries, states, extent
+):
+    # the baseline divided by the production of the whole region, even where there is no data
+    # or the crop extent does not reach, which biased the timeseries towards 0. The timeseries are
+    # now weighted means over the pixels with data, so they differ from the baseline by the
+    # fraction of the production of the region in those pixels
+    weights = production(wb)
+    geometry = countries.geometry.iloc[[0]]
+
+    series = engine_series(
+        wb, countries, states, lambda regions: crop_weights(regions, weights, 'maize', extent)
+    )
+
+    region_production = float(weights.rio.clip(geometry, all_touched=True).sum())
+    in_extent = wb.rio.clip(geometry, all_touched=True).rio.clip(extent.geometry, all_touched=True)
+    has_data = in_extent.perc.notnull()
+    valid_production = (weights * has_data).sum(['x', 'y']).values
+
+    # the baseline also scaled the mean by the number of pixels with data in the first month
+    pixels = has_data.sum(['x', 'y']).values
+    baseline = baseline_crop_series(wb, weights, geometry, extent) * pixels / pixels[0]
+
+    assert (valid_production < region_production).all()
+    np.testing.assert_allclose(
+        series.sel(country='Inland', state='All', crop='maize').values,
+        baseline * region_production / valid_production,
+    )
+
+
+@pytest.mark.parametrize(
+    'country, state', [('Inland', 'All'), ('Inland', 'North'), ('Dateline', 'All')]
+)
+def test_region_series_match_clip_and_mean(wb, countries, states, country, state):
+    geometry = region_geometry(countries, states, country, state)
+
+    series = engine_series(wb, countries, states, region_weights)
+    expected = wb.rio.clip(geometry, all_touched=True, drop=True).perc.mean(dim=['x', 'y'])
+
+    np.testing.assert_allclose(
+        series.sel(country=country, state=state, crop='none').values, expected.values
+    )
+
+
+@pytest.mark.parametrize('country', ['Inland', 'Dateline'])
+def test_crop_series_match_production_weighted_clip(wb, countries, states, extent, country):
+    weights = production(wb)
+    geometry = region_geometry(countries, states, country, 'All')
+
+    series = engine_series(
+        wb, countries, states, lambda regions: crop_weights(regions, weights, 'maize', extent)
+    )
+    clipped = wb.rio.clip(geometry, all_touched=True, drop=False)
+    clipped = clipped.rio.clip(extent.geometry, all_touched=True, drop=False).perc
+    expected = (clipped * weights).sum(dim=['x', 'y']) / weights.where(clipped.notnull()).sum(
+        dim=['x', 'y']
+    )
+
+    np.testing.assert_allclose(
+        series.sel(country=country, state='All', crop='maize').values, expected.values
+    )
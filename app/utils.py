@@ -4,10 +4,27 @@ from datetime import datetime
 
 import gcsfs
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import rioxarray
 import shapely
 import xarray as xr
 
+import metrics
+from artifacts import cached_path, exists
+from encoding import decode_dataset
+from results import byte_lru_cache
+from shared import shared_dataset
+from stores import ChunkCacheStore, chunk_reads, open_store
+from zonal import (
+    SERIES_COLUMNS,
+    crop_weights,
+    rasterize_regions,
+    region_weights,
+    regional_series,
+    series_to_dataframe,
+)
+
 # calculate the initial conditions from today's day, month, and year
 # in general, the month (and potentially year) roll back one month
 # however, right before the update occurs, there are times when the month looks back two months
@@ -48,7 +65,19 @@ forecast_dates = [
     for date in pd.date_range(start=f'{year_ic}-{month_ic}-01', freq='MS', periods=7)
 ][1:]
 
-BUCKET = os.getenv('BUCKET_NAME')
+# 'eager' loads the global water balance data into memory when it is first used,
+# 'lazy' keeps the Zarr stores open and only reads the chunks that a selection needs,
+# and 'shared' loads it into memory once for every worker process of the app (see `shared.py`)
+LOAD_MODE = os.getenv('WB_LOAD_MODE', 'eager')
+
+# in lazy mode, the number of bytes of recently read Zarr chunks to keep in memory (0 turns the cache off)
+CHUNK_CACHE_BYTES = int(os.getenv('WB_CHUNK_CACHE_BYTES', '0'))
+
+# the number of bytes of clipped forecasts and regional timeseries that are shared by every session
+RESULT_CACHE_BYTES = int(os.getenv('RESULT_CACHE_BYTES', str(512 * 1024**2)))
+
+if LOAD_MODE not in ['eager', 'lazy', 'shared']:
+    raise ValueError("WB_LOAD_MODE should be either 'eager', 'lazy', or 'shared'.")
 
 
 def create_bbox_from_coords(
@@ -68,60 +97,580 @@ def create_bbox_from_coords(
     return bbox
 
 
-# open historical and forecast data for both integration windows
-@functools.lru_cache(maxsize=2)
-def load_historical_wb(window: str) -> xr.Dataset:
+def open_wb(path: str, release: str = 'static') -> xr.Dataset:
+    """
+    Open a water balance Zarr store, either loaded into memory, lazily, or mapped from the copy that is
+    shared by every worker process, depending on `WB_LOAD_MODE`.
+
+    Lazily opened data is only read when it is indexed, so clipping a region to its window of the grid
+    (see `clip_to_region`) only reads the chunks that intersect that window.
+
+    Both the Zarr v2 and the sharded Zarr v3 stores that the pipeline can write are opened the same way,
+    since Zarr reads the format and the codecs from the metadata of the store.
+
+    The percentiles are not decoded when they are opened, so data that the pipeline stored compactly
+    (see `encoding.py`) also stays compact in memory. `clip_to_region` and the zonal engine decode
+    only the pixels they use.
+    """
+    if LOAD_MODE == 'shared':
+        return shared_dataset(path, release)
+
+    if LOAD_MODE == 'lazy':
+        store = open_store(path, CHUNK_CACHE_BYTES)
+        if isinstance(store, ChunkCacheStore):
+            metrics.watch_cache(f'chunks {os.path.basename(path.rstrip("/"))}', store.cache_info)
+
+        return xr.open_dataset(
+            store,
+            engine='zarr',
+            consolidated=True,
+            decode_coords='all',
+            mask_and_scale=False,
+            cache=False,
+        )
+
     return xr.open_dataset(
-        f'gs://{BUCKET}/zarr/analysis/wb-h{window}-{year_ic}-{month_ic}-01.zarr',
+        path,
         engine='zarr',
         consolidated=True,
         decode_coords='all',
+        mask_and_scale=False,
     ).compute()
 
 
+# open historical and forecast data for both integration windows
+@functools.lru_cache(maxsize=2)
+@metrics.loader(lazy=LOAD_MODE == 'lazy')
+def load_historical_wb(window: str) -> xr.Dataset:
+    return open_wb(
+        cached_path(
+            f'zarr/analysis/wb-h{window}-{year_ic}-{month_ic}-01.zarr',
+            release=f'{year_ic}-{month_ic}-01',
+        ),
+        release=f'{year_ic}-{month_ic}-01',
+    )
+
+
+@functools.lru_cache(maxsize=2)
+@metrics.loader(lazy=LOAD_MODE == 'lazy')
+def load_historical_series_wb(window: str) -> None | xr.Dataset:
+    """
+    Open the historical data in the series layout, where each chunk is a small tile of the grid with
+    every time step. Returns None if it has not been published for this release, or if the data is
+    loaded into memory, where the layout does not matter.
+    """
+    path = f'zarr/analysis/wb-series-h{window}-{year_ic}-{month_ic}-01.zarr'
+    if LOAD_MODE != 'lazy' or not exists(path):
+        return None
+
+    return open_wb(cached_path(path, release=f'{year_ic}-{month_ic}-01'))
+
+
+def load_historical_for_pixels(window: str, pixels: np.ndarray) -> xr.Dataset:
+    """
+    Return the historical data in the layout that reads the fewest chunks for the timeseries of some pixels.
+
+    The analysis store has a chunk for every month, so the timeseries of a small region reads hundreds
+    of chunks, while the series layout only reads the few tiles that cover it. Regions that cover most
+    of the grid read fewer chunks from the analysis store.
+
+    Parameters:
+        window(str): the integration window, either '3' or '12'
+
+        pixels(numpy.ndarray): the flat pixel indices (y * width + x) that will be read
+
+    Returns:
+        ds(xarray.core.dataset.Dataset): the historical data with dims (time, y, x)
+    """
+    layouts = [load_historical_wb(window), load_historical_series_wb(window)]
+    layouts = [ds for ds in layouts if ds is not None]
+    if len(pixels) == 0:
+        return layouts[0]
+
+    # the zonal engine reads the window of the grid that contains the pixels
+    rows, cols = np.divmod(pixels, layouts[0].sizes['x'])
+    extent = {'y': slice(rows.min(), rows.max() + 1), 'x': slice(cols.min(), cols.max() + 1)}
+
+    return min(layouts, key=lambda ds: chunk_reads(ds.perc, extent))
+
+
 @functools.lru_cache(maxsize=2)
+@metrics.loader(lazy=LOAD_MODE == 'lazy')
 def load_forecast_wb(window: str) -> xr.Dataset:
-    return xr.open_dataset(
-        f'gs://{BUCKET}/zarr/analysis/wb-f{window}-{year_ic}-{month_ic}-01.zarr',
-        engine='zarr',
-        consolidated=True,
-        decode_coords='all',
-    ).compute()[['5%', '20%', 'perc', '80%', '95%']]
+    return open_wb(
+        cached_path(
+            f'zarr/analysis/wb-f{window}-{year_ic}-{month_ic}-01.zarr',
+            release=f'{year_ic}-{month_ic}-01',
+        ),
+        release=f'{year_ic}-{month_ic}-01',
+    )[['5%', '20%', 'perc', '80%', '95%']]
 
 
 # lazy load country boundary layer
 @functools.lru_cache(maxsize=1)
+@metrics.loader
 def load_countries() -> gpd.GeoDataFrame:
-    return gpd.read_parquet(f'gs://{BUCKET}/vector/countries.parquet')
+    return gpd.read_parquet(cached_path('vector/countries.parquet'))
 
 
 # lazy load country boundary layer
 @functools.lru_cache(maxsize=1)
+@metrics.loader
 def load_states() -> gpd.GeoDataFrame:
-    return gpd.read_parquet(f'gs://{BUCKET}/vector/states.parquet')
+    return gpd.read_parquet(cached_path('vector/states.parquet'))
 
 
 # lazy load crop extent vector
 @functools.lru_cache(maxsize=10)
+@metrics.loader
 def load_crop_extent_vector(crop_name: str) -> None | gpd.GeoDataFrame:
     if crop_name == '' or crop_name == 'none':
         return None
     return gpd.read_parquet(
-        f'gs://{BUCKET}/vector/{crop_name}.parquet',
+        cached_path(f'vector/{crop_name}.parquet'),
     )
 
 
 # lazy load crop production raster
 @functools.lru_cache(maxsize=10)
+@metrics.loader
 def load_crop_production_raster(crop_name: str) -> None | xr.Dataset:
     if crop_name == '' or crop_name == 'none':
         return None
     return (
         xr.open_dataset(
-            f'gs://{BUCKET}/zarr/spam-crop-production.zarr',
+            cached_path('zarr/spam-crop-production.zarr'),
             engine='zarr',
             consolidated=True,
         )
         .sel(crop=crop_name)
         .production.compute()
     )
+
+
+# lazy load the region index created by the data pipeline
+# releases made without it (like those of `drought_to_zarr_gcsfuse.py`) clip each selection by its geometry
+REGION_INDEX = f'zarr/analysis/regions-{year_ic}-{month_ic}-01.zarr'
+
+
+@functools.lru_cache(maxsize=1)
+@metrics.loader
+def load_regions() -> None | xr.Dataset:
+    """
+    Load the region index of the release, or return None if it has not been published.
+    """
+    if not exists(REGION_INDEX):
+        return None
+
+    return xr.open_dataset(
+        cached_path(REGION_INDEX, release=f'{year_ic}-{month_ic}-01'),
+        engine='zarr',
+        consolidated=True,
+    ).compute()
+
+
+@functools.lru_cache(maxsize=1)
+@metrics.loader
+def load_region_lookup() -> None | dict:
+    """
+    Map each (country, state) selection to the flat pixel indices it covers on the water balance grid,
+    or return None if the region index has not been published.
+    """
+    regions = load_regions()
+    if regions is None:
+        return None
+
+    offsets = regions.region_offset.values
+    pixels = regions.region_pixel.values
+
+    return {
+        (country, state): pixels[offsets[idx] : offsets[idx + 1]]
+        for idx, (country, state) in enumerate(
+            zip(regions.region_country.values, regions.region_state.values)
+        )
+    }
+
+
+def region_pixels(country: str, state: str) -> np.ndarray:
+    """
+    Return the flat pixel indices (y * width + x) for a country and state, where state can be 'All'.
+    """
+    return load_region_lookup()[(country, state)]
+
+
+def known_region(country: str, state: str) -> bool:
+    """
+    Check whether a country and state (where state can be 'All') is one of the regions of the app.
+    """
+    lookup = load_region_lookup()
+    if lookup is not None:
+        return (country, state) in lookup
+
+    if state == 'All':
+        return bool((load_countries().name == country).any())
+    states = load_states()
+    return bool(((states.name == state) & (states.country == country)).any())
+
+
+def on_region_grid(ds: xr.Dataset, regions: None | xr.Dataset) -> bool:
+    """
+    Check whether a Dataset is on the grid that the region index was built for.
+
+    The coordinates are compared rather than only the shape of the grid, since a grid of the same shape
+    can start somewhere else (like longitudes from 0 to 360) or run the other way (like ascending latitudes).
+    """
+    return (
+        regions is not None
+        and ds.sizes['y'] == regions.sizes['y']
+        and ds.sizes['x'] == regions.sizes['x']
+        and np.allclose(ds.y.values, regions.y.values)
+        and np.allclose(ds.x.values, regions.x.values)
+    )
+
+
+def rasterize_region(ds: xr.Dataset, country: str, state: str) -> xr.Dataset:
+    """
+    Create a region index of a single country or state on the grid of a Dataset,
+    for releases without a region index on that grid.
+    """
+    countries = load_countries()
+    states = load_states()
+
+    if state == 'All':
+        return rasterize_regions(ds, countries.query(" name == @country "), states.iloc[:0])
+    return rasterize_regions(
+        ds, countries.iloc[:0], states.query(" name == @state and country == @country ")
+    )
+
+
+def region_bounds(geometry: gpd.GeoSeries) -> list:
+    """
+    Return the bounds [xmin, ymin, xmax, ymax] of a region.
+
+    If the region is narrower when it crosses the antimeridian (for example Fiji, Russia, or the USA with
+    Alaska), xmin is the western edge in the eastern hemisphere and xmax is the eastern edge in the
+    western hemisphere, so xmin > xmax.
+    """
+    parts = geometry.explode(index_parts=False).bounds
+    xmin, ymin = parts.minx.min(), parts.miny.min()
+    xmax, ymax = parts.maxx.max(), parts.maxy.max()
+
+    east = parts[parts.minx + parts.maxx > 0]
+    west = parts[parts.minx + parts.maxx <= 0]
+    if len(east) > 0 and len(west) > 0:
+        wrapped_xmin = east.minx.min()
+        wrapped_xmax = west.maxx.max()
+        if wrapped_xmax + 360 - wrapped_xmin < xmax - xmin:
+            return [wrapped_xmin, ymin, wrapped_xmax, ymax]
+
+    return [xmin, ymin, xmax, ymax]
+
+
+def index_range(coords: np.ndarray, vmin: float, vmax: float) -> tuple[int, int]:
+    """
+    Find the range of indices on a regular grid of pixel centers whose pixels touch [vmin, vmax],
+    padded by one pixel on both sides. This works for both increasing and decreasing coordinates.
+    """
+    step = coords[1] - coords[0]
+    indices = np.floor((np.array([vmin, vmax]) - coords[0]) / step + 0.5)
+    start = max(int(indices.min()) - 1, 0)
+    stop = min(int(indices.max()) + 2, len(coords))
+
+    return start, stop
+
+
+def join_antimeridian(ds: xr.Dataset, east_start: int, west_stop: int) -> xr.Dataset:
+    """
+    Join the eastern edge of a global Dataset (from column `east_start`) to its western edge
+    (up to column `west_stop`). The western columns are shifted by 360 degrees so that x keeps increasing.
+    """
+    east = ds.isel(x=slice(east_start, None))
+    west = ds.isel(x=slice(0, west_stop))
+    west = west.assign_coords(x=west.x + 360)
+
+    return xr.concat([east, west], dim='x', coords='minimal', compat='override')
+
+
+def subset_to_bbox(ds: xr.Dataset, bounds: list) -> xr.Dataset:
+    """
+    Slice a Dataset on a regular lat / lon grid to the bounds of a region with index arithmetic,
+    so that masking by a polygon afterwards only has to look at a small window of the grid.
+
+    Bounds that cross the antimeridian (xmin > xmax, see `region_bounds`) are joined into a single window.
+    """
+    xmin, ymin, xmax, ymax = bounds
+    x = ds.x.values
+
+    y_start, y_stop = index_range(ds.y.values, ymin, ymax)
+    ds = ds.isel(y=slice(y_start, y_stop))
+
+    if xmin <= xmax:
+        x_start, x_stop = index_range(x, xmin, xmax)
+        return ds.isel(x=slice(x_start, x_stop))
+
+    east_start, _ = index_range(x, xmin, x[-1])
+    _, west_stop = index_range(x, x[0], xmax)
+
+    return join_antimeridian(ds, east_start, west_stop)
+
+
+def clip_to_geometry(ds: xr.Dataset, geometry: gpd.GeoSeries) -> xr.Dataset:
+    """
+    Mask a Dataset that has already been sliced to a window (for example with `subset_to_bbox`) by a geometry.
+
+    The geometry is first cut to the window, so large geometries like crop extents are only rasterized
+    where they overlap the data. Windows that cross the antimeridian are also masked by a copy of the
+    geometry shifted by 360 degrees.
+    """
+    xmin, ymin, xmax, ymax = ds.rio.bounds()
+
+    geometries = [geometry]
+    if xmax > 180:
+        geometries.append(geometry.translate(xoff=360))
+    geometries = pd.concat(geometries).clip_by_rect(xmin, ymin, xmax, ymax)
+    geometries = geometries[~geometries.is_empty]
+
+    if len(geometries) == 0:
+        raise rioxarray.exceptions.NoDataInBounds('No data found in bounds.')
+
+    return ds.rio.clip(geometries, all_touched=True, drop=True)
+
+
+def clip_to_region(ds: xr.Dataset, country: str, state: str, geometry: gpd.GeoSeries) -> xr.Dataset:
+    """
+    Clip a Xarray Dataset to a country or state using the precomputed region index.
+
+    This gives the same result as `ds.rio.clip(geometry, all_touched=True, drop=True)`,
+    but only touches the window of the grid that contains the region. Regions that cross the
+    antimeridian are joined into one window, with x continuing past 180 degrees.
+    If the region index has not been published, or the Dataset is not on the grid that it was built for,
+    we slice it to the region's bounds and clip it by its geometry instead. Compactly stored percentiles
+    are decoded once they are sliced to the window (see `encoding.py`).
+    """
+    if not on_region_grid(ds, load_regions()):
+        return clip_to_geometry(
+            decode_dataset(subset_to_bbox(ds, region_bounds(geometry))), geometry
+        )
+
+    pixels = region_pixels(country, state)
+    if len(pixels) == 0:
+        raise rioxarray.exceptions.NoDataInBounds(f'No data found in bounds of {state}, {country}.')
+
+    width = ds.sizes['x']
+    rows, cols = np.divmod(pixels, width)
+    row_start, row_stop = rows.min(), rows.max() + 1
+    col_start, col_stop = cols.min(), cols.max() + 1
+
+    # if the largest gap between the columns of a region is not at the edge of the grid,
+    # the region is narrower when its window crosses the antimeridian
+    occupied = np.unique(cols)
+    gaps = np.diff(np.append(occupied, occupied[0] + width))
+    largest = gaps.argmax()
+    wraps = largest < len(gaps) - 1 and gaps[largest] > width - (col_stop - col_start)
+
+    if wraps:
+        col_start = occupied[largest + 1]
+        col_stop = occupied[largest] + 1
+        window = join_antimeridian(ds.isel(y=slice(row_start, row_stop)), col_start, col_stop)
+        cols = np.where(cols >= col_start, cols - col_start, cols + width - col_start)
+    else:
+        window = ds.isel(y=slice(row_start, row_stop), x=slice(col_start, col_stop))
+        cols = cols - col_start
+
+    mask = np.zeros((window.sizes['y'], window.sizes['x']), dtype=bool)
+    mask[rows - row_start, cols] = True
+
+    return decode_dataset(window).where(xr.DataArray(mask, dims=('y', 'x')))
+
+
+# the regional timeseries table published by the data pipeline
+REGIONAL_SERIES_TABLE = f'tables/regional-series-{year_ic}-{month_ic}-01.parquet'
+
+
+@functools.lru_cache(maxsize=1)
+def regional_series_path() -> str:
+    """
+    Return where the regional timeseries table can be read from, which only needs to be looked up once.
+    """
+    return cached_path(REGIONAL_SERIES_TABLE, release=f'{year_ic}-{month_ic}-01')
+
+
+@functools.lru_cache(maxsize=64)
+@metrics.loader
+def load_regional_series(country: str, state: str, crop: str, window: str) -> None | pd.DataFrame:
+    """
+    Read the historical and forecast timeseries of a single selection from the regional timeseries table.
+
+    Returns None if the table has not been published for this release,
+    in which case the timeseries need to be calculated from the water balance data.
+    """
+    try:
+        df = pd.read_parquet(
+            regional_series_path(),
+            filters=[
+                ('country', '==', country),
+                ('states', '==', state),
+                ('crop', '==', crop),
+                ('window', '==', int(window)),
+            ],
+        )
+    except FileNotFoundError:
+        return None
+
+    return df[SERIES_COLUMNS]
+
+
+@metrics.loader
+def calculate_regional_series(country: str, state: str, crop: str, window: str) -> pd.DataFrame:
+    """
+    Calculate the historical and forecast timeseries of a single selection from the water balance data.
+
+    This is only needed when the regional timeseries table has not been published for this release.
+    """
+    regions = load_regions()
+
+    # without a region index on the grid of the data, the selection is rasterized on its own
+    if not on_region_grid(load_forecast_wb(window), regions):
+        regions = rasterize_region(load_forecast_wb(window), country, state)
+
+    selection = np.flatnonzero(
+        (regions.region_country.values == country) & (regions.region_state.values == state)
+    )
+
+    return calculate_series(selection, crop, window, regions)
+
+
+def calculate_series(
+    selection: np.ndarray, crop: str, window: str, regions: None | xr.Dataset = None
+) -> pd.DataFrame:
+    """
+    Calculate the historical and forecast timeseries of several regions at once from the water balance data,
+    which reads the data that the regions share only once.
+
+    Parameters:
+        selection(numpy.ndarray): the positions of the regions in the region index `regions`
+
+        crop(str): the name of a crop, or 'none' for the whole regions
+
+        window(str): the integration window, either '3' or '12'
+
+        regions(xarray.core.dataset.Dataset): the region index that the selection is from,
+            which is the one from `load_regions` by default
+
+    Returns:
+        df(pandas.DataFrame): a table with the columns in `SERIES_COLUMNS`,
+            without the regions that have no data at all
+    """
+    if regions is None:
+        regions = load_regions()
+
+    if crop == '' or crop == 'none':
+        weights, index = region_weights(regions)
+        weights = weights[selection]
+        index = index.iloc[selection]
+    else:
+        weights, index = crop_weights(
+            regions,
+            load_crop_production_raster(crop),
+            crop,
+            load_crop_extent_vector(crop),
+            selection,
+        )
+
+    historical = regional_series(
+        load_historical_for_pixels(window, np.unique(weights.indices)), weights, index, ['perc']
+    )
+    forecast = regional_series(
+        load_forecast_wb(window), weights, index, ['5%', '20%', 'perc', '80%', '95%']
+    )
+
+    return pd.concat(
+        [
+            series_to_dataframe(historical, 'historical', window),
+            series_to_dataframe(forecast, 'forecast', window),
+        ],
+        ignore_index=True,
+    )
+
+
+# the results depend on the release as well as the selection
+@byte_lru_cache(RESULT_CACHE_BYTES, key=lambda *args: (year_ic, month_ic, *args))
+@metrics.loader
+def reduce_selection(
+    country: str, state: str, crop: str, window: str
+) -> tuple[xr.Dataset, None | pd.DataFrame]:
+    """
+    Clip the forecast to a selection and get the selection's historical and forecast timeseries.
+
+    The results are cached for every session of the app process, so they should not be modified.
+
+    Parameters:
+        country(str): the name of a country
+
+        state(str): the name of a state of that country, or 'All'
+
+        crop(str): the name of a crop, or 'none' for the whole region
+
+        window(str): the integration window, either '3' or '12'
+
+    Returns:
+        forecast(xarray.core.dataset.Dataset): the forecast clipped to the selection
+
+        series(pandas.DataFrame): the timeseries of the selection,
+            or None if the crop is not grown in the selection
+    """
+    countries = load_countries()
+    states = load_states()
+
+    # we have already filtered countries where we don't have data, so clipping by country extent
+    # should never produce a rioxarray.exceptions.NoDataInBounds error at this step
+    # the pixels of each country and state are precomputed, so we don't rasterize the geometry here
+    if state == 'All':
+        geometry = countries.query(" name == @country ").geometry
+    else:
+        geometry = states.query(" name == @state and country == @country ").geometry
+
+    forecast = clip_to_region(load_forecast_wb(window), country, state, geometry)
+    forecast = forecast.assign_attrs({'crop': crop})
+
+    try:
+        # the forecast map is not production weighted, but it only shows where the crop is grown
+        if crop != 'none':
+            forecast = clip_to_geometry(forecast, load_crop_extent_vector(crop).geometry)
+
+        # the timeseries are calculated for every selection by the data pipeline,
+        # so we only need to calculate them here if the table has not been published for this release
+        series = load_regional_series(country, state, crop, window)
+        if series is None:
+            series = calculate_regional_series(country, state, crop, window)
+
+    except rioxarray.exceptions.NoDataInBounds:
+        print('No data in bounds!')
+        series = None
+
+    return forecast, series
+
+
+@functools.lru_cache(maxsize=1)
+def regional_series_available() -> bool:
+    """
+    Check whether the regional timeseries table has been published for this release.
+    """
+    return exists(REGIONAL_SERIES_TABLE)
+
+
+# the hits and misses of the caches of loaded data and results are reported on /metrics
+for cached in [
+    load_historical_wb,
+    load_historical_series_wb,
+    load_forecast_wb,
+    load_countries,
+    load_states,
+    load_crop_extent_vector,
+    load_crop_production_raster,
+    load_regions,
+    load_region_lookup,
+    load_regional_series,
+    reduce_selection,
+]:
+    metrics.watch_cache(cached.__name__, cached.cache_info)
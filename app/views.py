@@ -0,0 +1,829 @@
+"""
+Build what the app shows and downloads for a selection: the clipped forecast and timeseries,
+the timeseries table, the timeseries figure, the forecast map, and the downloaded PNG and CSV files.
+
+These are plain functions of their inputs, so the server in `drought.py` only passes the values of its
+inputs and reactive values to them, and they can be timed outside of a Shiny session
+(see `data_processing/benchmark_server.py`).
+
+    forecast, series = select_region('USA', 'CONUS', 'maize', '3')
+    df = series_table(series, show_historical=True, show_forecast=True)
+    fig = timeseries_figure(df, True, True, '2021-01-01')
+    png = timeseries_png(fig, 300, timeseries_title('USA', 'CONUS', 'maize', '3'))
+
+Figures are created without pyplot, so they are freed like any other object instead of being kept
+open by pyplot, and they can be rendered in other threads. The rendered timeseries PNG files are cached
+for every session by `render_timeseries`, which the server runs in `render_executor`, so rendering
+does not block the event loop that every session of the app process shares, and moving the time slider
+back to a date that was already shown does not render the figure again. The forecast maps and the
+images of their forecast months are cached for every session in the same way, by `forecast_map_payload`
+and `render_forecast_frame`.
+"""
+
+import asyncio
+import io
+import os
+import urllib.parse
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import matplotlib
+import matplotlib.dates as mdates
+import matplotlib.font_manager as font_manager
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xarray as xr
+from matplotlib.figure import Figure
+from matplotlib.image import imsave
+from matplotlib.lines import Line2D
+
+import metrics
+from results import byte_lru_cache
+from utils import forecast_dates, month_ic, reduce_selection, year_ic
+from zonal import SERIES_COLUMNS, SERIES_SCHEMA
+
+# the number of bytes of rendered timeseries figures that are shared by every session
+FIGURE_CACHE_BYTES = int(os.getenv('FIGURE_CACHE_BYTES', str(64 * 1024**2)))
+
+# the number of bytes of forecast maps and of their images that are shared by every session
+FORECAST_MAP_CACHE_BYTES = int(os.getenv('FORECAST_MAP_CACHE_BYTES', str(64 * 1024**2)))
+
+# the number of figures that are rendered at the same time
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', '2'))
+
+# the number of rows of a timeseries table that are written to a Parquet or Arrow file at a time,
+# which is a row group of a Parquet file and a record batch of an Arrow file
+TABLE_CHUNK_ROWS = int(os.getenv('TABLE_CHUNK_ROWS', str(64 * 1024)))
+
+# 'image' (the default) renders a PNG file of the timeseries on the server for every date of the time slider,
+# while 'interactive' sends the whole timeseries of a selection to the browser once, which draws it with
+# plotly.js and filters it to the dates of the time slider
+TIMESERIES_MODE = os.getenv('WB_TIMESERIES_MODE', 'image')
+
+# the size in pixels of downloaded timeseries figures, when the figure in the app is not an image,
+# which is about the size of the figure in the app
+DOWNLOAD_SIZE = (900, 300)
+
+# the number of pixels that the images of the forecast map have at least along their longer side
+FRAME_SIZE = 512
+
+# the path of the images of the forecast map in the app, see `frames.py`
+FRAME_ROUTE = 'forecast-frames'
+
+# the latitude up to which the forecast map shows the forecast, like every Web Mercator map
+MAX_LATITUDE = 85.05
+
+# the Plotly config of the forecast map
+FORECAST_MAP_CONFIG = {
+    # 'staticPlot': False,
+    'displaylogo': False,
+    # 'displayModeBar': False,
+    'scrollZoom': True,
+    # 'modeBarButtonsToRemove': ['zoom', 'pan', 'select', 'lasso2d', 'toImage']
+    'modeBarButtonsToRemove': ['pan', 'select', 'lasso2d', 'toImage'],
+    # the map fills the width of its container
+    'responsive': True,
+}
+
+# figures are rendered in these threads instead of on the event loop of the app
+render_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix='render')
+
+static_dir = Path(__file__).parent / 'www'
+ginto = font_manager.FontProperties(fname=static_dir / 'GintoNormal-Regular.ttf')
+ginto_medium = font_manager.FontProperties(fname=static_dir / 'GintoNormal-Medium.ttf')
+
+timeseries_color = '#1b1e23'
+high_certainty_color = '#f4c1c1'
+medium_certainty_color = '#f69a9a'
+
+
+def select_region(
+    country: str, state: str, crop: str, window: str
+) -> tuple[None | xr.Dataset, None | pd.DataFrame]:
+    """
+    Get the clipped forecast and the timeseries of a selection, or None for both if there is no data to show.
+
+    Parameters:
+        country(str): the name of a country
+
+        state(str): the name of a state of that country, or 'All'
+
+        crop(str): the name of a crop, or 'none' for the whole region
+
+        window(str): the integration window, either '3' or '12'
+
+    Returns:
+        forecast(xarray.core.dataset.Dataset): the forecast clipped to the selection
+
+        series(pandas.DataFrame): the historical and forecast timeseries of the selection
+    """
+    if window != '3' and window != '12':
+        raise ValueError('The integration window should be either 3 or 12 months.')
+
+    # the clipped forecast and the timeseries of a selection are shared by every session,
+    # so popular selections are only calculated once
+    forecast, series = reduce_selection(country, state, crop, window)
+
+    # sometimes, clipping is silently failing when there is no data to show, but instead returns an empty dataset
+    if series is None or series.empty or forecast.perc.isnull().all():
+        return None, None
+
+    return forecast, series
+
+
+def series_table(
+    series: None | pd.DataFrame, show_historical: bool, show_forecast: bool
+) -> pd.DataFrame:
+    """
+    Filter the timeseries of a selection to the datasets that are shown, with the latest dates first.
+
+    Parameters:
+        series(pandas.DataFrame): the timeseries from `select_region`, or None if nothing is selected
+
+        show_historical(bool): whether to keep the historical timeseries
+
+        show_forecast(bool): whether to keep the forecast timeseries
+
+    Returns:
+        df(pandas.DataFrame): the table that is shown and downloaded, which is empty if nothing is shown
+    """
+    # if there is no data (on initial load) or if the toggles controlling which datasets to show are both false, then return empty dataframe
+    if series is None or (show_forecast is False and show_historical is False):
+        return pd.DataFrame({column: [] for column in SERIES_COLUMNS})
+
+    types = []
+    if show_historical is True:
+        types.append('historical')
+    if show_forecast is True:
+        types.append('forecast')
+
+    return (
+        series[series['type'].isin(types)]
+        .sort_values('time', ascending=False)
+        .reset_index(drop=True)
+    )
+
+
+def timeseries_figure(
+    df: pd.DataFrame,
+    show_historical: bool,
+    show_forecast: bool,
+    start_date: str,
+    figsize: None | tuple[float, float] = None,
+) -> Figure:
+    """
+    Plot the timeseries table of a selection from a date onwards.
+
+    Parameters:
+        df(pandas.DataFrame): the table from `series_table`
+
+        show_historical(bool): whether the table has the historical timeseries
+
+        show_forecast(bool): whether the table has the forecast timeseries
+
+        start_date(str): the first date that is shown, like '2021-01-01'
+
+        figsize(tuple): the (width, height) of the figure in inches, by default the Matplotlib default
+
+    Returns:
+        fig(matplotlib.figure.Figure): the figure
+    """
+    # later if we want to make it so that we can dynamically change the timeframe:
+    # https://plotly.com/python/range-slider/
+    df = df[pd.to_datetime(df['time'], format='%Y-%m-%d') >= pd.Timestamp(start_date)]
+
+    legend_options = {
+        'xdata': [0],
+        'ydata': [0],
+    }
+
+    historical_label = Line2D(
+        color=timeseries_color,
+        markerfacecolor=timeseries_color,
+        label='Historical',
+        linewidth=1.25,
+        **legend_options,
+    )
+    forecast_label = Line2D(
+        color=timeseries_color,
+        markerfacecolor=timeseries_color,
+        label='Mean forecast',
+        linestyle='--',
+        linewidth=1.25,
+        **legend_options,
+    )
+    medium_certainty_label = Line2D(
+        color=medium_certainty_color,
+        markerfacecolor=medium_certainty_color,
+        label='60%',
+        linewidth=3,
+        **legend_options,
+    )
+    high_certainty_label = Line2D(
+        color=high_certainty_color,
+        markerfacecolor=high_certainty_color,
+        label='90%',
+        linewidth=3,
+        **legend_options,
+    )
+    legend_elements = []
+
+    fig = Figure(figsize=figsize)
+    ax = fig.subplots()
+
+    # if both are true, we need to stitch together the historical and forecast timeseries
+    if show_historical is True and show_forecast is True:
+        # this is the historical data plus the first entry for forecast data
+        df_historical = df.iloc[6:, :]
+
+        # this is the 6-month forecast plus the last data entry for historical data
+        df_forecast = df.iloc[0:7, :]
+
+        # this dataframe is purely aesthetic; it covers up the gap in the historical and forecast data in the plot
+        df_bridge = df.iloc[5:7]
+
+        # forecast data needs to be plotted first because of the uncertainty bounds
+        ax.fill_between(
+            df_forecast['time'],
+            df_forecast['5%'],
+            df_forecast['95%'],
+            color=high_certainty_color,
+        )
+        ax.fill_between(
+            df_forecast['time'],
+            df_forecast['20%'],
+            df_forecast['80%'],
+            color=medium_certainty_color,
+        )
+        ax.plot(
+            df_forecast['time'],
+            df_forecast['percentile'],
+            color=timeseries_color,
+            linestyle='--',
+        )
+        ax.plot(df_historical['time'], df_historical['percentile'], color=timeseries_color)
+        ax.plot(df_bridge['time'], df_bridge['percentile'], color=timeseries_color)
+
+        legend_elements = [
+            historical_label,
+            forecast_label,
+            medium_certainty_label,
+            high_certainty_label,
+        ]
+
+    if show_historical is True and show_forecast is False:
+        ax.plot(df['time'], df['percentile'], color=timeseries_color)
+
+        if len(df) == 5:
+            ax.set_xticks([date for date in df.time.values])
+
+        legend_elements = [historical_label]
+
+    if show_historical is False and show_forecast is True:
+        ax.fill_between(df['time'], df['5%'], df['95%'], color=high_certainty_color)
+        ax.fill_between(df['time'], df['20%'], df['80%'], color=medium_certainty_color)
+        ax.plot(df['time'], df['percentile'], color=timeseries_color, linestyle='--')
+
+        forecast_date_format = mdates.DateFormatter('%m-%y')
+        ax.xaxis.set_major_formatter(forecast_date_format)
+
+        legend_elements = [forecast_label, medium_certainty_label, high_certainty_label]
+
+    ax.set_xlabel('Time', fontproperties=ginto_medium)
+    # ax.set_ylabel('Mean water balance', fontproperties=ginto_medium)
+    ax.set_ylabel('Water balance percentile', fontproperties=ginto_medium)
+
+    # when there are 60 or more entries in the dataframe,
+    # the date labels along the x-axis get crowded and difficult to read
+    if len(df) <= 60:
+        date_format = mdates.DateFormatter('%m-%y')
+        ax.xaxis.set_major_formatter(date_format)
+
+    # use custom fonts for x and y axes labels
+    for label in ax.get_xticklabels():
+        label.set_fontproperties(ginto)
+
+    for label in ax.get_yticklabels():
+        label.set_fontproperties(ginto)
+
+    ax.margins(0, 0)
+    ax.set_ylim(-0.05, 1.05)
+
+    if not show_forecast and not show_historical:
+        ax.set_xticks([0, 1, 2, 3, 4, 5])
+        ax.set_xticklabels(['', '', '', '', '', ''])
+
+    # you need both of these to change the colors
+    fig.patch.set_facecolor('#f7f7f7')
+    ax.set_facecolor('#f7f7f7')
+
+    fig.tight_layout()
+    fig.subplots_adjust(bottom=0.25)
+
+    if len(legend_elements) > 0:
+        fig.legend(
+            handles=legend_elements,
+            ncols=len(legend_elements),
+            loc='lower center',
+            bbox_to_anchor=(0 if len(legend_elements) == 3 else 0.025, 0, 1, 0.5),
+            fontsize='small',
+            facecolor='white',
+            frameon=False,
+        )
+
+    return fig
+
+
+def timeseries_chart(df: pd.DataFrame, show_historical: bool, show_forecast: bool) -> str:
+    """
+    Plot the whole timeseries table of a selection like `timeseries_figure`, as a Plotly figure that
+    the browser draws and filters to the dates of the time slider (see `scripts/timeseries-chart.js`).
+
+    Parameters:
+        df(pandas.DataFrame): the table from `series_table`
+
+        show_historical(bool): whether the table has the historical timeseries
+
+        show_forecast(bool): whether the table has the forecast timeseries
+
+    Returns:
+        figure(str): the JSON of the Plotly figure
+    """
+    fig = go.Figure()
+
+    if show_forecast is True:
+        # this is the 6-month forecast plus the last data entry for historical data
+        df_forecast = df.iloc[0:7, :] if show_historical is True else df
+
+        # the lower bound of each uncertainty band is filled up to its upper bound
+        for lower, upper, color, name, rank in [
+            ('5%', '95%', high_certainty_color, '90%', 4),
+            ('20%', '80%', medium_certainty_color, '60%', 3),
+        ]:
+            fig.add_scatter(
+                x=df_forecast['time'],
+                y=df_forecast[upper],
+                mode='lines',
+                line_width=0,
+                showlegend=False,
+                hoverinfo='skip',
+            )
+            fig.add_scatter(
+                x=df_forecast['time'],
+                y=df_forecast[lower],
+                mode='lines',
+                line_width=0,
+                fill='tonexty',
+                fillcolor=color,
+                name=name,
+                legendrank=rank,
+                hoverinfo='skip',
+            )
+
+        fig.add_scatter(
+            x=df_forecast['time'],
+            y=df_forecast['percentile'],
+            mode='lines',
+            line={'color': timeseries_color, 'dash': 'dash', 'width': 1.25},
+            name='Mean forecast',
+            legendrank=2,
+        )
+
+    if show_historical is True:
+        # this also covers up the gap between the historical and the forecast data
+        df_historical = df.iloc[5:, :] if show_forecast is True else df
+
+        fig.add_scatter(
+            x=df_historical['time'],
+            y=df_historical['percentile'],
+            mode='lines',
+            line={'color': timeseries_color, 'width': 1.25},
+            name='Historical',
+            legendrank=1,
+        )
+
+    axes = {
+        'showgrid': False,
+        'zeroline': False,
+        'showline': True,
+        'mirror': True,
+        'linecolor': 'black',
+        'ticks': 'outside',
+        'title_font_family': 'Ginto normal',
+    }
+
+    fig.update_layout(
+        font_family='Ginto normal',
+        paper_bgcolor='#f7f7f7',
+        plot_bgcolor='#f7f7f7',
+        margin={'l': 60, 'r': 20, 't': 15, 'b': 0},
+        hovermode='x',
+        showlegend=True,
+        legend={'orientation': 'h', 'x': 0.5, 'xanchor': 'center', 'y': -0.3, 'yanchor': 'top'},
+    )
+    fig.update_xaxes(
+        title_text='Time',
+        tickformat='%m-%y' if show_historical is False else None,
+        **axes,
+    )
+    fig.update_yaxes(title_text='Water balance percentile', range=[-0.05, 1.05], **axes)
+
+    return fig.to_json()
+
+
+def timeseries_title(country: str, state: str, crop: str, window: str) -> str:
+    """
+    Return the title of a downloaded timeseries figure, like 'Texas, USA maize-growing regions, 3-month integration window'.
+    """
+    country_label = country
+
+    if state == 'CONUS':
+        state_label = 'CONUS'
+        country_label = ''
+    elif state != '' and state != 'All':
+        state_label = state + ', '
+    else:
+        state_label = ''
+
+    if crop != '' and crop != 'none':
+        crop_label = f' {crop}-growing regions'
+    else:
+        crop_label = ''
+
+    window_label = f', {window}-month integration window'
+
+    return f'{state_label}{country_label}{crop_label}{window_label}'
+
+
+def timeseries_png(fig: Figure, dpi: float, title: None | str = None) -> bytes:
+    """
+    Render a timeseries figure from `timeseries_figure` to a PNG file. Figures with a title
+    (the downloaded figures) get a white background. This changes the figure in place.
+    """
+    if title is not None:
+        ax = fig.axes[0]
+
+        fig.patch.set_facecolor('white')
+        ax.set_facecolor('white')
+
+        ax.set_title(title, fontproperties=ginto_medium)
+
+        fig.subplots_adjust(top=0.9)
+
+    with io.BytesIO() as buffer:
+        fig.savefig(buffer, format='png', dpi=dpi)
+        return buffer.getvalue()
+
+
+# the results depend on the release as well as the selection
+@byte_lru_cache(FIGURE_CACHE_BYTES, key=lambda *args: (year_ic, month_ic, *args))
+@metrics.loader
+def render_timeseries(
+    country: str,
+    state: str,
+    crop: str,
+    window: str,
+    show_historical: bool,
+    show_forecast: bool,
+    start_date: str,
+    width: int,
+    height: int,
+    dpi: float,
+    download: bool = False,
+) -> bytes:
+    """
+    Render the timeseries figure of a selection to a PNG file, which is cached for every session.
+
+    Parameters:
+        country(str): the name of a country
+
+        state(str): the name of a state of that country, or 'All'
+
+        crop(str): the name of a crop, or 'none' for the whole region
+
+        window(str): the integration window, either '3' or '12'
+
+        show_historical(bool): whether to show the historical timeseries
+
+        show_forecast(bool): whether to show the forecast timeseries
+
+        start_date(str): the first date that is shown, like '2021-01-01'
+
+        width(int): the width of the figure in pixels at 100 dpi
+
+        height(int): the height of the figure in pixels at 100 dpi
+
+        dpi(float): the resolution of the PNG file, which is 100 times the pixel ratio of a screen
+
+        download(bool): whether to render the figure for downloading, with a title and a white background
+
+    Returns:
+        png(bytes): the PNG file
+    """
+    _, series = select_region(country, state, crop, window)
+    df = series_table(series, show_historical, show_forecast)
+    fig = timeseries_figure(
+        df, show_historical, show_forecast, start_date, (width / 100, height / 100)
+    )
+    title = timeseries_title(country, state, crop, window) if download else None
+
+    return timeseries_png(fig, dpi, title)
+
+
+async def render_async(function: Callable, *args):
+    """
+    Run a rendering function, like `render_timeseries`, in `render_executor`,
+    so that the event loop can serve other sessions in the meantime.
+    """
+    return await asyncio.get_running_loop().run_in_executor(render_executor, function, *args)
+
+
+def table_csv(df: pd.DataFrame) -> bytes:
+    """
+    Render the timeseries table from `series_table` to a CSV file.
+    """
+    with io.BytesIO() as buffer:
+        df.to_csv(buffer)
+        return buffer.getvalue()
+
+
+def series_arrow_table(df: pd.DataFrame) -> pa.Table:
+    """
+    Convert a timeseries table from `series_table` to an Arrow table with the types of `SERIES_SCHEMA`.
+    """
+    # the empty table has no types to convert from
+    if len(df) == 0:
+        return SERIES_SCHEMA.empty_table()
+
+    return pa.Table.from_pandas(df[SERIES_COLUMNS], schema=SERIES_SCHEMA, preserve_index=False)
+
+
+class ChunkSink(io.RawIOBase):
+    """
+    A file that keeps what is written to it until it is taken with `take()`, while its position keeps
+    counting every byte, so that file formats with offsets (like Parquet) can be streamed from it.
+    """
+
+    def __init__(self) -> None:
+        self.chunks = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def table_chunks(tables: Iterable[pd.DataFrame], file_format: str) -> Iterator[bytes]:
+    """
+    Write timeseries tables from `series_table` to a single Parquet or Arrow IPC file with the columns
+    and types of `SERIES_SCHEMA`, and yield the file in chunks of `TABLE_CHUNK_ROWS` rows as they are
+    written, so that neither a large table nor a download of many regions holds the whole file in memory.
+
+    Parameters:
+        tables(iterable): the timeseries tables, like those of every region of a download
+
+        file_format(str): either 'parquet' or 'arrow' (the Arrow IPC file format, which is also Feather)
+
+    Returns:
+        chunks(iterator): the bytes of the file
+    """
+    sink = ChunkSink()
+    if file_format == 'parquet':
+        writer = pq.ParquetWriter(sink, SERIES_SCHEMA, compression='zstd')
+    elif file_format == 'arrow':
+        options = pa.ipc.IpcWriteOptions(compression='zstd')
+        writer = pa.ipc.new_file(sink, SERIES_SCHEMA, options=options)
+    else:
+        raise ValueError(f'The file format should be either parquet or arrow, not {file_format}.')
+
+    with writer:
+        for df in tables:
+            for batch in series_arrow_table(df).to_batches(max_chunksize=TABLE_CHUNK_ROWS):
+                writer.write_batch(batch)
+                yield sink.take()
+
+    # the footer is written when the writer is closed
+    yield sink.take()
+
+
+def forecast_frame_png(forecast: xr.Dataset, month: int) -> bytes:
+    """
+    Colormap a forecast month of a clipped forecast to a PNG image, which the forecast map stretches over
+    the bounds of the forecast. Pixels without data are transparent.
+
+    Parameters:
+        forecast(xarray.core.dataset.Dataset): the forecast from `select_region`
+
+        month(int): the index of the forecast month
+
+    Returns:
+        png(bytes): the PNG image
+    """
+    _, ymin, _, ymax = forecast.rio.bounds()
+    perc = forecast['perc'].isel(time=month).sortby('y', ascending=False).transpose('y', 'x')
+    ny, nx = perc.shape
+
+    # small regions are scaled up, so that the map does not blur their pixels into each other
+    scale = int(min(max(np.ceil(FRAME_SIZE / max(ny, nx)), 1), 32))
+
+    # the map is in Web Mercator, so the rows of the image are evenly spaced in Web Mercator
+    # instead of in latitude, and every row shows the pixel of the forecast at its latitude
+    edges = np.linspace(
+        mercator_y(min(ymax, MAX_LATITUDE)), mercator_y(max(ymin, -MAX_LATITUDE)), ny * scale + 1
+    )
+    latitudes = np.degrees(np.arctan(np.sinh((edges[:-1] + edges[1:]) / 2)))
+    rows = np.clip(((ymax - latitudes) / (ymax - ymin) * ny).astype(int), 0, ny - 1)
+
+    values = np.repeat(perc.values[rows], scale, axis=1)
+    rgba = matplotlib.colormaps['RdYlBu'](np.clip(values, 0, 1), bytes=True)
+
+    with io.BytesIO() as buffer:
+        imsave(buffer, rgba, format='png')
+        return buffer.getvalue()
+
+
+def mercator_y(latitude: float) -> float:
+    """
+    Return the Web Mercator y of a latitude, in radians.
+    """
+    return np.arcsinh(np.tan(np.radians(latitude)))
+
+
+# the results depend on the release as well as the selection
+@byte_lru_cache(FORECAST_MAP_CACHE_BYTES, key=lambda *args: (year_ic, month_ic, *args))
+@metrics.loader
+def render_forecast_frame(
+    country: str, state: str, crop: str, window: str, month: int
+) -> None | bytes:
+    """
+    Render a forecast month of the forecast map of a selection to a PNG image, which is cached for every session.
+    This returns None if there is no data to show for the selection.
+    """
+    forecast, _ = select_region(country, state, crop, window)
+    if forecast is None:
+        return None
+
+    return forecast_frame_png(forecast, month)
+
+
+def forecast_frame_url(country: str, state: str, crop: str, window: str, month: int) -> str:
+    """
+    Return the URL of the image of a forecast month of a selection, which `frames.py` serves.
+    The URL includes the release, so browsers can cache the images.
+    """
+    params = urllib.parse.urlencode({'country': country, 'state': state, 'crop': crop})
+    return f'{FRAME_ROUTE}/{year_ic}-{month_ic}/{window}/{month}.png?{params}'
+
+
+# the results depend on the release as well as the selection
+@byte_lru_cache(FORECAST_MAP_CACHE_BYTES, key=lambda *args: (year_ic, month_ic, *args))
+@metrics.loader
+def forecast_map_payload(country: str, state: str, crop: str, window: str) -> None | str:
+    """
+    Create the forecast map of a selection with `forecast_map_figure`, which is cached for every session,
+    so the forecast maps of popular selections are sent without clipping the forecast again.
+    This returns None if there is no data to show for the selection.
+    """
+    forecast, _ = select_region(country, state, crop, window)
+    if forecast is None:
+        return None
+
+    frame_urls = [
+        forecast_frame_url(country, state, crop, window, month)
+        for month in range(forecast.sizes['time'])
+    ]
+
+    return forecast_map_figure(forecast, frame_urls)
+
+
+def forecast_map_figure(forecast: xr.Dataset, frame_urls: list[str]) -> str:
+    """
+    Create the map of a clipped forecast, with a slider over the forecast months, which the browser
+    draws with `FORECAST_MAP_CONFIG` (see `scripts/forecast-map.js`). Every forecast month is an image
+    over the bounds of the forecast, which the browser only loads when the slider shows it.
+
+    Parameters:
+        forecast(xarray.core.dataset.Dataset): the forecast from `select_region`
+
+        frame_urls(list): the URL of the image of every forecast month, from `forecast_frame_png`
+
+    Returns:
+        figure(str): the JSON of the Plotly figure
+    """
+    # the clipped forecast covers the region, including regions that cross the antimeridian,
+    # where x continues past 180 degrees
+    xmin, ymin, xmax, ymax = forecast.rio.bounds()
+    ymin, ymax = max(ymin, -MAX_LATITUDE), min(ymax, MAX_LATITUDE)
+
+    max_bounds = max(abs(xmin - xmax), abs(ymin - ymax)) * 111
+    zoom = 11 - np.log(max_bounds)
+
+    formatted_dates = [pd.to_datetime(date).strftime('%b-%Y') for date in forecast_dates]
+
+    # the corners of the images, clockwise from the top left
+    coordinates = [[xmin, ymax], [xmax, ymax], [xmax, ymin], [xmin, ymin]]
+
+    # the map itself only has an invisible point, which shows the color bar of the images
+    center = {'lon': (xmin + xmax) / 2, 'lat': (ymin + ymax) / 2}
+    fig = go.Figure(
+        go.Scattermap(
+            lon=[center['lon']],
+            lat=[center['lat']],
+            mode='markers',
+            marker={'color': [0.5], 'coloraxis': 'coloraxis', 'opacity': 0},
+            hoverinfo='skip',
+            showlegend=False,
+        )
+    )
+
+    steps = []
+    for idx in range(len(formatted_dates)):
+        step = dict(
+            method='relayout',
+            label=formatted_dates[idx],
+            args=[{'map.layers[0].source': frame_urls[idx]}],
+        )
+        steps.append(step)
+
+    fig.update_layout(
+        map={
+            'style': 'carto-positron-nolabels',
+            'center': {'lon': (center['lon'] + 180) % 360 - 180, 'lat': center['lat']},
+            'zoom': zoom,
+            'layers': [
+                {'sourcetype': 'image', 'source': frame_urls[0], 'coordinates': coordinates}
+            ],
+        },
+        height=495,
+        coloraxis={
+            'colorscale': px.colors.diverging.RdYlBu,
+            'cmin': 0,
+            'cmax': 1,
+            'colorbar_title_text': 'Percentile',
+        },
+        sliders=[
+            {
+                'currentvalue': {'prefix': 'Time: '},
+                'len': 0.8,
+                'pad': {'b': 10, 't': 0},
+                'steps': steps,
+                # 'transition': {'easing': 'circle-in'},
+                'bgcolor': '#f7f7f7',
+                'bordercolor': '#1b1e23',
+                'activebgcolor': '#1b1e23',
+                'tickcolor': '#1b1e23',
+                'font': {'color': '#1b1e23', 'family': 'Ginto normal'},
+            }
+        ],
+        margin=dict(l=0, r=0, t=0, b=0),
+        paper_bgcolor='#f7f7f7',
+    )
+
+    fig.update_coloraxes(
+        colorbar_title_side='right',
+        colorbar_title_font=dict(color='#1b1e23', family='Ginto normal'),
+        # colorbar_title_font=dict(color='#f7f7f7', family='Ginto normal'),
+        colorbar_len=0.8,
+        colorbar_thickness=20,
+        colorbar_tickfont=dict(color='#1b1e23', family='Ginto normal'),
+        # colorbar_tickfont=dict(color='#f7f7f7', family='Ginto normal'),
+    )
+
+    fig.update_layout(coloraxis_colorbar_x=0.01, hoverlabel=dict(font_family='Ginto normal'))
+
+    # https://stackoverflow.com/questions/78834353/animated-plotly-graph-in-pyshiny-express
+    """
+    The below is not working in CSS: the background color and border radius change, but not the padding.
+    So I could try to directly change the HTML string to add the padding in myself.
+
+    .maplibregl-ctrl-attrib-inner {
+        background-color: lightgray;
+        border-radius: 10px;
+        padding: 2px 5px;
+    }
+    """
+
+    # to save individual images later: https://github.com/plotly/plotly.py/issues/664
+    return fig.to_json()
+
+
+metrics.watch_cache(render_timeseries.__name__, render_timeseries.cache_info)
+metrics.watch_cache(render_forecast_frame.__name__, render_forecast_frame.cache_info)
+metrics.watch_cache(forecast_map_payload.__name__, forecast_map_payload.cache_info)
@@ -0,0 +1,456 @@
+"""
+Zonal aggregation of water balance data with sparse pixel-weight matrices.
+
+Every region (a country, a state, or a region restricted to where a crop is grown) is one row of a
+sparse (region x pixel) matrix on the water balance grid. The regional timeseries of every region
+is then a single sparse matrix product with the (pixel x time) water balance data, instead of one
+clip, merge and mean for each selection.
+
+This module is used by both the app and the data pipeline in `data_processing/`.
+
+    weights, index = region_weights(regions)
+    crop_matrix, crop_index = crop_weights(regions, production, 'maize')
+    weights, index = stack_weights([(weights, index), (crop_matrix, crop_index)])
+    series = regional_series(historical, weights, index)
+    series.sel(country='Brazil', state='All', crop='maize')
+"""
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import rasterio.features
+import rioxarray  # noqa: F401 (registers the .rio accessor)
+import scipy.sparse
+import xarray as xr
+
+from encoding import decode_values
+
+# the number of time steps that are multiplied with the weight matrix at once,
+# which bounds the size of the dense (pixel x time) block held in memory
+TIME_BLOCK_SIZE = 12
+
+# crops with production data in `spam-crop-production.zarr` and an extent in `vector/{crop}.parquet`
+CROPS = ['barley', 'cocoa', 'coffee', 'cotton', 'maize', 'rice', 'soybean', 'sugarcane', 'wheat']
+
+# the columns of the regional timeseries table shown and downloaded in the app
+SERIES_COLUMNS = [
+    'country',
+    'states',
+    'crop',
+    'type',
+    'window',
+    'time',
+    'percentile',
+    '5%',
+    '20%',
+    '80%',
+    '95%',
+]
+
+# the types of those columns in the downloaded Parquet and Arrow files, which do not depend on the rows,
+# like an empty table or historical data without uncertainty bounds
+SERIES_SCHEMA = pa.schema(
+    [
+        ('country', pa.string()),
+        ('states', pa.string()),
+        ('crop', pa.string()),
+        ('type', pa.string()),
+        ('window', pa.int64()),
+        ('time', pa.date32()),
+        ('percentile', pa.float64()),
+        ('5%', pa.float64()),
+        ('20%', pa.float64()),
+        ('80%', pa.float64()),
+        ('95%', pa.float64()),
+    ]
+)
+
+
+def rasterize_regions(
+    ds: xr.Dataset, countries: gpd.GeoDataFrame, states: gpd.GeoDataFrame
+) -> xr.Dataset:
+    """
+    Rasterize every country and state onto the water balance grid so that the app can look up
+    the pixels of a selection instead of clipping the global data on every request.
+
+    Each region (a country with state 'All', or a single state including CONUS) is stored as a
+    list of flat pixel indices (y * width + x) using the same `all_touched=True` rule as `rio.clip`.
+    Because regions overlap (borders, CONUS and the US states), the pixel lists are stored in a
+    compressed form: the pixels of region `i` are `region_pixel[region_offset[i]:region_offset[i + 1]]`.
+    Two integer label rasters (`country_label` and `state_label`) are stored as well; they assign each
+    pixel center to at most one region and point into the same region dimension (-1 for no region).
+
+    Parameters:
+        ds(xarray.core.dataset.Dataset): a Xarray Dataset on the water balance grid with dims (y, x)
+
+        countries(geopandas.GeoDataFrame): country boundaries with at least the columns (name, geometry)
+
+        states(geopandas.GeoDataFrame): state boundaries with at least the columns (name, country, geometry)
+
+    Returns:
+        regions(xarray.core.dataset.Dataset): the region index on the same grid as the input Dataset
+    """
+    transform = ds.rio.transform()
+    height = ds.sizes['y']
+    width = ds.sizes['x']
+
+    region_country = countries.name.tolist() + states.country.tolist()
+    region_state = ['All'] * len(countries) + states.name.tolist()
+    geometries = countries.geometry.tolist() + states.geometry.tolist()
+
+    offsets = [0]
+    pixels = []
+    for geometry in geometries:
+        # only rasterize the window of the grid that covers the geometry
+        xmin, ymin, xmax, ymax = geometry.bounds
+        cols, rows = ~transform * (
+            np.array([xmin, xmax, xmin, xmax]),
+            np.array([ymin, ymin, ymax, ymax]),
+        )
+        col_start = max(int(np.floor(cols.min())) - 1, 0)
+        col_stop = min(int(np.ceil(cols.max())) + 1, width)
+        row_start = max(int(np.floor(rows.min())) - 1, 0)
+        row_stop = min(int(np.ceil(rows.max())) + 1, height)
+
+        if col_start >= col_stop or row_start >= row_stop:
+            offsets.append(offsets[-1])
+            continue
+
+        mask = rasterio.features.geometry_mask(
+            [geometry],
+            out_shape=(row_stop - row_start, col_stop - col_start),
+            transform=transform * transform.translation(col_start, row_start),
+            all_touched=True,
+            invert=True,
+        )
+        row, col = np.nonzero(mask)
+        region_pixels = (row + row_start).astype('int64') * width + (col + col_start)
+        pixels.append(region_pixels)
+        offsets.append(offsets[-1] + len(region_pixels))
+
+    # label rasters only use pixel centers, so each pixel belongs to one country and one state
+    # CONUS is left out of the state labels because it overlaps the lower 48 states
+    country_label = rasterio.features.rasterize(
+        [(geometry, idx) for idx, geometry in enumerate(countries.geometry)],
+        out_shape=(height, width),
+        transform=transform,
+        fill=-1,
+        dtype='int32',
+    )
+    state_label = rasterio.features.rasterize(
+        [
+            (geometry, len(countries) + idx)
+            for idx, (name, geometry) in enumerate(zip(states.name, states.geometry))
+            if name != 'CONUS'
+        ],
+        out_shape=(height, width),
+        transform=transform,
+        fill=-1,
+        dtype='int32',
+    )
+
+    regions = xr.Dataset(
+        {
+            'country_label': (('y', 'x'), country_label),
+            'state_label': (('y', 'x'), state_label),
+            'region_country': ('region', np.array(region_country, dtype=str)),
+            'region_state': ('region', np.array(region_state, dtype=str)),
+            'region_offset': ('region_edge', np.array(offsets, dtype='int64')),
+            'region_pixel': (
+                'member',
+                np.concatenate(pixels) if len(pixels) > 0 else np.array([], dtype='int64'),
+            ),
+        },
+        coords={'y': ds.y.values, 'x': ds.x.values},
+    )
+    regions.rio.write_crs(4326, inplace=True)
+
+    return regions
+
+
+def grid_mask(ds: xr.Dataset, geometries: gpd.GeoSeries) -> np.ndarray:
+    """
+    Rasterize geometries (for example a crop extent) onto the grid of a Dataset.
+
+    Parameters:
+        ds(xarray.core.dataset.Dataset): a Xarray Dataset with dims (y, x), which can be a window of the grid
+
+        geometries(geopandas.GeoSeries): the geometries to rasterize
+
+    Returns:
+        mask(numpy.ndarray): a boolean array with dims (y, x), using `all_touched=True`
+    """
+    # only rasterize the parts of the geometries that overlap the grid
+    geometries = geometries.clip_by_rect(*ds.rio.bounds())
+    geometries = geometries[~geometries.is_empty]
+    if len(geometries) == 0:
+        return np.zeros((ds.sizes['y'], ds.sizes['x']), dtype=bool)
+
+    return rasterio.features.geometry_mask(
+        geometries,
+        out_shape=(ds.sizes['y'], ds.sizes['x']),
+        transform=ds.rio.transform(),
+        all_touched=True,
+        invert=True,
+    )
+
+
+def region_weights(regions: xr.Dataset) -> tuple[scipy.sparse.csr_matrix, pd.DataFrame]:
+    """
+    Create an unweighted (region x pixel) matrix from the region index written by the data pipeline.
+
+    Parameters:
+        regions(xarray.core.dataset.Dataset): the region index created by `rasterize_regions`
+
+    Returns:
+        weights(scipy.sparse.csr_matrix): a matrix with a weight of 1 for every pixel in a region
+
+        index(pandas.DataFrame): the (country, state, crop) of each row, where crop is 'none'
+    """
+    offsets = regions.region_offset.values
+    pixels = regions.region_pixel.values
+    npixels = regions.sizes['y'] * regions.sizes['x']
+
+    weights = scipy.sparse.csr_matrix(
+        (np.ones(len(pixels)), pixels, offsets),
+        shape=(len(offsets) - 1, npixels),
+    )
+    index = pd.DataFrame(
+        {
+            'country': regions.region_country.values.astype(str),
+            'state': regions.region_state.values.astype(str),
+            'crop': 'none',
+        }
+    )
+
+    return weights, index
+
+
+def crop_weights(
+    regions: xr.Dataset,
+    production: xr.DataArray,
+    crop: str,
+    extent: None | gpd.GeoDataFrame = None,
+    selection: None | np.ndarray = None,
+) -> tuple[scipy.sparse.csr_matrix, pd.DataFrame]:
+    """
+    Create a production-weighted (region x pixel) matrix for a single crop.
+
+    Each region keeps the pixels where the crop is produced (and, if given, that touch the crop extent),
+    weighted by crop production. The weighted mean of a region is then the production-weighted mean of
+    the water balance over the pixels where the crop is grown.
+
+    Parameters:
+        regions(xarray.core.dataset.Dataset): the region index created by `rasterize_regions`
+
+        production(xarray.DataArray): crop production with dims (y, x), from `load_crop_production_raster`
+
+        crop(str): the lowercase crop name used in the index
+
+        extent(geopandas.GeoDataFrame): an optional crop extent from `load_crop_extent_vector`
+
+        selection(numpy.ndarray): optional positions of the regions to keep, all regions by default
+
+    Returns:
+        weights(scipy.sparse.csr_matrix): a matrix with the production of every pixel in a region
+
+        index(pandas.DataFrame): the (country, state, crop) of each row
+    """
+    weights, index = region_weights(regions)
+    if selection is not None:
+        weights = weights[selection]
+        index = index.iloc[selection].reset_index(drop=True)
+
+    pixels = np.unique(weights.indices)
+    pixel_production = np.zeros(weights.shape[1])
+
+    if len(pixels) > 0:
+        # production and the crop extent are only read and rasterized in the window that contains the regions
+        rows, cols = np.divmod(pixels, regions.sizes['x'])
+        row_start, col_start = rows.min(), cols.min()
+        window = regions.isel(
+            y=slice(row_start, rows.max() + 1), x=slice(col_start, cols.max() + 1)
+        )
+
+        # the production raster is expected to be on the water balance grid,
+        # but its coordinates may be stored in a different order
+        window_production = production.sel(y=window.y, x=window.x, method='nearest').values
+        window_production = np.nan_to_num(window_production.astype('float64'), nan=0.0)
+
+        if extent is not None:
+            window_production = window_production * grid_mask(window, extent.geometry)
+
+        pixel_production[pixels] = window_production[rows - row_start, cols - col_start]
+
+    weights = (weights @ scipy.sparse.diags(pixel_production)).tocsr()
+    weights.eliminate_zeros()
+    index['crop'] = crop
+
+    return weights, index
+
+
+def stack_weights(
+    weights: list[tuple[scipy.sparse.csr_matrix, pd.DataFrame]],
+) -> tuple[scipy.sparse.csr_matrix, pd.DataFrame]:
+    """
+    Stack several weight matrices (for example, unweighted regions and each crop) into one.
+    """
+    matrix = scipy.sparse.vstack([matrix for matrix, _ in weights], format='csr')
+    index = pd.concat([index for _, index in weights], ignore_index=True)
+
+    return matrix, index
+
+
+def aggregate(weights: scipy.sparse.csr_matrix, da: xr.DataArray) -> np.ndarray:
+    """
+    Calculate the weighted mean of every region for every time step.
+
+    Pixels without data (NaN) are left out of the mean of that time step, which matches
+    `da.mean(dim=['x', 'y'])` on clipped data for unweighted regions.
+
+    Parameters:
+        weights(scipy.sparse.csr_matrix): a (region x pixel) matrix on the grid of the DataArray
+
+        da(xarray.DataArray): water balance data with dims (time, y, x), either decoded or opened
+            with `mask_and_scale=False`
+
+    Returns:
+        means(numpy.ndarray): an array with dims (region, time), NaN where a region has no data
+    """
+    # the shape of the chunks that the data is stored in, if it was read from a Zarr store
+    stored = dict(zip(da.dims, da.encoding['chunks'])) if 'chunks' in da.encoding else None
+
+    da = da.transpose('time', 'y', 'x')
+    ntime = da.sizes['time']
+
+    # only read the pixels that are part of at least one region
+    pixels = np.unique(weights.indices)
+    if len(pixels) == 0:
+        return np.full((weights.shape[0], ntime), np.nan)
+    weights = weights[:, pixels]
+
+    # and only read the window of the grid that contains those pixels,
+    # so lazily opened data only reads the chunks that intersect the regions
+    rows, cols = np.divmod(pixels, da.sizes['x'])
+    row_start, col_start = rows.min(), cols.min()
+    window = da.isel(y=slice(row_start, rows.max() + 1), x=slice(col_start, cols.max() + 1))
+    rows = rows - row_start
+    cols = cols - col_start
+    nrows = window.sizes['y']
+
+    if stored is not None and stored['time'] >= ntime > TIME_BLOCK_SIZE:
+        # data in the series layout has every time step of a tile in one chunk, so reading blocks of
+        # time steps would read every chunk again for each block. It is read in bands of tile rows instead
+        row_chunk = stored['y']
+        time_step = ntime
+        bands = [0, *range(row_chunk - row_start % row_chunk, nrows, row_chunk), nrows]
+    else:
+        time_step = TIME_BLOCK_SIZE
+        bands = [0, nrows]
+
+    total = np.zeros((weights.shape[0], ntime))
+    count = np.zeros((weights.shape[0], ntime))
+
+    for band_start, band_stop in zip(bands[:-1], bands[1:]):
+        in_band = (rows >= band_start) & (rows < band_stop)
+        if not in_band.any():
+            continue
+        band = window.isel(y=slice(band_start, band_stop))
+        band_weights = weights[:, in_band]
+        band_rows = rows[in_band] - band_start
+        band_cols = cols[in_band]
+
+        for start in range(0, ntime, time_step):
+            stop = min(start + time_step, ntime)
+            # compactly stored data (see `encoding.py`) is only decoded for the pixels of the regions
+            block = band.isel(time=slice(start, stop)).values
+            values = decode_values(block[:, band_rows, band_cols], da.attrs, 'float64').T
+
+            valid = np.isfinite(values)
+            total[:, start:stop] += band_weights @ np.where(valid, values, 0.0)
+            count[:, start:stop] += band_weights @ valid.astype('float64')
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(count > 0, total / count, np.nan)
+
+    return means
+
+
+def regional_series(
+    ds: xr.Dataset,
+    weights: scipy.sparse.csr_matrix,
+    index: pd.DataFrame,
+    variables: None | list[str] = None,
+) -> xr.Dataset:
+    """
+    Calculate the regional timeseries of every region in a weight matrix.
+
+    Parameters:
+        ds(xarray.core.dataset.Dataset): water balance data with dims (time, y, x),
+            for example from `load_historical_wb` or `load_forecast_wb`
+
+        weights(scipy.sparse.csr_matrix): a (region x pixel) matrix on the grid of the Dataset
+
+        index(pandas.DataFrame): the (country, state, crop) of each row of the weight matrix
+
+        variables(list): the data variables to aggregate, all of them by default
+
+    Returns:
+        series(xarray.core.dataset.Dataset): a Dataset with dims (region, time), where region is indexed
+            by (country, state, crop) so that a single series can be selected with `.sel()`
+    """
+    if weights.shape[1] != ds.sizes['y'] * ds.sizes['x']:
+        raise ValueError('The weight matrix and the dataset are not on the same grid.')
+
+    if variables is None:
+        variables = [name for name in ds.data_vars if set(ds[name].dims) == {'time', 'y', 'x'}]
+
+    series = xr.Dataset(
+        {name: (('region', 'time'), aggregate(weights, ds[name])) for name in variables},
+        coords={
+            'time': ds.time.values,
+            'country': ('region', index.country.values),
+            'state': ('region', index.state.values),
+            'crop': ('region', index.crop.values),
+        },
+    )
+
+    return series.set_index(region=['country', 'state', 'crop'])
+
+
+def series_to_dataframe(series: xr.Dataset, kind: str, window: int | str) -> pd.DataFrame:
+    """
+    Convert regional timeseries into the table shown in the app.
+
+    Parameters:
+        series(xarray.core.dataset.Dataset): a Dataset with dims (region, time) from `regional_series`
+
+        kind(str): either 'historical' or 'forecast'
+
+        window(int): the integration window in months
+
+    Returns:
+        df(pandas.DataFrame): a table with the columns in `SERIES_COLUMNS`,
+            without the regions that have no data at all
+    """
+    df = series.to_dataframe().reset_index()
+    df = df.drop(columns=[column for column in ['region', 'spatial_ref'] if column in df.columns])
+    df = df.rename(columns={'state': 'states', 'perc': 'percentile'})
+
+    # the historical data does not have uncertainty bounds
+    for column in ['percentile', '5%', '20%', '80%', '95%']:
+        if column not in df.columns:
+            df[column] = np.nan
+        df[column] = df[column].astype(float).round(4)
+
+    has_data = df.groupby(['country', 'states', 'crop'])['percentile'].transform(
+        lambda values: values.notnull().any()
+    )
+    df = df[has_data].copy()
+
+    df['time'] = pd.to_datetime(df['time']).dt.date
+    df['type'] = kind
+    df['window'] = int(window)
+
+    return df[SERIES_COLUMNS].reset_index(drop=True)
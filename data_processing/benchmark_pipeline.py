@@ -0,0 +1,211 @@
+"""
+Benchmark the stages of the data pipeline against synthetic inputs in a local directory.
+
+Synthetic ERA5 inputs are written with `synthetic_data.py` (unless they are already there), and each
+stage runs in a fresh process, so that the peak memory it reports is its own:
+
+    open_files_in_parallel   open every monthly file of the H3 data
+    process_dataset          process the concatenated months and compute every chunk of them
+    write_analysis_store     write the Zarr store used for analysis
+    pyramid_to_zarr          write the Zarr pyramid used for visualization from the analysis store
+
+For every stage this reports the wall time, the throughput in MiB of (uncompressed) data per second,
+and the peak resident memory of its process, which includes about the memory of the imports.
+
+    python benchmark_pipeline.py --resolution 0.5 --months 120 --json results.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import timeit
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import xarray as xr
+
+from drought_to_zarr import (
+    BASELINE,
+    historical_files,
+    open_files_in_parallel,
+    process_dataset,
+    save_pyramid,
+    store_format,
+    write_analysis_store,
+)
+from synthetic_data import write_synthetic_inputs
+
+# the release that the synthetic inputs are written for
+RELEASE = '2026-07-01'
+
+
+def open_stage(files: list) -> tuple[float, int]:
+    """
+    Time `open_files_in_parallel`, and return the time and the number of bytes of the opened data.
+    """
+    start = timeit.default_timer()
+    ds_list = open_files_in_parallel(files)
+
+    return timeit.default_timer() - start, sum(ds.nbytes for ds in ds_list)
+
+
+def process_stage(files: list) -> tuple[float, int]:
+    """
+    Time `process_dataset` and computing every chunk of its output, which reads every file.
+    """
+    ds = xr.concat(open_files_in_parallel(files), dim='time')
+
+    start = timeit.default_timer()
+    ds = process_dataset(ds)
+    ds.perc.sum().compute()
+
+    return timeit.default_timer() - start, ds.nbytes
+
+
+def analysis_stage(files: list, path: str, dtype: str, options: dict) -> tuple[float, int]:
+    """
+    Time `write_analysis_store` for the processed months.
+    """
+    ds = process_dataset(xr.concat(open_files_in_parallel(files), dim='time'))
+
+    start = timeit.default_timer()
+    write_analysis_store(ds, path, dtype, {}, options)
+
+    return timeit.default_timer() - start, ds.nbytes
+
+
+def pyramid_stage(store_path: str, path: str, options: dict) -> tuple[float, int]:
+    """
+    Time writing the pyramid of an analysis store with `pyramid_to_zarr`.
+    """
+    start = timeit.default_timer()
+    # historical pyramids are written with a chunk for every month, like in the pipeline
+    save_pyramid(store_path, path, {'baseline': BASELINE, **options}, options, None)
+
+    return timeit.default_timer() - start, xr.open_zarr(store_path).nbytes
+
+
+def run_in_process(function: callable, *args) -> tuple[float, int, int]:
+    """
+    Run a stage in its own process and return its wall time, the number of bytes it processed,
+    and the peak resident memory of the process in bytes.
+    """
+    seconds, nbytes = function(*args)
+    # the maximum resident set size is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return seconds, nbytes, peak
+
+
+def benchmark(
+    root: str, resolution: float, months: int, dtype: str, options: dict, seed: int = 0
+) -> pd.DataFrame:
+    """
+    Run every stage against synthetic inputs in a directory.
+
+    Parameters:
+        root(str): the local directory of the synthetic inputs and of the Zarr stores that are written
+
+        resolution(float): the size of a pixel in degrees
+
+        months(int): the number of historical months
+
+        dtype(str): how the percentiles are stored in the analysis store
+
+        options(dict): the arguments of `store_format`, for how the Zarr stores are written
+
+        seed(int): the seed of the synthetic data
+
+    Returns:
+        results(pandas.DataFrame): the wall time, throughput, and peak memory of every stage
+    """
+    inputs = os.path.join(root, 'inputs')
+    marker = os.path.join(inputs, 'synthetic.json')
+    settings = {'resolution': resolution, 'months': months, 'seed': seed}
+
+    written = None
+    if os.path.exists(marker):
+        with open(marker) as f:
+            written = json.load(f)
+
+    # the inputs are only written again if they were written with other settings
+    if written != settings:
+        print('Writing synthetic inputs...')
+        shutil.rmtree(inputs, ignore_errors=True)
+        write_synthetic_inputs(inputs, resolution, months, RELEASE, seed)
+        with open(marker, 'w') as f:
+            json.dump(settings, f)
+
+    dates = pd.date_range(end=RELEASE, periods=months, freq='MS')
+    files = list(historical_files(inputs, 3, dates).values())
+    store_path = os.path.join(root, 'zarr', 'analysis', 'wb-h3.zarr')
+    pyramid_path = os.path.join(root, 'zarr', 'viz', 'wb-h3.zarr')
+    options = store_format(**options)
+
+    stages = {
+        'open_files_in_parallel': (open_stage, files),
+        'process_dataset': (process_stage, files),
+        'write_analysis_store': (analysis_stage, files, store_path, dtype, options),
+        'pyramid_to_zarr': (pyramid_stage, store_path, pyramid_path, options),
+    }
+
+    rows = []
+    for name, (function, *args) in stages.items():
+        print(f'Running {name}...')
+        # processes are spawned, so that every stage starts from the memory of a new process
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            seconds, nbytes, peak = executor.submit(run_in_process, function, *args).result()
+
+        rows.append(
+            {
+                'stage': name,
+                'wall (s)': seconds,
+                'MiB': nbytes / 1024**2,
+                'MiB/s': nbytes / 1024**2 / seconds,
+                'peak RSS (MiB)': peak / 1024**2,
+            }
+        )
+
+    return pd.DataFrame(rows).set_index('stage')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument(
+        '--root',
+        help='the directory of the synthetic inputs and outputs, which are kept and reused if it is given '
+        '(a temporary directory by default)',
+    )
+    parser.add_argument(
+        '--resolution', type=float, default=1.0, help='the size of a pixel in degrees'
+    )
+    parser.add_argument('--months', type=int, default=120, help='the number of historical months')
+    parser.add_argument('--dtype', choices=['uint16', 'float32', 'float64'], default='uint16')
+    parser.add_argument('--zarr-format', type=int, choices=[2, 3], default=2)
+    parser.add_argument('--compressor', choices=['default', 'zstd', 'blosc'], default='default')
+    parser.add_argument('--shard-time', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    options = {
+        'zarr_format': args.zarr_format,
+        'compressor': args.compressor,
+        'shard_time': args.shard_time,
+    }
+    root = args.root or tempfile.mkdtemp()
+    try:
+        results = benchmark(root, args.resolution, args.months, args.dtype, options)
+    finally:
+        if args.root is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print()
+    print(f'{args.months} months at {args.resolution} degrees, {args.dtype} percentiles, {options}')
+    print(results.round(2).to_string())
+
+    if args.json:
+        results.reset_index().to_json(args.json, orient='records', indent=2)
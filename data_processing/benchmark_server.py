@@ -0,0 +1,510 @@
+"""
+Benchmark the logic that the app runs for a selection against synthetic global data in a local directory.
+
+The pipeline writes the Zarr stores, the region index, and (unless `--no-series-table` is passed)
+the regional timeseries table of the synthetic inputs from `synthetic_data.py` into a directory with
+the layout of the bucket, along with synthetic boundaries, crop extents, and crop production. The app
+then reads them through `DATA_ROOT` in a fresh process, and every selection of a matrix of regions
+(a tiny state, a mid-sized country, Russia across the antimeridian, and CONUS), crops, and integration
+windows goes through the functions of `app/views.py` that the server calls:
+
+    select_region         update_wb_data, with the cache of clipped forecasts and timeseries cleared
+    series_table          update_dataframe, with both the historical and forecast data shown
+    timeseries_figure     the figure of timeseries, from the default date of the time slider
+    timeseries_png        the PNG file of timeseries at 100 dpi
+    render_timeseries     timeseries, with the cache of rendered figures cleared, and then from the cache
+    forecast_map_figure   the figure of update_forecast_map
+    forecast_map_payload  update_forecast_map, with the cache of forecast maps cleared, and then from the cache
+    forecast_frame_png    forecast_frame, for every forecast month of the map
+    timeseries_png        download_timeseries_link at 300 dpi (as timeseries_png 300 dpi)
+    table_csv             download_csv_link
+
+The data is loaded before any selection is timed, like the app does in the background when it starts.
+For every selection and function this reports the 50th, 95th, and 99th percentiles of the wall time,
+and the peak memory that Python and NumPy allocate while it runs (measured in a separate run with
+tracemalloc, which slows the code down).
+
+    python benchmark_server.py --resolution 0.5 --repeats 20 --json results.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+import xarray as xr
+
+from drought_to_zarr import (
+    BASELINE,
+    forecast_file,
+    historical_files,
+    open_analysis_store,
+    run_stages,
+    save_forecast_store,
+    save_historical_store,
+    save_region_index,
+    save_series_table,
+    store_format,
+)
+from synthetic_data import write_synthetic_inputs
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'app'))
+import utils  # isort: skip  # noqa: E402
+import views  # isort: skip  # noqa: E402
+from zonal import CROPS  # isort: skip  # noqa: E402
+
+# the release that the app reads, which the synthetic inputs are written for
+RELEASE = f'{utils.year_ic}-{utils.month_ic}-01'
+
+# the synthetic boundaries, with about the extent of the real ones
+COUNTRIES = {
+    'Germany': shapely.box(5.9, 47.3, 15.0, 55.1),
+    'Russia': shapely.MultiPolygon(
+        [shapely.box(27.3, 41.2, 180.0, 77.7), shapely.box(-180.0, 64.3, -169.0, 71.5)]
+    ),
+    'United States of America': shapely.MultiPolygon(
+        [
+            shapely.box(-124.7, 25.1, -67.0, 49.4),
+            shapely.box(-168.1, 54.6, -141.0, 71.4),
+            shapely.box(172.4, 51.7, 180.0, 53.0),
+        ]
+    ),
+}
+STATES = {
+    ('Saarland', 'Germany'): shapely.box(6.4, 49.1, 7.4, 49.6),
+    ('Bavaria', 'Germany'): shapely.box(9.0, 47.3, 13.8, 50.6),
+    ('CONUS', 'United States of America'): shapely.box(-124.7, 25.1, -67.0, 49.4),
+}
+
+# the regions of the benchmark as (country, state)
+REGIONS = {
+    'tiny state': ('Germany', 'Saarland'),
+    'mid country': ('Germany', 'All'),
+    'Russia': ('Russia', 'All'),
+    'CONUS': ('United States of America', 'CONUS'),
+}
+
+
+# the size of the timeseries figure in inches, about its size in the app on a laptop screen
+FIGSIZE = (9, 4)
+
+
+def write_synthetic_bucket(
+    root: str, resolution: float, months: int, dtype: str, options: dict, seed: int
+) -> None:
+    """
+    Write everything that the app reads for a release into a directory with the layout of the bucket.
+
+    Parameters:
+        root(str): the local directory that stands in for the root of the bucket
+
+        resolution(float): the size of a pixel in degrees
+
+        months(int): the number of historical months
+
+        dtype(str): how the percentiles are stored in the analysis stores
+
+        options(dict): how the Zarr stores are written, see `store_format`
+
+        seed(int): the seed of the synthetic data
+
+    Returns:
+        None
+    """
+    # the regions are on land, so that there is always data to show for them
+    write_synthetic_inputs(
+        root, resolution, months, RELEASE, seed, list(COUNTRIES.values()) + list(STATES.values())
+    )
+    dates = pd.date_range(end=RELEASE, periods=months, freq='MS')
+
+    vector = os.path.join(root, 'vector')
+    os.makedirs(vector, exist_ok=True)
+    countries = gpd.GeoDataFrame(
+        {
+            'name': list(COUNTRIES),
+            'bbox': [json.dumps(list(geometry.bounds)) for geometry in COUNTRIES.values()],
+        },
+        geometry=list(COUNTRIES.values()),
+        crs=4326,
+    )
+    states = gpd.GeoDataFrame(
+        {
+            'name': [name for name, _ in STATES],
+            'country': [country for _, country in STATES],
+            'bbox': [json.dumps(list(geometry.bounds)) for geometry in STATES.values()],
+        },
+        geometry=list(STATES.values()),
+        crs=4326,
+    )
+    countries.to_parquet(os.path.join(vector, 'countries.parquet'))
+    states.to_parquet(os.path.join(vector, 'states.parquet'))
+
+    # every crop extent is made of many strips (like the many polygons of the real extents),
+    # which leave gaps of a degree between them at a different longitude for every crop
+    rng = np.random.default_rng(seed)
+    for crop in CROPS:
+        offset = rng.uniform(0, 5)
+        extent = shapely.MultiPolygon(
+            [
+                shapely.box(xmin, rng.uniform(-60, -20), xmin + 4, rng.uniform(50, 75))
+                for xmin in np.arange(-185 + offset, 180, 5)
+            ]
+        ).intersection(shapely.box(-180, -90, 180, 90))
+        gpd.GeoDataFrame(geometry=[extent], crs=4326).to_parquet(
+            os.path.join(vector, f'{crop}.parquet')
+        )
+
+    analysis = os.path.join(root, 'zarr', 'analysis')
+    store_paths = {
+        dataset: os.path.join(analysis, f'wb-{dataset}-{RELEASE}.zarr')
+        for dataset in ['h3', 'h12', 'f3', 'f12']
+    }
+    regions_path = os.path.join(analysis, f'regions-{RELEASE}.zarr')
+    store_attrs = {'baseline': BASELINE, 'percentile_dtype': dtype, **options}
+
+    stages = {}
+    for window in [3, 12]:
+        stages[f'H{window} analysis store'] = (
+            save_historical_store,
+            (
+                historical_files(root, window, dates),
+                store_paths[f'h{window}'],
+                dtype,
+                store_attrs,
+                options,
+                None,
+            ),
+            [],
+        )
+        stages[f'F{window} analysis store'] = (
+            save_forecast_store,
+            (forecast_file(root, window, RELEASE), store_paths[f'f{window}'], dtype, {}, options),
+            [],
+        )
+    stages['region index'] = (
+        save_region_index,
+        (
+            store_paths['h3'],
+            os.path.join(vector, 'countries.parquet'),
+            os.path.join(vector, 'states.parquet'),
+            regions_path,
+            options,
+        ),
+        ['H3 analysis store'],
+    )
+    run_stages(stages, workers=1)
+
+    # the crop production is on the grid of the analysis stores, and only where there is land
+    grid = open_analysis_store(store_paths['h3']).perc.isel(time=-1)
+    land = grid.notnull().values
+    production = xr.Dataset(
+        {
+            'production': (
+                ('crop', 'y', 'x'),
+                rng.gamma(0.5, 1000, (len(CROPS), *land.shape)) * land,
+            )
+        },
+        coords={'crop': CROPS, 'y': grid.y.values, 'x': grid.x.values},
+    )
+    production.to_zarr(
+        os.path.join(root, 'zarr', 'spam-crop-production.zarr'), consolidated=True, mode='w'
+    )
+
+
+def percentiles(times: list) -> dict:
+    """
+    Return the 50th, 95th, and 99th percentiles of a list of times in milliseconds.
+    """
+    p50, p95, p99 = np.percentile(1000 * np.array(times), [50, 95, 99])
+    return {'p50 (ms)': p50, 'p95 (ms)': p95, 'p99 (ms)': p99}
+
+
+def run_selection(selection: tuple, start_date: str, measure: callable) -> bool:
+    """
+    Run every function that the app runs for a selection, in the same order and with the same arguments.
+
+    Parameters:
+        selection(tuple): the (country, state, crop, window) of the selection
+
+        start_date(str): the date that the timeseries figure starts from
+
+        measure(callable): called as `measure(name, function, *args)`, which returns `function(*args)`
+
+    Returns:
+        shown(bool): whether there was data to show for the selection
+    """
+    country, state, crop, window = selection
+
+    # the clipped forecasts and timeseries are cached for every session, so the cache is cleared
+    # to calculate the selection again, like the first time that any user makes it
+    utils.reduce_selection.cache_clear()
+    utils.load_regional_series.cache_clear()
+    views.render_timeseries.cache_clear()
+    views.forecast_map_payload.cache_clear()
+
+    forecast, series = measure('select_region', views.select_region, *selection)
+    if series is None:
+        return False
+
+    df = measure('series_table', views.series_table, series, True, True)
+    fig = measure('timeseries_figure', views.timeseries_figure, df, True, True, start_date, FIGSIZE)
+    measure('timeseries_png', views.timeseries_png, fig, 100)
+    args = (*selection, True, True, start_date, FIGSIZE[0] * 100, FIGSIZE[1] * 100, 100)
+    measure('render_timeseries', views.render_timeseries, *args)
+    measure('render_timeseries cached', views.render_timeseries, *args)
+    frame_urls = [
+        views.forecast_frame_url(*selection, month) for month in range(forecast.sizes['time'])
+    ]
+    measure('forecast_map_figure', views.forecast_map_figure, forecast, frame_urls)
+    measure('forecast_map_payload', views.forecast_map_payload, *selection)
+    measure('forecast_map_payload cached', views.forecast_map_payload, *selection)
+    for month in range(forecast.sizes['time']):
+        measure('forecast_frame_png', views.forecast_frame_png, forecast, month)
+    fig = views.timeseries_figure(df, True, True, start_date, FIGSIZE)
+    title = views.timeseries_title(country, state, crop, window)
+    measure('timeseries_png 300 dpi', views.timeseries_png, fig, 300, title)
+    measure('table_csv', views.table_csv, df)
+
+    return True
+
+
+def benchmark_selections(selections: dict, repeats: int) -> list[dict]:
+    """
+    Time every function of every selection, and measure the memory they allocate.
+    This runs in its own process, which reads the synthetic data through `DATA_ROOT`.
+
+    Parameters:
+        selections(dict): the (country, state, crop, window) of each selection, keyed by a label
+
+        repeats(int): the number of times every selection is timed
+
+    Returns:
+        rows(list): the latency percentiles and peak allocated memory of every selection and function
+    """
+    # the time slider of the app starts at the first month of the last five years
+    start_date = f'{int(utils.historical_dates[-1][:4]) - 4}-01-01'
+
+    def untimed(name: str, function: callable, *args):
+        return function(*args)
+
+    rows = []
+    for label, selection in selections.items():
+        # the first run loads the data, like the app does in the background when it starts
+        if not run_selection(selection, start_date, untimed):
+            print(f'    No data to show for {label}')
+            continue
+
+        times = {}
+
+        def timed(name: str, function: callable, *args):
+            start = timeit.default_timer()
+            result = function(*args)
+            times.setdefault(name, []).append(timeit.default_timer() - start)
+            return result
+
+        for _ in range(repeats):
+            run_selection(selection, start_date, timed)
+
+        peaks = {}
+
+        def traced(name: str, function: callable, *args):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            result = function(*args)
+            peaks[name] = tracemalloc.get_traced_memory()[1] - current
+            return result
+
+        tracemalloc.start()
+        run_selection(selection, start_date, traced)
+        tracemalloc.stop()
+
+        print(f'    {label}: {1000 * sum(map(sum, times.values())) / repeats:.0f} ms')
+        for name, values in times.items():
+            rows.append(
+                {
+                    'selection': label,
+                    'function': name,
+                    **percentiles(values),
+                    'peak alloc (MiB)': peaks[name] / 1024**2,
+                }
+            )
+
+    return rows
+
+
+def benchmark(
+    root: str,
+    resolution: float,
+    months: int,
+    dtype: str,
+    options: dict,
+    crops: list,
+    repeats: int,
+    load_mode: str = 'eager',
+    series_table: bool = True,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Run every selection of the matrix of regions, crops, and windows against synthetic data in a directory.
+
+    Parameters:
+        root(str): the local directory of the synthetic data, which stands in for the root of the bucket
+
+        resolution(float): the size of a pixel in degrees
+
+        months(int): the number of historical months
+
+        dtype(str): how the percentiles are stored in the analysis stores
+
+        options(dict): the arguments of `store_format`, for how the Zarr stores are written
+
+        crops(list): the crops of the matrix, where 'none' is the whole region
+
+        repeats(int): the number of times every selection is timed
+
+        load_mode(str): how the app loads the water balance data, 'eager', 'lazy', or 'shared'
+
+        series_table(bool): whether the app reads the timeseries from the regional timeseries table,
+            or calculates them from the water balance data
+
+        seed(int): the seed of the synthetic data
+
+    Returns:
+        results(pandas.DataFrame): the latency percentiles and peak allocated memory of every
+            selection and function
+    """
+    marker = os.path.join(root, 'synthetic.json')
+    options = store_format(**options)
+    settings = {
+        'resolution': resolution,
+        'months': months,
+        'dtype': dtype,
+        'options': options,
+        'seed': seed,
+    }
+
+    written = None
+    if os.path.exists(marker):
+        with open(marker) as f:
+            written = json.load(f)
+
+    # the data is only written again if it was written with other settings
+    if written != settings:
+        print('Writing synthetic data...')
+        for name in ['era5', 'nmme', 'vector', 'zarr', 'tables']:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+        write_synthetic_bucket(root, resolution, months, dtype, options, seed)
+        with open(marker, 'w') as f:
+            json.dump(settings, f)
+
+    analysis = os.path.join(root, 'zarr', 'analysis')
+    table = os.path.join(root, 'tables', f'regional-series-{RELEASE}.parquet')
+    if series_table and not os.path.exists(table):
+        print('Writing the regional timeseries table...')
+        os.makedirs(os.path.dirname(table), exist_ok=True)
+        save_series_table(
+            {
+                dataset: os.path.join(analysis, f'wb-{dataset}-{RELEASE}.zarr')
+                for dataset in ['h3', 'h12', 'f3', 'f12']
+            },
+            os.path.join(analysis, f'regions-{RELEASE}.zarr'),
+            os.path.join(root, 'zarr', 'spam-crop-production.zarr'),
+            {crop: os.path.join(root, 'vector', f'{crop}.parquet') for crop in CROPS},
+            table,
+        )
+    elif not series_table and os.path.exists(table):
+        os.remove(table)
+
+    selections = {
+        f'{region} / {crop} / {window}': (country, state, crop, window)
+        for region, (country, state) in REGIONS.items()
+        for crop in crops
+        for window in ['3', '12']
+    }
+
+    # the app reads its settings when it is imported, so it runs in a new process with these settings
+    os.environ['DATA_ROOT'] = root
+    os.environ['WB_LOAD_MODE'] = load_mode
+    os.environ.pop('DISK_CACHE_DIR', None)
+
+    print('Running selections...')
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        rows = executor.submit(benchmark_selections, selections, repeats).result()
+
+    return pd.DataFrame(rows).set_index(['selection', 'function'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument(
+        '--root',
+        help='the directory of the synthetic data, which is kept and reused if it is given '
+        '(a temporary directory by default)',
+    )
+    parser.add_argument(
+        '--resolution', type=float, default=1.0, help='the size of a pixel in degrees'
+    )
+    parser.add_argument('--months', type=int, default=427, help='the number of historical months')
+    parser.add_argument('--dtype', choices=['uint16', 'float32', 'float64'], default='uint16')
+    parser.add_argument('--zarr-format', type=int, choices=[2, 3], default=2)
+    parser.add_argument('--compressor', choices=['default', 'zstd', 'blosc'], default='default')
+    parser.add_argument('--shard-time', type=int, default=0)
+    parser.add_argument(
+        '--crops',
+        nargs='+',
+        choices=['none'] + CROPS,
+        default=['none', 'maize', 'wheat'],
+        help='the crops of the matrix, where none is the whole region',
+    )
+    parser.add_argument('--load-mode', choices=['eager', 'lazy', 'shared'], default='eager')
+    parser.add_argument(
+        '--no-series-table',
+        action='store_true',
+        help='calculate the timeseries from the water balance data instead of reading them from the table',
+    )
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    options = {
+        'zarr_format': args.zarr_format,
+        'compressor': args.compressor,
+        'shard_time': args.shard_time,
+    }
+    root = args.root or tempfile.mkdtemp()
+    try:
+        results = benchmark(
+            root,
+            args.resolution,
+            args.months,
+            args.dtype,
+            options,
+            args.crops,
+            args.repeats,
+            args.load_mode,
+            not args.no_series_table,
+        )
+    finally:
+        if args.root is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print()
+    print(
+        f'{args.months} months at {args.resolution} degrees, {args.dtype} percentiles, {options}, '
+        f'{args.load_mode} loading, {"without" if args.no_series_table else "with"} the series table'
+    )
+    print(results.round(2).to_string())
+
+    if args.json:
+        results.reset_index().to_json(args.json, orient='records', indent=2)
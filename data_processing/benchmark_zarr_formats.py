@@ -0,0 +1,159 @@
+"""
+Compare the formats that the pipeline can write its Zarr stores for analysis in.
+
+An existing analysis store is re-written in every format, and for each of them this reports the number
+of objects and bytes of the store, how long it took to write, and how long the app takes to open it and
+read a region (a window of the grid over every time step, like a clipped state) or a single month.
+
+    python benchmark_zarr_formats.py \\
+        gs://{BUCKET_NAME}/zarr/analysis/wb-h3-2026-07-01.zarr \\
+        gs://{BUCKET_NAME}/benchmarks/zarr-formats
+
+The stores are written under the second path and removed at the end, unless `--keep` is passed.
+"""
+
+import argparse
+import statistics
+import timeit
+
+import fsspec
+import pandas as pd
+import xarray as xr
+
+from drought_to_zarr import open_analysis_store, store_format, write_analysis_store
+
+# the formats to compare, as the arguments of `store_format`
+FORMATS = {
+    'v2': {},
+    'v2-zstd': {'compressor': 'zstd'},
+    'v3-zstd': {'zarr_format': 3, 'compressor': 'zstd'},
+    'v3-zstd-sharded': {'zarr_format': 3, 'compressor': 'zstd', 'shard_time': 120},
+    'v3-blosc-sharded': {
+        'zarr_format': 3,
+        'compressor': 'blosc',
+        'compression_level': 5,
+        'shard_time': 120,
+    },
+}
+
+
+def read_latency(path: str, repeats: int) -> dict:
+    """
+    Time how long it takes to open a store the way the app does in lazy mode, and to read
+    a window of an eighth of the grid over every time step, or the whole grid of the last month.
+
+    Parameters:
+        path(str): the path of the Zarr store
+
+        repeats(int): the number of times every read is repeated, from which the median is reported
+
+    Returns:
+        latency(dict): the median time of each read in milliseconds
+    """
+    times = {'open (ms)': [], 'region (ms)': [], 'month (ms)': []}
+
+    for _ in range(repeats):
+        start = timeit.default_timer()
+        ds = xr.open_dataset(
+            path,
+            engine='zarr',
+            consolidated=True,
+            decode_coords='all',
+            mask_and_scale=False,
+            cache=False,
+        )
+        times['open (ms)'].append(timeit.default_timer() - start)
+
+        ny, nx = ds.sizes['y'], ds.sizes['x']
+        start = timeit.default_timer()
+        ds.perc[:, ny // 2 : ny // 2 + max(ny // 8, 1), nx // 2 : nx // 2 + max(nx // 8, 1)].values
+        times['region (ms)'].append(timeit.default_timer() - start)
+
+        start = timeit.default_timer()
+        ds.perc[-1].values
+        times['month (ms)'].append(timeit.default_timer() - start)
+
+    return {name: 1000 * statistics.median(values) for name, values in times.items()}
+
+
+def benchmark(source: str, output: str, dtype: str, keep_bits: int, repeats: int, keep: bool):
+    """
+    Re-write an analysis store in every format and print how they compare.
+
+    Parameters:
+        source(str): the path of an analysis store written by the pipeline
+
+        output(str): the path that the stores of every format are written under
+
+        dtype(str): how the percentiles are stored, by default the same way as in the source store
+
+        keep_bits(int): if larger than zero and the percentiles are stored as floats,
+            also compare sharded Zarr v3 stores with bit-rounded percentiles
+
+        repeats(int): the number of times every read is repeated
+
+        keep(bool): whether to keep the written stores
+
+    Returns:
+        None
+    """
+    ds = open_analysis_store(source)
+    dtype = dtype or ds.attrs.get('percentile_dtype', 'float64')
+    # start from one time step per chunk, like the data that the pipeline opens from the monthly files
+    ds = ds.drop_encoding().chunk({'time': 1})
+
+    formats = dict(FORMATS)
+    if keep_bits > 0 and dtype != 'uint16':
+        formats[f'v3-zstd-sharded-{keep_bits}bits'] = {
+            **FORMATS['v3-zstd-sharded'],
+            'keep_bits': keep_bits,
+        }
+
+    fs, _ = fsspec.core.url_to_fs(output)
+    rows = []
+    for name, options in formats.items():
+        print(f'Writing {name}...')
+        path = f'{output.rstrip("/")}/{name}.zarr'
+
+        start = timeit.default_timer()
+        write_analysis_store(ds, path, dtype, {}, store_format(**options))
+        write_time = timeit.default_timer() - start
+
+        rows.append(
+            {
+                'format': name,
+                'objects': len(fs.find(path)),
+                'MiB': fs.du(path) / 1024**2,
+                'write (s)': write_time,
+                **read_latency(path, repeats),
+            }
+        )
+
+        if not keep:
+            fs.rm(path, recursive=True)
+
+    print()
+    print(f'{source} ({dtype} percentiles, {dict(ds.sizes)})')
+    print(pd.DataFrame(rows).set_index('format').round(2).to_string())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('source', help='the path of an analysis store written by the pipeline')
+    parser.add_argument('output', help='the path that the benchmark stores are written under')
+    parser.add_argument(
+        '--dtype',
+        choices=['uint16', 'float32', 'float64'],
+        help='how the percentiles are stored, by default the same way as in the source store',
+    )
+    parser.add_argument(
+        '--keep-bits',
+        type=int,
+        default=14,
+        help='the mantissa bits of the bit-rounded format, which is only compared for float percentiles',
+    )
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--keep', action='store_true', help='keep the written stores')
+    args = parser.parse_args()
+
+    benchmark(args.source, args.output, args.dtype, args.keep_bits, args.repeats, args.keep)
@@ -1,14 +1,86 @@
+import multiprocessing
 import os
+import signal
+import sys
+import threading
+import time
 import timeit
-from concurrent.futures import ThreadPoolExecutor
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path
 
+import dask
+import fsspec
 import gcsfs
+import geopandas as gpd
+import numcodecs
 import numpy as np
 import pandas as pd
+import psutil
 import rioxarray
 import xarray as xr
 import zarr
 from ndpyramid import pyramid_reproject
+from zarr.codecs import BloscCodec, ZstdCodec
+
+# code shared with the app lives in the app directory so that the app container stays self-contained
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'app'))
+from encoding import bit_round, percentile_encoding  # isort: skip  # noqa: E402
+from zonal import (  # isort: skip  # noqa: E402
+    CROPS,
+    crop_weights,
+    rasterize_regions,
+    region_weights,
+    regional_series,
+    series_to_dataframe,
+    stack_weights,
+)
+
+# the baseline period that the water balance percentiles are calculated relative to
+BASELINE = '1991-2020'
+
+ZARR_FORMATS = [2, 3]
+ZARR_COMPRESSORS = ['default', 'zstd', 'blosc']
+
+# Zarr v3 stores are written with consolidated metadata, which every reader of these stores supports
+warnings.filterwarnings('ignore', message='Consolidated metadata is currently not part')
+
+
+def historical_files(root: str, window: int, dates: pd.DatetimeIndex) -> dict:
+    """
+    Return the NetCDF file of every month of historical ERA5 water balance percentiles.
+
+    Parameters:
+        root(str): the root of the bucket (for example 'gs://{BUCKET_NAME}') or of a local copy of it
+
+        window(int): the integration window in months, either 3 or 12
+
+        dates(pandas.DatetimeIndex): the first day of every month
+
+    Returns:
+        files(dict): the path of the file of every month, keyed by date
+    """
+    return {
+        date: f'{root}/era5/monthly/water_balance_hamon_percentiles/era5_water-balance-perc-w{window}_bl-{BASELINE}_mon_{date.strftime("%Y-%m-%d")}.nc'
+        for date in dates
+    }
+
+
+def forecast_file(root: str, window: int, release: str) -> str:
+    """
+    Return the NetCDF file of the NMME ensemble forecast percentiles of a release.
+
+    Parameters:
+        root(str): the root of the bucket (for example 'gs://{BUCKET_NAME}') or of a local copy of it
+
+        window(int): the integration window in months, either 3 or 12
+
+        release(str): the date of the initial conditions, for example '2026-07-01'
+
+    Returns:
+        path(str): the path of the file, with the forecasts of the next six months
+    """
+    return f'{root}/nmme/ensemble/water_balance_hamon_percentiles/nmme_ensemble_water-balance-perc-w{window}_mon_ic-{release}_leads-6.nc'
 
 
 def open_dataset(path: str) -> xr.Dataset:
@@ -61,7 +133,417 @@ def process_dataset(ds: xr.Dataset) -> xr.Dataset:
     return ds
 
 
-def pyramid_to_zarr(ds: xr.Dataset, levels: int, path: str) -> None:
+def store_format(
+    zarr_format: int = 2,
+    compressor: str = 'default',
+    compression_level: int = 3,
+    shard_time: int = 0,
+    keep_bits: int = 0,
+) -> dict:
+    """
+    Describe how the Zarr stores of the pipeline are written. The description is also saved in the
+    attributes of the historical stores and pyramids, so that a release with a different format
+    rebuilds them instead of appending to them.
+
+    Parameters:
+        zarr_format(int): 2, or 3 for Zarr v3 stores, which can be sharded
+
+        compressor(str): 'default' for the default compressor of Zarr, 'zstd' for Zstandard,
+            or 'blosc' for Blosc with Zstandard and byte shuffling
+
+        compression_level(int): the compression level of 'zstd' and 'blosc'
+
+        shard_time(int): for Zarr v3, the number of time steps in each shard (0 for no sharding),
+            so that one object holds many chunks of a single time step instead of one object per chunk
+
+        keep_bits(int): the number of mantissa bits that float percentiles keep (0 for all of them),
+            see `bit_round` in `encoding.py`
+
+    Returns:
+        store_format(dict): the format, which can be passed to the functions that write Zarr stores
+    """
+    if zarr_format not in ZARR_FORMATS:
+        raise ValueError(f'The Zarr format should be one of {ZARR_FORMATS}.')
+    if compressor not in ZARR_COMPRESSORS:
+        raise ValueError(f'The Zarr compressor should be one of {ZARR_COMPRESSORS}.')
+    if shard_time > 0 and zarr_format != 3:
+        raise ValueError('Only Zarr v3 stores can be sharded.')
+
+    return {
+        'zarr_format': zarr_format,
+        'compressor': compressor,
+        'compression_level': compression_level,
+        'shard_time': shard_time,
+        'keep_bits': keep_bits,
+    }
+
+
+def zarr_encoding(ds: xr.Dataset, store_format: dict, encoding: None | dict = None) -> dict:
+    """
+    Add the compressor and, for sharded stores, the shards of every data variable to an encoding
+    for `ds.to_zarr(encoding=...)`. Shards hold whole chunks, so the number of time steps in a shard
+    is rounded up to a multiple of the time steps in a chunk.
+
+    Parameters:
+        ds(xarray.core.dataset.Dataset): the data to write
+
+        store_format(dict): the format created by `store_format`
+
+        encoding(dict): the encoding to add to, like the one from `percentile_encoding`
+
+    Returns:
+        encoding(dict): the encoding of every data variable
+    """
+    encoding = {name: dict(value) for name, value in (encoding or {}).items()}
+    zarr_format = store_format['zarr_format']
+    level = store_format['compression_level']
+
+    for name, da in ds.data_vars.items():
+        variable = encoding.setdefault(name, {})
+
+        if store_format['compressor'] == 'zstd':
+            codec = numcodecs.Zstd(level=level) if zarr_format == 2 else ZstdCodec(level=level)
+        elif store_format['compressor'] == 'blosc':
+            codec = (
+                numcodecs.Blosc(cname='zstd', clevel=level, shuffle=numcodecs.Blosc.SHUFFLE)
+                if zarr_format == 2
+                else BloscCodec(cname='zstd', clevel=level, shuffle='shuffle')
+            )
+        else:
+            codec = None
+
+        if codec is not None:
+            variable['compressors'] = [codec]
+
+        if store_format['shard_time'] > 0 and 'time' in da.dims:
+            if 'chunks' in da.encoding:
+                chunks = tuple(da.encoding['chunks'])
+            elif da.chunks is not None:
+                chunks = tuple(sizes[0] for sizes in da.chunks)
+            else:
+                chunks = da.shape
+
+            time_chunk = chunks[da.dims.index('time')]
+            shard_time = -(-store_format['shard_time'] // time_chunk) * time_chunk
+            if shard_time > time_chunk:
+                variable['chunks'] = chunks
+                variable['shards'] = tuple(
+                    shard_time if dim == 'time' else size for dim, size in zip(da.dims, chunks)
+                )
+
+    return encoding
+
+
+def prepare_percentiles(ds: xr.Dataset, dtype: str, store_format: dict) -> xr.Dataset:
+    """
+    Prepare the percentiles of a processed dataset for how they are stored, so that a store written
+    in one go and a store appended to month by month hold the same values.
+
+    Parameters:
+        ds(xarray.core.dataset.Dataset): water balance data with dims (time, y, x)
+
+        dtype(str): how the percentiles are stored, one of 'uint16', 'float32', or 'float64'
+
+        store_format(dict): how the Zarr store is written, see `store_format`
+
+    Returns:
+        ds(xarray.core.dataset.Dataset): the clipped or bit rounded data
+    """
+    if dtype == 'uint16':
+        # the integer encoding only covers [0, 1], so round-off outside of it can't wrap around
+        return ds.map(
+            lambda da: da.clip(0, 1) if set(da.dims) == {'time', 'y', 'x'} else da,
+            keep_attrs=True,
+        )
+    if store_format['keep_bits'] > 0:
+        return bit_round(ds, store_format['keep_bits'])
+    return ds
+
+
+def write_analysis_store(
+    ds: xr.Dataset, path: str, dtype: str, attrs: dict, store_format: dict
+) -> None:
+    """
+    Write a processed dataset to a new Zarr store for analysis, replacing any existing store.
+
+    Parameters:
+        ds(xarray.core.dataset.Dataset): water balance data with dims (time, y, x)
+
+        path(str): the path of the Zarr store on a GCS bucket
+
+        dtype(str): how the percentiles are stored, one of 'uint16', 'float32', or 'float64'
+
+        attrs(dict): attributes that decide whether later releases can append to the store
+
+        store_format(dict): how the Zarr store is written, see `store_format`
+
+    Returns:
+        None
+    """
+    ds = prepare_percentiles(ds, dtype, store_format)
+    ds.assign_attrs(attrs).to_zarr(
+        path,
+        encoding=zarr_encoding(ds, store_format, percentile_encoding(ds, dtype)),
+        consolidated=True,
+        zarr_format=store_format['zarr_format'],
+        mode='w',
+        align_chunks=True,
+    )
+
+
+def append_to_analysis_store(
+    ds: xr.Dataset, path: str, dtype: str, attrs: dict, store_format: dict
+) -> None:
+    """
+    Append the time steps of a processed dataset to an existing Zarr store for analysis.
+    The store's encoding is reused, so the new time steps are stored the same way as the existing ones.
+
+    Parameters:
+        ds(xarray.core.dataset.Dataset): water balance data with dims (time, y, x),
+            on the same grid as the store and starting after its last time step
+
+        path(str): the path of the Zarr store on a GCS bucket
+
+        dtype(str): how the percentiles are stored, one of 'uint16', 'float32', or 'float64'
+
+        attrs(dict): the attributes of the store, which appending would otherwise replace
+
+        store_format(dict): how the Zarr store was written, see `store_format`
+
+    Returns:
+        None
+    """
+    ds = prepare_percentiles(ds, dtype, store_format)
+
+    # only variables along time are appended, the grid and the CRS are already in the store
+    ds = ds.drop_vars([name for name in ds.variables if 'time' not in ds[name].dims])
+    # the new time steps can fill up the last shard, which is re-written along with them
+    ds.drop_encoding().assign_attrs(attrs).to_zarr(
+        path,
+        append_dim='time',
+        consolidated=True,
+        zarr_format=store_format['zarr_format'],
+        align_chunks=True,
+    )
+
+
+def write_series_store(
+    source: str, path: str, dtype: str, store_format: dict, tile: int, max_bytes: int
+) -> None:
+    """
+    Rechunk an analysis store into the series layout, where each chunk is a tile of `tile` x `tile`
+    pixels with every time step, so that the timeseries of a region only reads the few chunks that
+    cover it instead of a chunk for every month.
+
+    The store is rechunked in bands of tile rows that fit into `max_bytes` of memory, so the whole
+    dataset is never loaded at once. Every chunk has every time step, so the store can not be appended
+    to and is rechunked again for every release.
+
+    Parameters:
+        source(str): the path of the analysis store, with a chunk for every time step
+
+        path(str): the path of the Zarr store in the series layout on a GCS bucket
+
+        dtype(str): how the percentiles are stored, one of 'uint16', 'float32', or 'float64'
+
+        store_format(dict): how the Zarr store is written, see `store_format`
+
+        tile(int): the number of pixels along y and x in a chunk
+
+        max_bytes(int): the number of bytes of data to load at once
+
+    Returns:
+        None
+    """
+    ds = open_analysis_store(source).drop_encoding()
+    variables = [name for name in ds.data_vars if set(ds[name].dims) == {'time', 'y', 'x'}]
+
+    # the percentiles are decoded and encoded again the same way, which gives back the stored values
+    encoding = zarr_encoding(ds, {**store_format, 'shard_time': 0}, percentile_encoding(ds, dtype))
+    for name in variables:
+        encoding[name]['chunks'] = tuple(
+            ds.sizes['time'] if dim == 'time' else tile for dim in ds[name].dims
+        )
+
+    # write the metadata and the coordinates first, then fill in the data band by band
+    ds.chunk({'time': -1, 'y': tile, 'x': tile}).to_zarr(
+        path,
+        encoding=encoding,
+        compute=False,
+        consolidated=True,
+        zarr_format=store_format['zarr_format'],
+        mode='w',
+    )
+
+    row_bytes = sum(
+        ds.sizes['time'] * ds.sizes['x'] * ds[name].dtype.itemsize for name in variables
+    )
+    band_rows = max(max_bytes // row_bytes // tile, 1) * tile
+
+    for start in range(0, ds.sizes['y'], band_rows):
+        band = ds[variables].isel(y=slice(start, start + band_rows))
+        # only variables along y are written, the rest of the coordinates are already in the store
+        band = band.drop_vars([name for name in band.variables if 'y' not in band[name].dims])
+        band.load().to_zarr(
+            path,
+            region={'y': slice(start, start + band.sizes['y'])},
+            consolidated=False,
+            zarr_format=store_format['zarr_format'],
+        )
+
+
+def copy_store(source: str, path: str) -> None:
+    """
+    Copy a Zarr store from a previous release to the path of this release,
+    unless it is already at that path.
+
+    Parameters:
+        source(str): the path of the existing Zarr store
+
+        path(str): the path of the Zarr store of this release
+
+    Returns:
+        None
+    """
+    fs, _ = fsspec.core.url_to_fs(path)
+
+    if fs._strip_protocol(source) != fs._strip_protocol(path):
+        print(f'        Copying {source}...')
+        fs.copy(source, path, recursive=True)
+
+
+def find_latest_store(
+    fs: fsspec.AbstractFileSystem,
+    bucket: str,
+    dataset: str,
+    release: str,
+    directory: str = 'analysis',
+) -> None | str:
+    """
+    Find the Zarr store of a dataset from the latest release up to and including `release`.
+
+    Parameters:
+        fs(fsspec.AbstractFileSystem): the filesystem of the bucket
+
+        bucket(str): the name of the bucket
+
+        dataset(str): the name of the dataset, for example 'h3'
+
+        release(str): the date of the release, for example '2026-07-01'
+
+        directory(str): either 'analysis' or 'viz'
+
+    Returns:
+        path(str): the URL of the store, or None if there is no such store
+    """
+    stores = {}
+    for path in fs.glob(f'{bucket}/zarr/{directory}/wb-{dataset}-*.zarr'):
+        date = path.rstrip('/').split(f'wb-{dataset}-')[-1].removesuffix('.zarr')
+        stores[date] = fs.unstrip_protocol(path)
+
+    releases = sorted(date for date in stores if date <= release)
+
+    return stores[releases[-1]] if len(releases) > 0 else None
+
+
+def missing_dates(path: str, dates: pd.DatetimeIndex, attrs: dict) -> None | pd.DatetimeIndex:
+    """
+    Find the dates that are missing from an existing analysis store.
+
+    Parameters:
+        path(str): the path of the Zarr store on a GCS bucket
+
+        dates(pandas.DatetimeIndex): all of the dates that the store should have
+
+        attrs(dict): the attributes that the store was written with, like the baseline period
+
+    Returns:
+        dates(pandas.DatetimeIndex): the dates after the last time step of the store,
+            or None if the store can not be appended to and has to be rebuilt
+    """
+    try:
+        store = xr.open_zarr(path, consolidated=True)
+    except (FileNotFoundError, KeyError, ValueError):
+        # for example a store that was only partially written by a failed run
+        return None
+
+    if any(store.attrs.get(key) != value for key, value in attrs.items()):
+        return None
+
+    existing = pd.DatetimeIndex(store.time.values)
+    if len(existing) > len(dates) or not existing.equals(dates[: len(existing)]):
+        return None
+
+    return dates[len(existing) :]
+
+
+def update_historical_store(
+    files: dict, path: str, dtype: str, attrs: dict, store_format: dict, previous: None | str
+) -> xr.Dataset:
+    """
+    Write the analysis store of a historical dataset. If a previous store can be appended to,
+    only the months that are missing from it are opened and appended, instead of rebuilding the store.
+
+    A previous store from an older release is copied to the new path first (copy-forward), so that it
+    keeps serving its release, while a store that already has the new path is appended to in place.
+    The store is rebuilt from every file if its attributes (the baseline period, how the
+    percentiles are stored, and the format of the store), its dates, or its grid do not match the new data.
+
+    Parameters:
+        files(dict): the file of every month that the store should have, keyed by date
+
+        path(str): the path of the Zarr store on a GCS bucket
+
+        dtype(str): how the percentiles are stored, one of 'uint16', 'float32', or 'float64'
+
+        attrs(dict): attributes that decide whether later releases can append to the store
+
+        store_format(dict): how the Zarr store is written, see `store_format`
+
+        previous(str): the path of the store to append to, or None to rebuild the store
+
+    Returns:
+        ds(xarray.core.dataset.Dataset): the historical data for the rest of the pipeline
+    """
+    dates = pd.DatetimeIndex(list(files.keys()))
+
+    missing = None if previous is None else missing_dates(previous, dates, attrs)
+
+    if missing is not None:
+        copy_store(previous, path)
+
+        if len(missing) > 0:
+            print(f'        Appending {len(missing)} month(s)...')
+            ds = xr.concat(open_files_in_parallel([files[date] for date in missing]), dim='time')
+            ds = process_dataset(ds)
+
+            store = xr.open_zarr(path, consolidated=True)
+            if np.array_equal(store.x.values, ds.x.values) and np.array_equal(
+                store.y.values, ds.y.values
+            ):
+                append_to_analysis_store(ds, path, dtype, attrs, store_format)
+                missing = []
+            else:
+                print('        The grid has changed, rebuilding the store.')
+
+        if len(missing) == 0:
+            return xr.open_zarr(path, consolidated=True, decode_coords='all')
+
+    ds = xr.concat(open_files_in_parallel(list(files.values())), dim='time')
+    ds = process_dataset(ds)
+    write_analysis_store(ds, path, dtype, attrs, store_format)
+
+    return ds
+
+
+def pyramid_to_zarr(
+    ds: xr.Dataset,
+    levels: int,
+    path: str,
+    store_format: dict,
+    time_chunk: None | int = None,
+    attrs: None | dict = None,
+) -> None:
     """
     Convert a Xarray Dataset into a Zarr for visualization using CarbonPlan's `maps` package.
 
@@ -72,6 +554,13 @@ def pyramid_to_zarr(ds: xr.Dataset, levels: int, path: str) -> None:
 
         path(str): the path on disk for where to save the Zarr store
 
+        store_format(dict): how the Zarr store is written, see `store_format`
+
+        time_chunk(int): the number of time steps in each chunk, all of them by default.
+            Pyramids with one time step per chunk can have new time steps appended to them
+
+        attrs(dict): attributes that decide whether later releases can append to the pyramid
+
     Returns:
         None
     """
@@ -81,10 +570,473 @@ def pyramid_to_zarr(ds: xr.Dataset, levels: int, path: str) -> None:
         levels=levels,
         # extra_dim='window',
         # other_chunks={'window': len(ds.window), 'time': len(ds.time)},
-        other_chunks={'time': len(ds.time)},
+        other_chunks={'time': len(ds.time) if time_chunk is None else time_chunk},
+    )
+    if store_format['keep_bits'] > 0:
+        dt = dt.map_over_datasets(lambda level_ds: bit_round(level_ds, store_format['keep_bits']))
+    dt.attrs.update(attrs or {})
+
+    dt.to_zarr(
+        path,
+        encoding={
+            node.path: zarr_encoding(node.to_dataset(inherit=False), store_format)
+            for node in dt.subtree
+            if node.has_data
+        },
+        zarr_format=store_format['zarr_format'],
+        consolidated=True,
+        mode='w',
+        align_chunks=True,
+    )
+
+
+def append_to_pyramid(ds: xr.Dataset, levels: int, path: str, store_format: dict) -> None:
+    """
+    Reproject new time steps and append them to every level of a pyramid
+    that was written with one time step per chunk, then update its consolidated metadata.
+
+    Parameters:
+        ds(xarray.core.dataset.Dataset): the new time steps, with at least the dims (time, longitude, latitude)
+
+        levels(int): the number of levels in the Zarr pyramid
+
+        path(str): the path of the Zarr pyramid
+
+        store_format(dict): how the Zarr pyramid was written, see `store_format`
+
+    Returns:
+        None
+    """
+    dt = pyramid_reproject(ds.drop_encoding(), levels=levels, other_chunks={'time': 1})
+    if store_format['keep_bits'] > 0:
+        dt = dt.map_over_datasets(lambda level_ds: bit_round(level_ds, store_format['keep_bits']))
+
+    for level in range(levels):
+        level_ds = dt[str(level)].to_dataset()
+        # only variables along time are appended, the grid of each level is already in the store
+        level_ds = level_ds.drop_vars(
+            [name for name in level_ds.variables if 'time' not in level_ds[name].dims]
+        )
+        level_ds.to_zarr(
+            path,
+            group=str(level),
+            append_dim='time',
+            zarr_format=store_format['zarr_format'],
+            consolidated=False,
+            align_chunks=True,
+        )
+
+    zarr.consolidate_metadata(path, zarr_format=store_format['zarr_format'])
+
+
+def missing_pyramid_times(
+    path: str, times: np.ndarray, levels: int, attrs: dict
+) -> None | np.ndarray:
+    """
+    Find the time steps that are missing from an existing pyramid.
+
+    Parameters:
+        path(str): the path of the Zarr pyramid
+
+        times(numpy.ndarray): all of the time steps that the pyramid should have
+
+        levels(int): the number of levels that the pyramid should have
+
+        attrs(dict): the attributes that the pyramid was written with
+
+    Returns:
+        times(numpy.ndarray): the time steps after the last time step of the pyramid, or None if the
+            pyramid can not be appended to (for example, because it has all time steps in one chunk)
+            and has to be rebuilt
+    """
+    try:
+        dt = xr.open_datatree(path, engine='zarr', consolidated=True)
+    except (FileNotFoundError, KeyError, ValueError):
+        return None
+
+    if any(dt.attrs.get(key) != value for key, value in attrs.items()):
+        return None
+
+    if sorted(dt.children) != sorted(str(level) for level in range(levels)):
+        return None
+
+    existing = dt['0'].time.values
+    for node in dt.children.values():
+        # every level needs the same time steps, which a failed append could have left out of sync
+        if not np.array_equal(node.time.values, existing):
+            return None
+
+        for da in node.data_vars.values():
+            chunks = dict(zip(da.dims, da.encoding.get('chunks', ())))
+            if 'time' in da.dims and chunks.get('time') != 1:
+                return None
+
+    if len(existing) > len(times) or not np.array_equal(existing, times[: len(existing)]):
+        return None
+
+    return times[len(existing) :]
+
+
+def update_pyramid(
+    ds: xr.Dataset,
+    levels: int,
+    path: str,
+    attrs: dict,
+    store_format: dict,
+    previous: None | str,
+) -> None:
+    """
+    Write the pyramid of a historical dataset. If a previous pyramid can be appended to,
+    only the time steps that are missing from it are reprojected and appended to each of its levels,
+    instead of reprojecting the whole time axis again.
+
+    Parameters:
+        ds(xarray.core.dataset.Dataset): the historical data, with at least the dims (time, longitude, latitude)
+
+        levels(int): the number of levels in the Zarr pyramid
+
+        path(str): the path of the Zarr pyramid
+
+        attrs(dict): attributes that decide whether later releases can append to the pyramid
+
+        store_format(dict): how the Zarr pyramid is written, see `store_format`
+
+        previous(str): the path of the pyramid to append to, or None to rebuild the pyramid
+
+    Returns:
+        None
+    """
+    missing = (
+        None if previous is None else missing_pyramid_times(previous, ds.time.values, levels, attrs)
+    )
+
+    if missing is None:
+        pyramid_to_zarr(ds, levels, path, store_format, time_chunk=1, attrs=attrs)
+        return
+
+    copy_store(previous, path)
+
+    if len(missing) > 0:
+        print(f'        Appending {len(missing)} month(s)...')
+        append_to_pyramid(ds.sel(time=missing), levels, path, store_format)
+
+
+def regional_series_table(
+    dataset_dict: dict, regions: xr.Dataset, production: xr.Dataset, extents: dict
+) -> pd.DataFrame:
+    """
+    Calculate the historical and forecast timeseries of every country and state, both unweighted
+    and weighted by the production of each crop, in the table format that the app shows.
+
+    Parameters:
+        dataset_dict(dict): the processed datasets keyed by name ('h3', 'h12', 'f3', 'f12')
+
+        regions(xarray.core.dataset.Dataset): the region index created by `rasterize_regions`
+
+        production(xarray.core.dataset.Dataset): the SPAM crop production with dims (crop, y, x)
+
+        extents(dict): the crop extent GeoDataFrame for each crop name
+
+    Returns:
+        df(pandas.DataFrame): a table with one row per region, crop, window, type, and time step
+    """
+    weights = [region_weights(regions)] + [
+        crop_weights(regions, production.sel(crop=crop).production, crop, extents[crop])
+        for crop in CROPS
+    ]
+    weights, index = stack_weights(weights)
+
+    tables = []
+    for dataset in dataset_dict.keys():
+        print(f'    Aggregating {dataset.upper()} data...')
+        if dataset.startswith('h'):
+            kind = 'historical'
+            variables = ['perc']
+        else:
+            kind = 'forecast'
+            variables = ['5%', '20%', 'perc', '80%', '95%']
+
+        series = regional_series(dataset_dict[dataset], weights, index, variables)
+        tables.append(series_to_dataframe(series, kind, dataset[1:]))
+
+    # sorting by region keeps each selection in a few Parquet row groups, so filtered reads are fast
+    df = (
+        pd.concat(tables)
+        .sort_values(['country', 'states', 'crop', 'window', 'type', 'time'])
+        .reset_index(drop=True)
+    )
+
+    return df
+
+
+def open_analysis_store(path: str) -> xr.Dataset:
+    """
+    Lazily open a Zarr store for analysis that was written by this pipeline, with decoded percentiles.
+
+    Parameters:
+        path(str): the path of the Zarr store on a GCS bucket
+
+    Returns:
+        ds(xarray.core.dataset.Dataset): the water balance data with dims (time, y, x)
+    """
+    return xr.open_zarr(path, consolidated=True, decode_coords='all')
+
+
+def save_historical_store(
+    files: dict, path: str, dtype: str, attrs: dict, store_format: dict, previous: None | str
+) -> None:
+    """
+    Pipeline stage that writes the Zarr store of a historical dataset used for analysis.
+    See `update_historical_store` for the parameters.
+    """
+    update_historical_store(files, path, dtype, attrs, store_format, previous)
+
+
+def save_forecast_store(file: str, path: str, dtype: str, attrs: dict, store_format: dict) -> None:
+    """
+    Pipeline stage that writes the Zarr store of a forecast used for analysis.
+
+    Parameters:
+        file(str): the NetCDF file of the forecast on a GCS bucket
+
+        path(str): the path of the Zarr store on a GCS bucket
+
+        dtype(str): how the percentiles are stored, one of 'uint16', 'float32', or 'float64'
+
+        attrs(dict): attributes of the store, like the baseline period
+
+        store_format(dict): how the Zarr store is written, see `store_format`
+
+    Returns:
+        None
+    """
+    ds = open_dataset(file)
+    ds = process_dataset(ds)
+    ds = ds.rename({'50%': 'perc'})
+    ds = ds[['time', 'y', 'x', 'spatial_ref', '5%', '20%', 'perc', '80%', '95%']]
+
+    write_analysis_store(ds, path, dtype, attrs, store_format)
+
+
+def save_region_index(
+    grid_path: str, countries_path: str, states_path: str, path: str, store_format: dict
+) -> None:
+    """
+    Pipeline stage that writes the region index used for analysis.
+
+    Parameters:
+        grid_path(str): the path of a Zarr store for analysis that is on the grid of the release
+
+        countries_path(str): the path of the country boundaries
+
+        states_path(str): the path of the state boundaries
+
+        path(str): the path of the Zarr store of the region index on a GCS bucket
+
+        store_format(dict): how the Zarr store is written, see `store_format`
+
+    Returns:
+        None
+    """
+    # the boundaries do not change between releases, but they need to match this release's grid
+    countries = gpd.read_parquet(countries_path)
+    states = gpd.read_parquet(states_path)
+    regions = rasterize_regions(open_analysis_store(grid_path), countries, states)
+    regions.to_zarr(
+        path,
+        encoding=zarr_encoding(regions, store_format),
+        consolidated=True,
+        zarr_format=store_format['zarr_format'],
+        mode='w',
     )
 
-    dt.to_zarr(path, zarr_format=2, consolidated=True, mode='w')
+
+def save_series_table(
+    store_paths: dict, regions_path: str, production_path: str, extent_paths: dict, path: str
+) -> None:
+    """
+    Pipeline stage that writes the regional timeseries table that the app reads.
+
+    Parameters:
+        store_paths(dict): the path of the Zarr store for analysis of each dataset ('h3', 'h12', 'f3', 'f12')
+
+        regions_path(str): the path of the region index
+
+        production_path(str): the path of the SPAM crop production Zarr store
+
+        extent_paths(dict): the path of the crop extent of each crop
+
+        path(str): the path of the Parquet table on a GCS bucket
+
+    Returns:
+        None
+    """
+    dataset_dict = {dataset: open_analysis_store(store) for dataset, store in store_paths.items()}
+    regions = xr.open_dataset(regions_path, engine='zarr', consolidated=True).compute()
+    production = xr.open_dataset(production_path, engine='zarr', consolidated=True)
+    extents = {crop: gpd.read_parquet(extent) for crop, extent in extent_paths.items()}
+
+    series_table = regional_series_table(dataset_dict, regions, production, extents)
+    series_table.to_parquet(path, index=False, row_group_size=50_000)
+
+
+def save_pyramid(
+    store_path: str, path: str, attrs: None | dict, store_format: dict, previous: None | str
+) -> None:
+    """
+    Pipeline stage that writes the Zarr pyramid of a dataset used for visualization.
+
+    Parameters:
+        store_path(str): the path of the Zarr store for analysis of the dataset
+
+        path(str): the path of the Zarr pyramid on a GCS bucket
+
+        attrs(dict): for historical datasets, the attributes that decide whether later releases can
+            append to the pyramid (see `update_pyramid`), or None to rebuild the pyramid every release
+
+        store_format(dict): how the Zarr pyramid is written, see `store_format`
+
+        previous(str): the path of the pyramid to append to, or None to rebuild the pyramid
+
+    Returns:
+        None
+    """
+    ds = open_analysis_store(store_path)
+
+    # the time coordinates of the pyramids are saved as strings
+    ds['time'] = np.array(
+        [pd.to_datetime(value).strftime('%Y-%m-%d') for value in ds.time.values], dtype='U10'
+    )
+
+    # calculate the number of zoom levels to use for the output Zarr
+    pixels_per_tile = 128
+    longitude_length = ds.perc.x.shape[0]
+    max_levels = round(np.sqrt(longitude_length / pixels_per_tile)) + 1
+    levels = max_levels
+
+    if attrs is None:
+        pyramid_to_zarr(ds, levels, path, store_format)
+    else:
+        update_pyramid(ds, levels, path, attrs, store_format, previous)
+
+
+# how often the memory of a worker process is checked, in seconds
+MEMORY_CHECK_INTERVAL = 0.5
+
+
+def raise_memory_error(signum: int, frame) -> None:
+    raise MemoryError('The worker process is using more memory than PIPELINE_WORKER_MEMORY.')
+
+
+def watch_memory(memory_limit: int) -> None:
+    """
+    Interrupt the stage that a worker process is running with a MemoryError whenever the resident memory
+    of the process is over a limit. Once it has interrupted a stage, it waits for the memory to drop back
+    under the limit, so that it only interrupts the next stage if that one uses too much memory as well.
+    """
+    process = psutil.Process()
+    over_limit = False
+
+    while True:
+        rss = process.memory_info().rss
+        if rss > memory_limit and not over_limit:
+            # the signal handler runs in the main thread of the worker, which runs the stage
+            signal.pthread_kill(threading.main_thread().ident, signal.SIGUSR1)
+        over_limit = rss > memory_limit
+        time.sleep(MEMORY_CHECK_INTERVAL)
+
+
+def init_stage_worker(memory_limit: int, threads: int) -> None:
+    """
+    Limit the memory of a worker process and the number of threads that Dask uses in it.
+
+    The limit is on resident memory (RSS) rather than on address space (like `RLIMIT_AS`), since Dask
+    thread pools, glibc arenas, and gcsfs threads reserve much more address space than they use.
+
+    Parameters:
+        memory_limit(int): the number of bytes of resident memory that the worker can use (0 for no limit)
+
+        threads(int): the number of threads that Dask uses to compute chunks in the worker
+
+    Returns:
+        None
+    """
+    if memory_limit > 0:
+        signal.signal(signal.SIGUSR1, raise_memory_error)
+        threading.Thread(target=watch_memory, args=(memory_limit,), daemon=True).start()
+
+    # the workers share the cores, instead of each of them starting a thread for every core
+    dask.config.set(num_workers=threads)
+
+
+def timed_stage(function: callable, *args) -> float:
+    """
+    Run a pipeline stage and return its wall time in seconds.
+    """
+    start = timeit.default_timer()
+    function(*args)
+
+    return timeit.default_timer() - start
+
+
+def run_stages(stages: dict, workers: int, memory_limit: int = 0) -> dict:
+    """
+    Run the stages of the pipeline in a pool of worker processes. Each stage starts as soon as
+    the stages that it depends on have finished, so stages of different datasets run at the same time.
+
+    Parameters:
+        stages(dict): (function, args, dependencies) for each stage name, where the function and
+            its arguments can be pickled and the dependencies are the names of other stages
+
+        workers(int): the number of worker processes, where 1 runs the stages one after the other
+            in this process, in the order of `stages`
+
+        memory_limit(int): the number of bytes of resident memory that each worker can use (0 for no limit)
+
+    Returns:
+        timings(dict): the wall time of each stage in seconds, in the order they finished
+    """
+    for name, (_, _, dependencies) in stages.items():
+        unknown = set(dependencies) - set(stages)
+        if len(unknown) > 0:
+            raise ValueError(f'The stage {name} depends on unknown stages {sorted(unknown)}.')
+
+    timings = {}
+
+    if workers <= 1:
+        for name, (function, args, _) in stages.items():
+            print(f'    Running {name}...')
+            timings[name] = timed_stage(function, *args)
+            print(f'    Finished {name} in {timings[name]:.1f} s')
+        return timings
+
+    # processes are spawned instead of forked, since the parent process can have GCS threads running
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_stage_worker,
+        initargs=(memory_limit, max(1, os.cpu_count() // workers)),
+    ) as executor:
+        pending = dict(stages)
+        running = {}
+
+        while len(pending) > 0 or len(running) > 0:
+            for name, (function, args, dependencies) in list(pending.items()):
+                if all(dependency in timings for dependency in dependencies):
+                    print(f'    Running {name}...')
+                    running[executor.submit(timed_stage, function, *args)] = name
+                    del pending[name]
+
+            if len(running) == 0:
+                raise RuntimeError(f'The stages {sorted(pending)} depend on each other.')
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                timings[name] = future.result()
+                print(f'    Finished {name} in {timings[name]:.1f} s')
+
+    return timings
 
 
 def drought_pipeline():
@@ -116,109 +1068,149 @@ def drought_pipeline():
 
     # environment variables
     BUCKET = os.getenv('BUCKET_NAME')
+    # how the percentiles are stored in the analysis Zarr stores: 'float64' (the default, which keeps the
+    # published values unchanged), or the compact but lossy 'float32' or 'uint16' (see `encoding.py`)
+    PERCENTILE_DTYPE = os.getenv('PERCENTILE_DTYPE', 'float64')
+    # 'incremental' appends the new months to the historical Zarr stores and pyramids
+    # of the previous release, while 'full' rebuilds them from every month
+    UPDATE_MODE = os.getenv('UPDATE_MODE', 'incremental')
+
+    # the number of pipeline stages that run at the same time, each in its own process
+    PIPELINE_WORKERS = int(os.getenv('PIPELINE_WORKERS', '4'))
+    # the number of bytes of resident memory (RSS) that each of those processes can use (0 for no limit)
+    PIPELINE_WORKER_MEMORY = int(os.getenv('PIPELINE_WORKER_MEMORY', '0'))
+
+    # the number of pixels along y and x in a chunk of the historical stores in the series layout
+    SERIES_TILE = int(os.getenv('SERIES_TILE', '32'))
+    # the number of bytes of data that are loaded at once to rechunk them into the series layout
+    SERIES_MEMORY = int(os.getenv('SERIES_MEMORY', str(1024**3)))
+
+    # how the Zarr stores are written (see `store_format`), by default as Zarr v2 with the default compressor
+    STORE_FORMAT = store_format(
+        zarr_format=int(os.getenv('ZARR_FORMAT', '2')),
+        compressor=os.getenv('ZARR_COMPRESSOR', 'default'),
+        compression_level=int(os.getenv('ZARR_COMPRESSION_LEVEL', '3')),
+        shard_time=int(os.getenv('ZARR_SHARD_TIME', '0')),
+        keep_bits=int(os.getenv('PERCENTILE_KEEP_BITS', '0')),
+    )
+
+    if UPDATE_MODE not in ['incremental', 'full']:
+        raise ValueError("UPDATE_MODE should be either 'incremental' or 'full'.")
+
+    release = f'{year_ic}-{month_ic}-01'
+
+    # a historical store can only be appended to if it was made in the same way
+    store_attrs = {'baseline': BASELINE, 'percentile_dtype': PERCENTILE_DTYPE, **STORE_FORMAT}
 
     print('Generating input file list.')
     print()
     # create file list
     dates = pd.date_range(start='1991-01-01', end=f'{year_ic}-{month_ic}-01', freq='MS')
-    h3_files = sorted(
-        [
-            f'gs://{BUCKET}/era5/monthly/water_balance_hamon_percentiles/era5_water-balance-perc-w3_bl-1991-2020_mon_{date.strftime("%Y-%m-%d")}.nc'
-            for date in dates
-        ]
-    )
-    h12_files = sorted([file.replace('w3', 'w12') for file in h3_files])
+    h3_files = historical_files(f'gs://{BUCKET}', 3, dates)
+    h12_files = historical_files(f'gs://{BUCKET}', 12, dates)
 
-    forecast_files = [
-        f'gs://{BUCKET}/nmme/ensemble/water_balance_hamon_percentiles/nmme_ensemble_water-balance-perc-w{window}_mon_ic-{year_ic}-{month_ic}-01_leads-6.nc'
-        for window in [3, 12]
-    ]
-    f3_file = [file for file in forecast_files if 'w3' in file][0]
-    f12_file = [file for file in forecast_files if 'w12' in file][0]
-
-    print('Opening data.')
-    # open historical data for both integration windows
-    # parallelize data reads
-    print('    Opening H3 data...')
-    ds_list = open_files_in_parallel(h3_files)
-    h3 = xr.concat(ds_list, dim='time')
-    h3 = process_dataset(h3)
-
-    print('    Opening H12 data...')
-    ds_list = open_files_in_parallel(h12_files)
-    h12 = xr.concat(ds_list, dim='time')
-    h12 = process_dataset(h12)
-
-    # open forecast data for both integration windows
-    print('    Opening F3 data...')
-    f3 = open_dataset(f3_file)
-    f3 = process_dataset(f3)
-    f3 = f3.rename({'50%': 'perc'})
-    f3 = f3[['time', 'y', 'x', 'spatial_ref', '5%', '20%', 'perc', '80%', '95%']]
-
-    print('    Opening F12 data...')
-    print()
-    f12 = open_dataset(f12_file)
-    f12 = process_dataset(f12)
-    f12 = f12.rename({'50%': 'perc'})
-    f12 = f12[['time', 'y', 'x', 'spatial_ref', '5%', '20%', 'perc', '80%', '95%']]
-
-    dataset_dict = {
-        'h3': h3,
-        'h12': h12,
-        'f3': f3,
-        'f12': f12,
+    f3_file = forecast_file(f'gs://{BUCKET}', 3, release)
+    f12_file = forecast_file(f'gs://{BUCKET}', 12, release)
+
+    print('Running pipeline stages.')
+    fs = fsspec.filesystem('gs')
+    analysis = f'gs://{BUCKET}/zarr/analysis'
+    viz = f'gs://{BUCKET}/zarr/viz'
+    store_paths = {
+        dataset: f'{analysis}/wb-{dataset}-{release}.zarr' for dataset in ['h3', 'h12', 'f3', 'f12']
     }
+    regions_path = f'{analysis}/regions-{release}.zarr'
+    incremental = UPDATE_MODE == 'incremental'
 
-    print('Saving Zarr stores used for analysis.')
-    # save the data as zarr stores that we will use for analysis
-    for dataset in dataset_dict.keys():
-        print(f'    Saving {dataset.upper()} data...')
-        save_to = f'gs://{BUCKET}/zarr/analysis/wb-{dataset}-{year_ic}-{month_ic}-01.zarr'
-        dataset_dict[dataset].to_zarr(
-            save_to,
-            consolidated=True,
-            zarr_format=2,
-            mode='w',
+    # every stage reads its inputs from the bucket and writes its outputs to the bucket,
+    # so stages that do not depend on each other can run in separate processes
+    stages = {}
+
+    # the Zarr stores used for analysis
+    # the historical data is only opened in its stage, since only the new months need to be opened
+    # when they are appended to the previous release
+    for dataset, files in {'h3': h3_files, 'h12': h12_files}.items():
+        previous = find_latest_store(fs, BUCKET, dataset, release) if incremental else None
+        stages[f'{dataset.upper()} analysis store'] = (
+            save_historical_store,
+            (files, store_paths[dataset], PERCENTILE_DTYPE, store_attrs, STORE_FORMAT, previous),
+            [],
         )
-    print()
 
-    print('Saving Zarr stores used for visualization.')
-    # next, save the data as zarr stores that we will use for visualization
-    # first, we need to save their time coordinates as object arrays
-    h3['time'] = np.array(
-        [pd.to_datetime(value).strftime('%Y-%m-%d') for value in h3.time.values], dtype='U10'
-    )
-    h12['time'] = np.array(
-        [pd.to_datetime(value).strftime('%Y-%m-%d') for value in h12.time.values], dtype='U10'
-    )
+    for dataset, file in {'f3': f3_file, 'f12': f12_file}.items():
+        stages[f'{dataset.upper()} analysis store'] = (
+            save_forecast_store,
+            (file, store_paths[dataset], PERCENTILE_DTYPE, store_attrs, STORE_FORMAT),
+            [],
+        )
 
-    f3['time'] = np.array(
-        [pd.to_datetime(value).strftime('%Y-%m-%d') for value in f3.time.values], dtype='U10'
+    # the region index and the regional timeseries table are calculated from the analysis stores
+    stages['region index'] = (
+        save_region_index,
+        (
+            store_paths['h3'],
+            f'gs://{BUCKET}/vector/countries.parquet',
+            f'gs://{BUCKET}/vector/states.parquet',
+            regions_path,
+            STORE_FORMAT,
+        ),
+        ['H3 analysis store'],
     )
-    f12['time'] = np.array(
-        [pd.to_datetime(value).strftime('%Y-%m-%d') for value in f12.time.values], dtype='U10'
+    stages['regional timeseries table'] = (
+        save_series_table,
+        (
+            store_paths,
+            regions_path,
+            f'gs://{BUCKET}/zarr/spam-crop-production.zarr',
+            {crop: f'gs://{BUCKET}/vector/{crop}.parquet' for crop in CROPS},
+            f'gs://{BUCKET}/tables/regional-series-{release}.parquet',
+        ),
+        [f'{dataset.upper()} analysis store' for dataset in store_paths] + ['region index'],
     )
 
-    # redeclare dict since data has changed
-    dataset_dict = {
-        'h3': h3,
-        'h12': h12,
-        'f3': f3,
-        'f12': f12,
-    }
+    # the historical data is also rechunked into the series layout, which reads the timeseries of
+    # small regions from a few chunks when the app calculates them from the data
+    for dataset in ['h3', 'h12']:
+        stages[f'{dataset.upper()} series store'] = (
+            write_series_store,
+            (
+                store_paths[dataset],
+                f'{analysis}/wb-series-{dataset}-{release}.zarr',
+                PERCENTILE_DTYPE,
+                STORE_FORMAT,
+                SERIES_TILE,
+                SERIES_MEMORY,
+            ),
+            [f'{dataset.upper()} analysis store'],
+        )
 
-    # next, calculate the number of zoom levels to use for the output Zarr
-    pixels_per_tile = 128
-    longitude_length = h3.perc.x.shape[0]
-    max_levels = round(np.sqrt(longitude_length / pixels_per_tile)) + 1
-    levels = max_levels
+    # the Zarr stores used for visualization
+    # the historical pyramids only need the new months to be reprojected and appended
+    for dataset in store_paths.keys():
+        historical = dataset.startswith('h')
+        previous = (
+            find_latest_store(fs, BUCKET, dataset, release, 'viz')
+            if historical and incremental
+            else None
+        )
+        stages[f'{dataset.upper()} pyramid'] = (
+            save_pyramid,
+            (
+                store_paths[dataset],
+                f'{viz}/wb-{dataset}-{release}.zarr',
+                {'baseline': BASELINE, **STORE_FORMAT} if historical else None,
+                STORE_FORMAT,
+                previous,
+            ),
+            [f'{dataset.upper()} analysis store'],
+        )
 
-    # create pyramids for each dataset, then save the pyramid to zarr
-    for dataset in dataset_dict.keys():
-        print(f'    Saving {dataset.upper()} data...')
-        save_to = f'gs://{BUCKET}/zarr/viz/wb-{dataset}-{year_ic}-{month_ic}-01.zarr'
-        pyramid_to_zarr(dataset_dict[dataset], levels, save_to)
+    timings = run_stages(stages, PIPELINE_WORKERS, PIPELINE_WORKER_MEMORY)
+    print()
+
+    print('Stage timings:')
+    for name, seconds in sorted(timings.items(), key=lambda item: item[1], reverse=True):
+        print(f'    {name}: {seconds:.1f} s')
     print()
 
     print('Done!')
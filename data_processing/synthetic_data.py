@@ -0,0 +1,159 @@
+"""
+Generate synthetic inputs for the data pipeline, so that it can be run and benchmarked without the
+production bucket.
+
+The files have the same names, variables, dims, and coordinates as the real inputs: monthly ERA5
+files with `perc`, and NMME forecast files with `5%`, `20%`, `50%`, `80%`, and `95%` for the next six
+months, on a global grid with descending latitudes and longitudes from 0 to 360. The percentiles are
+spatially smooth and persistent in time, with NaN over the oceans, so they compress about as well
+as real data.
+
+    python synthetic_data.py /tmp/wb-inputs --resolution 0.25 --months 427
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.ndimage
+import scipy.special
+import shapely
+import xarray as xr
+
+from drought_to_zarr import forecast_file, historical_files
+
+# how much of the previous month is kept in each month, for each integration window
+PERSISTENCE = {3: 0.7, 12: 0.95}
+
+# the forecast percentiles and their number of standard deviations from the median
+FORECAST_PERCENTILES = {'5%': -1.645, '20%': -0.842, '50%': 0.0, '80%': 0.842, '95%': 1.645}
+
+
+def global_grid(resolution: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Return the latitudes (from 90 to -90) and longitudes (from 0 to 360) of a global grid.
+    """
+    latitude = np.linspace(90, -90, round(180 / resolution) + 1)
+    longitude = np.arange(round(360 / resolution)) * resolution
+
+    return latitude, longitude
+
+
+def smooth_noise(rng: np.random.Generator, shape: tuple, scale: int) -> np.ndarray:
+    """
+    Return standard normal noise that is correlated over about `scale` pixels.
+    """
+    coarse_shape = tuple(max(size // scale, 2) + 1 for size in shape)
+    coarse = rng.standard_normal(coarse_shape)
+    noise = scipy.ndimage.zoom(
+        coarse, [size / coarse_size for size, coarse_size in zip(shape, coarse_shape)], order=1
+    )
+
+    return (noise - noise.mean()) / noise.std()
+
+
+def write_synthetic_inputs(
+    root: str,
+    resolution: float = 1.0,
+    months: int = 427,
+    release: str = '2026-07-01',
+    seed: int = 0,
+    land_geometries: None | list = None,
+) -> dict:
+    """
+    Write the historical and forecast NetCDF files of both integration windows for a release.
+
+    Parameters:
+        root(str): the local directory that stands in for the root of the bucket
+
+        resolution(float): the size of a pixel in degrees, 0.25 for the real data
+
+        months(int): the number of historical months, up to and including the release
+
+        release(str): the date of the initial conditions of the forecasts
+
+        seed(int): the seed of the random numbers, so that the same arguments write the same data
+
+        land_geometries(list): optional shapely geometries (with longitudes from -180 to 180)
+            whose pixels are always land, like the regions of a benchmark
+
+    Returns:
+        files(dict): the historical files (keyed by date) of 'h3' and 'h12', and the forecast files of 'f3' and 'f12'
+    """
+    rng = np.random.default_rng(seed)
+    latitude, longitude = global_grid(resolution)
+    shape = (len(latitude), len(longitude))
+    # about a pixel per 200 km, so that the features have the same size at every resolution
+    scale = max(round(2 / resolution), 1)
+
+    # the land is a third of the pixels with the highest smooth noise, and none of the poles
+    land = smooth_noise(rng, shape, 4 * scale)
+    land = (land > np.quantile(land, 2 / 3)) & (np.abs(latitude)[:, None] < 80)
+    # pixels are land if their center is within half a pixel of a geometry, so that they touch it
+    for geometry in land_geometries or []:
+        geometry = shapely.buffer(geometry, resolution / 2, join_style='mitre')
+        land |= shapely.contains_xy(geometry, (longitude + 180) % 360 - 180, latitude[:, None])
+
+    def to_dataset(variables: dict, time: pd.DatetimeIndex) -> xr.Dataset:
+        return xr.Dataset(
+            {
+                name: (
+                    ('time', 'latitude', 'longitude'),
+                    np.where(land, values, np.nan).astype('float32'),
+                )
+                for name, values in variables.items()
+            },
+            coords={'time': time, 'latitude': latitude, 'longitude': longitude},
+        )
+
+    dates = pd.date_range(end=release, periods=months, freq='MS')
+    files = {}
+
+    for window, persistence in PERSISTENCE.items():
+        files[f'h{window}'] = historical_files(root, window, dates)
+
+        # the percentiles are the normal CDF of a smooth AR(1) process, so they are uniform in [0, 1]
+        state = smooth_noise(rng, shape, scale)
+        for date, path in files[f'h{window}'].items():
+            noise = smooth_noise(rng, shape, scale)
+            state = persistence * state + np.sqrt(1 - persistence**2) * noise
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            to_dataset(
+                {'perc': scipy.special.ndtr(state)[None]}, pd.DatetimeIndex([date])
+            ).to_netcdf(path, engine='h5netcdf')
+
+        files[f'f{window}'] = forecast_file(root, window, release)
+
+        # the forecasts relax from the last month towards the climatology, with a growing spread
+        median = np.stack([persistence**lead * state for lead in range(1, 7)])
+        spread = np.sqrt(1 - persistence ** (2 * np.arange(1, 7)))[:, None, None]
+
+        os.makedirs(os.path.dirname(files[f'f{window}']), exist_ok=True)
+        to_dataset(
+            {
+                name: scipy.special.ndtr(median + z * spread)
+                for name, z in FORECAST_PERCENTILES.items()
+            },
+            pd.date_range(release, periods=7, freq='MS')[1:],
+        ).to_netcdf(files[f'f{window}'], engine='h5netcdf')
+
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument(
+        'root', help='the local directory that stands in for the root of the bucket'
+    )
+    parser.add_argument(
+        '--resolution', type=float, default=1.0, help='the size of a pixel in degrees'
+    )
+    parser.add_argument('--months', type=int, default=427, help='the number of historical months')
+    parser.add_argument(
+        '--release', default='2026-07-01', help='the date of the initial conditions'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    write_synthetic_inputs(args.root, args.resolution, args.months, args.release, args.seed)
@@ -0,0 +1,157 @@
+"""
+Tests of the incremental updates of the historical stores and pyramids in `drought_to_zarr.py`:
+appending the months of a new release to those of the previous release gives the same stores as
+rebuilding them, on small synthetic inputs from `synthetic_data.py`.
+
+    python -m pytest data_processing/tests
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import drought_to_zarr  # isort: skip  # noqa: E402
+from drought_to_zarr import (  # isort: skip  # noqa: E402
+    BASELINE,
+    missing_dates,
+    missing_pyramid_times,
+    save_pyramid,
+    store_format,
+    update_historical_store,
+)
+from synthetic_data import write_synthetic_inputs  # isort: skip  # noqa: E402
+
+# the months of the previous release, out of the months of the synthetic inputs
+PREVIOUS_MONTHS = 12
+
+
+@pytest.fixture(scope='module')
+def files(tmp_path_factory):
+    """
+    The historical files of every month of a release, at a coarse resolution.
+    """
+    root = tmp_path_factory.mktemp('bucket')
+    return write_synthetic_inputs(str(root), resolution=10, months=PREVIOUS_MONTHS + 2)['h3']
+
+
+def attrs(dtype: str, fmt: dict) -> dict:
+    """
+    The attributes that the pipeline writes the historical stores with.
+    """
+    return {'baseline': BASELINE, 'percentile_dtype': dtype, **fmt}
+
+
+def open_raw(path) -> xr.Dataset:
+    """
+    Open a store with the values as they are stored, so that stores are compared exactly.
+    """
+    return xr.open_zarr(path, consolidated=True, mask_and_scale=False).load()
+
+
+@pytest.mark.parametrize(
+    'dtype, fmt',
+    [
+        ('float64', store_format()),
+        ('uint16', store_format()),
+        ('float32', store_format(zarr_format=3, shard_time=12, keep_bits=10)),
+    ],
+)
+def test_appended_store_matches_rebuilt_store(files, tmp_path, dtype, fmt):
+    dates = pd.DatetimeIndex(list(files))
+    previous_files = {date: files[date] for date in dates[:PREVIOUS_MONTHS]}
+    store_attrs = attrs(dtype, fmt)
+
+    previous = str(tmp_path / 'previous.zarr')
+    update_historical_store(previous_files, previous, dtype, store_attrs, fmt, None)
+
+    # only the months of the new release are missing from the previous store
+    assert missing_dates(previous, dates, store_attrs).equals(dates[PREVIOUS_MONTHS:])
+
+    appended = str(tmp_path / 'appended.zarr')
+    rebuilt = str(tmp_path / 'rebuilt.zarr')
+    update_historical_store(files, appended, dtype, store_attrs, fmt, previous)
+    update_historical_store(files, rebuilt, dtype, store_attrs, fmt, None)
+
+    xr.testing.assert_identical(open_raw(appended), open_raw(rebuilt))
+    assert missing_dates(appended, dates, store_attrs).empty
+
+
+def test_store_is_rebuilt_when_it_can_not_be_appended_to(files, tmp_path, monkeypatch):
+    dates = pd.DatetimeIndex(list(files))
+    fmt = store_format()
+
+    previous = str(tmp_path / 'previous.zarr')
+    update_historical_store(files, previous, 'float64', attrs('float64', fmt), fmt, None)
+
+    # a store made in another way, or with other months, is not appended to
+    assert missing_dates(previous, dates, attrs('uint16', fmt)) is None
+    assert missing_dates(previous, dates[1:], attrs('float64', fmt)) is None
+    assert missing_dates(str(tmp_path / 'missing.zarr'), dates, attrs('float64', fmt)) is None
+
+    appended = []
+    monkeypatch.setattr(
+        drought_to_zarr, 'append_to_analysis_store', lambda *args: appended.append(args)
+    )
+    rebuilt = str(tmp_path / 'rebuilt.zarr')
+    update_historical_store(files, rebuilt, 'uint16', attrs('uint16', fmt), fmt, previous)
+
+    assert appended == []
+    assert open_raw(rebuilt).perc.dtype == 'uint16'
+    np.testing.assert_array_equal(open_raw(rebuilt).time.values, dates.values)
+
+
+def pyramid_times(path) -> np.ndarray:
+    """
+    The time steps of a pyramid, which are saved as strings.
+    """
+    return xr.open_datatree(path, engine='zarr', consolidated=True)['0'].time.values
+
+
+def test_appended_pyramid_matches_rebuilt_pyramid(files, tmp_path):
+    fmt = store_format(keep_bits=10)
+    pyramid_attrs = {'baseline': BASELINE, **fmt}
+    dates = pd.DatetimeIndex(list(files))
+
+    previous_files = {date: files[date] for date in dates[:PREVIOUS_MONTHS]}
+    store_attrs = attrs('float64', fmt)
+
+    previous_store = str(tmp_path / 'previous-store.zarr')
+    update_historical_store(previous_files, previous_store, 'float64', store_attrs, fmt, None)
+    store = str(tmp_path / 'store.zarr')
+    update_historical_store(files, store, 'float64', store_attrs, fmt, previous_store)
+
+    previous = str(tmp_path / 'previous.zarr')
+    save_pyramid(previous_store, previous, pyramid_attrs, fmt, None)
+
+    # only the months of the new release are missing from the previous pyramid
+    times = pyramid_times(previous)
+    all_times = np.array([date.strftime('%Y-%m-%d') for date in dates], dtype='U10')
+    levels = len(xr.open_datatree(previous, engine='zarr').children)
+    np.testing.assert_array_equal(
+        missing_pyramid_times(previous, all_times, levels, pyramid_attrs),
+        all_times[PREVIOUS_MONTHS:],
+    )
+    np.testing.assert_array_equal(times, all_times[:PREVIOUS_MONTHS])
+
+    appended = str(tmp_path / 'appended.zarr')
+    rebuilt = str(tmp_path / 'rebuilt.zarr')
+    save_pyramid(store, appended, pyramid_attrs, fmt, previous)
+    save_pyramid(store, rebuilt, pyramid_attrs, fmt, None)
+
+    xr.testing.assert_identical(
+        xr.open_datatree(appended, engine='zarr', consolidated=True, mask_and_scale=False).load(),
+        xr.open_datatree(rebuilt, engine='zarr', consolidated=True, mask_and_scale=False).load(),
+    )
+    assert len(missing_pyramid_times(appended, all_times, levels, pyramid_attrs)) == 0
+
+    # a pyramid with another format is rebuilt instead
+    assert missing_pyramid_times(appended, all_times, levels, {'baseline': BASELINE}) is not None
+    assert (
+        missing_pyramid_times(appended, all_times, levels, {**pyramid_attrs, 'keep_bits': 0})
+        is None
+    )